@@ -0,0 +1,242 @@
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Limits apply per worker process
+MAX_CONCURRENT = 4
+MAX_CONCURRENT_PER_MODEL = 2
+# Requests beyond this many waiting are turned away instead of queued
+MAX_QUEUE = 100
+QUEUE_TIMEOUT = 300
+# How often a waiting request re-checks its position for queued frames
+POSITION_INTERVAL = 1.0
+DEFAULT_POLICY = 'fifo'
+
+
+class QueueFull(Exception):
+    pass
+
+
+class QueueTimeout(Exception):
+    pass
+
+
+class Ticket:
+    """One chat request waiting for, or holding, an admission slot."""
+
+    def __init__(self, seq, model, user_id):
+        self.seq = seq
+        self.model = model
+        self.user_id = user_id
+        self.enqueued_at = time.monotonic()
+        self.admitted_at = None
+        self.released = False
+        self._event = threading.Event()
+        self._future = None
+        self._loop = None
+
+    @property
+    def admitted(self):
+        return self._event.is_set()
+
+    @property
+    def wait_seconds(self):
+        end = self.admitted_at if self.admitted_at is not None else time.monotonic()
+        return end - self.enqueued_at
+
+    def _grant(self):
+        self.admitted_at = time.monotonic()
+        self._event.set()
+        if self._future is not None:
+            self._loop.call_soon_threadsafe(self._resolve_future)
+
+    def _resolve_future(self):
+        if not self._future.done():
+            self._future.set_result(True)
+
+
+class AdmissionController:
+    """Caps concurrent chats globally and per model, and queues the rest fairly.
+
+    With the 'fifo' policy requests are admitted in arrival order, skipping
+    requests whose model is at its limit. With 'round_robin' each user's
+    requests form their own queue and users take turns, starting with the
+    one served least recently.
+    """
+
+    def __init__(self, max_concurrent=None, max_per_model=None, policy=None, max_queue=None):
+        self.max_concurrent = max_concurrent
+        self.max_per_model = max_per_model
+        self.policy = policy
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._waiting = []
+        self._active = {}
+        self._active_total = 0
+        self._last_served = {}
+        self.stats = {'admitted': 0, 'queued': 0, 'rejected': 0, 'timeouts': 0, 'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0}
+
+    def _global_limit(self):
+        return self.max_concurrent or getattr(settings, 'OLLAMA_CHAT_MAX_CONCURRENT', MAX_CONCURRENT)
+
+    def _model_limit(self, model):
+        overrides = getattr(settings, 'OLLAMA_CHAT_MODEL_CONCURRENCY', {})
+        if model in overrides:
+            return overrides[model]
+        return self.max_per_model or getattr(settings, 'OLLAMA_CHAT_MAX_CONCURRENT_PER_MODEL', MAX_CONCURRENT_PER_MODEL)
+
+    def _policy(self):
+        return self.policy or getattr(settings, 'OLLAMA_CHAT_QUEUE_POLICY', DEFAULT_POLICY)
+
+    def _ordered_waiting(self):
+        if self._policy() != 'round_robin':
+            return list(self._waiting)
+        per_user = {}
+        for ticket in self._waiting:
+            per_user.setdefault(ticket.user_id, []).append(ticket)
+        users = sorted(per_user, key=lambda u: (self._last_served.get(u, 0), per_user[u][0].seq))
+        ordered = []
+        for turn in range(max(len(q) for q in per_user.values()) if per_user else 0):
+            ordered.extend(per_user[u][turn] for u in users if turn < len(per_user[u]))
+        return ordered
+
+    def _has_capacity(self, model):
+        return self._active_total < self._global_limit() and self._active.get(model, 0) < self._model_limit(model)
+
+    def _admit(self, ticket):
+        self._active_total += 1
+        self._active[ticket.model] = self._active.get(ticket.model, 0) + 1
+        self._last_served[ticket.user_id] = next(self._seq)
+        self.stats['admitted'] += 1
+        ticket._grant()
+        wait = ticket.wait_seconds
+        self.stats['wait_seconds_total'] += wait
+        self.stats['wait_seconds_max'] = max(self.stats['wait_seconds_max'], wait)
+
+    def _dispatch(self):
+        for ticket in self._ordered_waiting():
+            if self._active_total >= self._global_limit():
+                break
+            if self._has_capacity(ticket.model):
+                self._waiting.remove(ticket)
+                self._admit(ticket)
+
+    def enqueue(self, model, user_id=None):
+        with self._lock:
+            ticket = Ticket(next(self._seq), model, user_id)
+            if not self._waiting and self._has_capacity(model):
+                self._admit(ticket)
+                return ticket
+            max_queue = self.max_queue or getattr(settings, 'OLLAMA_CHAT_MAX_QUEUE', MAX_QUEUE)
+            if len(self._waiting) >= max_queue:
+                self.stats['rejected'] += 1
+                raise QueueFull("The server is busy, please try again shortly")
+            self._waiting.append(ticket)
+            self.stats['queued'] += 1
+            # A slot may be free for this model even though others are waiting on theirs
+            self._dispatch()
+            return ticket
+
+    def position(self, ticket):
+        with self._lock:
+            if ticket.admitted:
+                return 0
+            ordered = self._ordered_waiting()
+            return ordered.index(ticket) + 1 if ticket in ordered else 0
+
+    def wait_positions(self, ticket, timeout=None, cancel=None):
+        # Blocks until admitted, yielding the queue position whenever it changes (for WSGI views).
+        # Returns early once cancel is set; the caller checks it and releases the ticket
+        timeout = timeout if timeout is not None else getattr(settings, 'OLLAMA_CHAT_QUEUE_TIMEOUT', QUEUE_TIMEOUT)
+        deadline = time.monotonic() + timeout
+        last_position = None
+        while True:
+            position = self.position(ticket)
+            if not position:
+                return
+            if position != last_position:
+                last_position = position
+                yield position
+            if ticket._event.wait(min(POSITION_INTERVAL, max(deadline - time.monotonic(), 0))):
+                return
+            if cancel is not None and cancel.is_set():
+                return
+            if time.monotonic() >= deadline:
+                self._expire(ticket)
+
+    async def wait_positions_async(self, ticket, timeout=None, cancel=None):
+        # Async counterpart of wait_positions for async views and consumers
+        timeout = timeout if timeout is not None else getattr(settings, 'OLLAMA_CHAT_QUEUE_TIMEOUT', QUEUE_TIMEOUT)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if ticket.admitted:
+                return
+            ticket._loop = loop
+            ticket._future = loop.create_future()
+        deadline = time.monotonic() + timeout
+        last_position = None
+        while True:
+            position = self.position(ticket)
+            if not position:
+                return
+            if position != last_position:
+                last_position = position
+                yield position
+            try:
+                await asyncio.wait_for(asyncio.shield(ticket._future), min(POSITION_INTERVAL, max(deadline - time.monotonic(), 0)))
+                return
+            except asyncio.TimeoutError:
+                pass
+            if cancel is not None and cancel.is_set():
+                return
+            if time.monotonic() >= deadline:
+                self._expire(ticket)
+
+    def _expire(self, ticket):
+        with self._lock:
+            if ticket.admitted:
+                return
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+            ticket.released = True
+            self.stats['timeouts'] += 1
+        raise QueueTimeout("Timed out waiting for a free model slot")
+
+    def release(self, ticket):
+        # Safe to call for admitted, waiting and already released tickets
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.admitted:
+                self._active_total -= 1
+                self._active[ticket.model] -= 1
+                if not self._active[ticket.model]:
+                    del self._active[ticket.model]
+            elif ticket in self._waiting:
+                self._waiting.remove(ticket)
+            self._dispatch()
+
+    def metrics(self):
+        with self._lock:
+            depth_per_model = {}
+            for ticket in self._waiting:
+                depth_per_model[ticket.model] = depth_per_model.get(ticket.model, 0) + 1
+            oldest = max((t.wait_seconds for t in self._waiting), default=0.0)
+            return dict(
+                self.stats,
+                depth=len(self._waiting),
+                depth_per_model=depth_per_model,
+                active=self._active_total,
+                active_per_model=dict(self._active),
+                oldest_wait_seconds=oldest
+            )
+
+
+admission = AdmissionController()
@@ -0,0 +1,166 @@
+import asyncio
+import queue
+import threading
+import time
+from django.core.cache import cache
+
+# A cancel may arrive before the request it targets starts; the flag waits this long for it
+CANCEL_TTL = 600
+# Seconds between checks for cancels that were sent to another worker
+POLL_INTERVAL = 0.5
+# How often a stream that has not produced a chunk yet checks for a cancel
+STREAM_CHECK_INTERVAL = 0.1
+
+
+def _cancel_key(user_id, request_id):
+    return f'ollama_chat_cancel_{user_id}_{request_id}'
+
+
+class CancelToken:
+    """Cancellation flag for one chat request, shared with the threads that serve it.
+
+    Tokens for HTTP streams are shared: a cancel posted to any worker reaches
+    them through the cache. WebSocket tokens only live on their connection.
+    """
+
+    def __init__(self, request_id=None, user_id=None, shared=False):
+        self.request_id = request_id
+        self.user_id = user_id
+        self.shared = shared
+        self._event = threading.Event()
+        self._checked_at = 0
+
+    def cancel(self):
+        self._event.set()
+
+    def is_set(self):
+        if self._event.is_set():
+            return True
+        if self.shared and time.monotonic() - self._checked_at >= POLL_INTERVAL:
+            self._checked_at = time.monotonic()
+            if cache.get(_cancel_key(self.user_id, self.request_id)):
+                self._event.set()
+        return self._event.is_set()
+
+
+class CancelRegistry:
+    """Running HTTP chat streams of this process, keyed by user and request id."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = {}
+
+    def register(self, user_id, request_id):
+        token = CancelToken(request_id, user_id, shared=True)
+        with self._lock:
+            self._tokens[(user_id, request_id)] = token
+        return token
+
+    def unregister(self, token):
+        with self._lock:
+            if self._tokens.get((token.user_id, token.request_id)) is token:
+                del self._tokens[(token.user_id, token.request_id)]
+        cache.delete(_cancel_key(token.user_id, token.request_id))
+
+    def cancel(self, user_id, request_id):
+        # Returns whether the request runs in this process; others see the cache flag
+        cache.set(_cancel_key(user_id, request_id), True, CANCEL_TTL)
+        with self._lock:
+            token = self._tokens.get((user_id, request_id))
+        if token is not None:
+            token.cancel()
+        return token is not None
+
+
+chat_cancels = CancelRegistry()
+
+
+class _StreamError:
+    def __init__(self, error):
+        self.error = error
+
+
+_STREAM_END = object()
+
+
+def iter_cancellable(stream, cancel):
+    """Iterates a blocking Ollama stream so a cancel is seen even before the first chunk.
+
+    The stream is read on a helper thread, one chunk per request, and closed
+    there too: a generator cannot be closed from another thread while it waits
+    for the daemon.
+    """
+    chunks = queue.Queue()
+    wanted = threading.Semaphore(0)
+    stop = threading.Event()
+
+    def pump():
+        try:
+            iterator = iter(stream)
+            while True:
+                wanted.acquire()
+                if stop.is_set():
+                    break
+                try:
+                    chunks.put(next(iterator))
+                except StopIteration:
+                    break
+        except Exception as e:
+            chunks.put(_StreamError(e))
+        finally:
+            close = getattr(stream, 'close', None)
+            if close:
+                close()
+            chunks.put(_STREAM_END)
+
+    thread = threading.Thread(target=pump, name='ollama-stream', daemon=True)
+    thread.start()
+    try:
+        while True:
+            wanted.release()
+            item = None
+            while item is None:
+                try:
+                    item = chunks.get(timeout=STREAM_CHECK_INTERVAL)
+                except queue.Empty:
+                    if cancel.is_set():
+                        return
+            if item is _STREAM_END:
+                return
+            if isinstance(item, _StreamError):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        wanted.release()
+        # Usually immediate; a pump still waiting on the daemon closes the stream when it answers
+        thread.join(STREAM_CHECK_INTERVAL)
+
+
+async def aiter_cancellable(stream, cancel):
+    # Like iter_cancellable; cancelling the pending read closes the daemon's response
+    try:
+        while True:
+            next_chunk = asyncio.ensure_future(stream.__anext__())
+            try:
+                while not next_chunk.done():
+                    await asyncio.wait({next_chunk}, timeout=STREAM_CHECK_INTERVAL)
+                    if not next_chunk.done() and cancel.is_set():
+                        next_chunk.cancel()
+                        try:
+                            await next_chunk
+                        except (asyncio.CancelledError, StopAsyncIteration):
+                            pass
+                        return
+            except asyncio.CancelledError:
+                next_chunk.cancel()
+                raise
+            try:
+                chunk = next_chunk.result()
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        aclose = getattr(stream, 'aclose', None)
+        if aclose:
+            await aclose()
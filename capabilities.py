@@ -0,0 +1,299 @@
+import threading
+import logging
+import time
+import requests
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Capabilities scraped from the Ollama library are guesses, so they are re-checked after 24 hours.
+# Capabilities reported by the local daemon are tied to a digest and never go stale.
+CAPABILITIES_TTL = 86400
+# The capability index lock expires on its own if a worker dies holding it
+INDEX_LOCK_TIMEOUT = 5
+INDEX_LOCK_WAIT = 2
+DEFAULT_CAPABILITIES = {'tools': False, 'thinking': False, 'vision': False, 'embedding': False}
+
+
+def get_base_name(model_full_name):
+    # 'llama3.1:latest' -> 'llama3.1'
+    return model_full_name.split(':')[0] if ':' in model_full_name else model_full_name
+
+
+def get_model_field(model, field, default=None):
+    # Ollama responses may be Pydantic objects or plain dicts depending on the client version
+    if isinstance(model, dict):
+        return model.get(field, default)
+    return getattr(model, field, default)
+
+
+def get_model_key(model):
+    # Digests change whenever the model changes, so they make a stable index key
+    return get_model_field(model, 'digest') or get_model_field(model, 'model', '')
+
+
+def is_stale(cache_entry, now=None):
+    if not cache_entry:
+        return True
+    if cache_entry.get('source') == 'local':
+        return False
+    now = now or time.time()
+    return now - cache_entry.get('timestamp', 0) > CAPABILITIES_TTL
+
+
+def remote_fallback_enabled():
+    return getattr(settings, 'OLLAMA_CAPABILITIES_REMOTE_FALLBACK', True)
+
+
+def resolve_local_capabilities(client, model_full_name):
+    info = client.show(model_full_name)
+    details = get_model_field(info, 'details') or {}
+    modelinfo = get_model_field(info, 'modelinfo') or get_model_field(info, 'model_info') or {}
+
+    # Context length is namespaced by architecture, e.g. 'llama.context_length'
+    context_length = next((v for k, v in modelinfo.items() if k.endswith('.context_length')), None)
+
+    result = {
+        'context_length': context_length,
+        'quantization': get_model_field(details, 'quantization_level'),
+        'family': get_model_field(details, 'family'),
+        'timestamp': time.time()
+    }
+
+    capabilities = get_model_field(info, 'capabilities')
+    if capabilities is None:
+        # Older daemons do not report capabilities
+        result['source'] = None
+        return result
+
+    capabilities = set(capabilities)
+    result.update({
+        'tools': 'tools' in capabilities,
+        'thinking': 'thinking' in capabilities,
+        'vision': 'vision' in capabilities,
+        'embedding': 'embedding' in capabilities,
+        'source': 'local'
+    })
+    return result
+
+
+def fetch_library_capabilities(model_base_name):
+    response = requests.get(f"https://ollama.com/library/{model_base_name}", timeout=5)
+    if response.status_code != 200:
+        return None
+    html = response.text.lower()
+    return {
+        'tools': 'tools' in html,
+        'thinking': 'thinking' in html,
+        'vision': 'vision' in html,
+        'embedding': 'embedding' in html,
+        'source': 'library',
+        'timestamp': time.time()
+    }
+
+
+def resolve_capabilities(client, model_full_name):
+    caps = resolve_local_capabilities(client, model_full_name)
+    if caps['source'] is not None:
+        return caps
+    if not remote_fallback_enabled():
+        # Trust the daemon: a model without reported capabilities has none
+        caps.update(DEFAULT_CAPABILITIES)
+        caps['source'] = 'local'
+        return caps
+    remote = fetch_library_capabilities(get_base_name(model_full_name))
+    if not remote:
+        # Leave the model pending so it is retried on a later render
+        return None
+    caps.update(remote)
+    return caps
+
+
+class CapabilityStore:
+    """Capability entries kept one cache key per model, with per-entry TTL and LRU eviction.
+
+    The index of entries and their last use is shared by all workers, so it is
+    only rewritten under a cache lock.
+    """
+
+    index_key = 'ollama_capabilities_index'
+    lock_key = 'ollama_capabilities_index_lock'
+
+    def __init__(self, max_entries=256, local_ttl=7 * 86400):
+        self.max_entries = max_entries
+        self.local_ttl = local_ttl
+
+    def _entry_key(self, model_key):
+        return f'ollama_capabilities_{model_key}'
+
+    def _get_max_entries(self):
+        return getattr(settings, 'OLLAMA_CAPABILITIES_MAX_ENTRIES', self.max_entries)
+
+    def _get_ttl(self, caps):
+        if caps.get('source') == 'local':
+            return getattr(settings, 'OLLAMA_CAPABILITIES_LOCAL_TTL', self.local_ttl)
+        # Library guesses outlive their freshness window so stale values can be shown while refreshing
+        return CAPABILITIES_TTL * 2
+
+    def _get_index(self):
+        from django.core.cache import cache
+        return cache.get(self.index_key) or {'entries': {}, 'fingerprint': None}
+
+    def _save_index(self, index):
+        from django.core.cache import cache
+        cache.set(self.index_key, index, None)
+
+    @contextmanager
+    def _index_lock(self, wait=INDEX_LOCK_WAIT):
+        # Yields whether the lock was taken; a holder that died releases it after INDEX_LOCK_TIMEOUT
+        from django.core.cache import cache
+        deadline = time.monotonic() + wait
+        while not cache.add(self.lock_key, True, INDEX_LOCK_TIMEOUT):
+            if time.monotonic() >= deadline:
+                yield False
+                return
+            time.sleep(0.01)
+        try:
+            yield True
+        finally:
+            cache.delete(self.lock_key)
+
+    def _touch(self, entries, model_keys, now):
+        # Re-inserted so entries used at the same instant still leave in order of use
+        for model_key in model_keys:
+            entries.pop(model_key, None)
+            entries[model_key] = now
+
+    def _evict(self, index):
+        entries = index['entries']
+        overflow = len(entries) - self._get_max_entries()
+        if overflow <= 0:
+            return []
+        # Least recently used entries go first
+        evicted = sorted(entries, key=entries.get)[:overflow]
+        for model_key in evicted:
+            entries.pop(model_key, None)
+        return evicted
+
+    def get_many(self, model_keys):
+        from django.core.cache import cache
+        entry_keys = {self._entry_key(k): k for k in model_keys}
+        found = {entry_keys[k]: v for k, v in cache.get_many(list(entry_keys)).items()}
+        if found:
+            self._record_use(found)
+        return found
+
+    def _record_use(self, model_keys):
+        # One index write per render; skipped rather than waited for when another worker holds the lock
+        with self._index_lock(wait=0) as locked:
+            if not locked:
+                return
+            index = self._get_index()
+            used = [k for k in model_keys if k in index['entries']]
+            if used:
+                self._touch(index['entries'], used, time.time())
+                self._save_index(index)
+
+    def get(self, model_key):
+        return self.get_many([model_key]).get(model_key)
+
+    def set(self, model_key, caps):
+        from django.core.cache import cache
+        cache.set(self._entry_key(model_key), caps, self._get_ttl(caps))
+        with self._index_lock() as locked:
+            if not locked:
+                # The entry still expires with its TTL; it just cannot be evicted or pruned early
+                logger.debug(f"Capability index busy, {model_key} was not indexed")
+                return
+            index = self._get_index()
+            self._touch(index['entries'], [model_key], time.time())
+            evicted = self._evict(index)
+            self._save_index(index)
+        if evicted:
+            cache.delete_many([self._entry_key(k) for k in evicted])
+
+    def prune(self, installed_keys, fingerprint=None):
+        # Drop entries for uninstalled models; a matching fingerprint means nothing changed
+        from django.core.cache import cache
+        if fingerprint is not None and self._get_index().get('fingerprint') == fingerprint:
+            return []
+        with self._index_lock() as locked:
+            if not locked:
+                # Retried by the next render, since the fingerprint was not recorded
+                return []
+            index = self._get_index()
+            if fingerprint is not None and index.get('fingerprint') == fingerprint:
+                return []
+            installed_keys = set(installed_keys)
+            removed = [k for k in index['entries'] if k not in installed_keys]
+            for model_key in removed:
+                index['entries'].pop(model_key, None)
+            # Installed models count as recently used
+            self._touch(index['entries'], [k for k in installed_keys if k in index['entries']], time.time())
+            index['fingerprint'] = fingerprint
+            self._save_index(index)
+        if removed:
+            cache.delete_many([self._entry_key(k) for k in removed])
+        return removed
+
+    def clear(self):
+        from django.core.cache import cache
+        with self._index_lock():
+            index = self._get_index()
+            cache.delete_many([self._entry_key(k) for k in index['entries']] + [self.index_key])
+
+
+capability_store = CapabilityStore()
+
+
+class CapabilityRefresher:
+    """Resolves model capabilities off the render path with a bounded worker pool."""
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        # model key -> Future, so concurrent renders never resolve the same model twice
+        self._in_flight = {}
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='ollama-caps')
+        return self._executor
+
+    def is_pending(self, model_key):
+        with self._lock:
+            return model_key in self._in_flight
+
+    def schedule(self, models):
+        # models is a list of (model_key, model_full_name) pairs
+        scheduled = []
+        with self._lock:
+            executor = self._get_executor()
+            for model_key, model_full_name in models:
+                if model_key in self._in_flight:
+                    continue
+                future = executor.submit(self._refresh, model_key, model_full_name)
+                self._in_flight[model_key] = future
+                scheduled.append(model_key)
+        return scheduled
+
+    def _refresh(self, model_key, model_full_name):
+        try:
+            from .clients import get_client
+            client = get_client()
+            caps = resolve_capabilities(client, model_full_name)
+            if caps is not None:
+                capability_store.set(model_key, caps)
+                from . import model_events
+                model_events.publish_capabilities(model_full_name)
+        except Exception as e:
+            logger.debug(f"Capability refresh failed for {model_full_name}: {e}")
+        finally:
+            with self._lock:
+                self._in_flight.pop(model_key, None)
+
+
+capability_refresher = CapabilityRefresher()
@@ -0,0 +1,209 @@
+import logging
+from . import context_window, response_cache
+from .metrics import RequestTimer, chat_metrics
+from .streaming import (
+    STREAM_HELPERS_SCRIPT, ReplyTurn, render_chat_error, render_reply_container,
+    render_reply_done, render_tool_call, render_tool_result
+)
+
+logger = logging.getLogger(__name__)
+
+
+class HtmlReplyFrames:
+    """chat_send frames: HTML fragments batched through a FrameCoalescer."""
+
+    def __init__(self, coalescer):
+        self.coalescer = coalescer
+
+    def start(self, model):
+        return [self.coalescer.record(STREAM_HELPERS_SCRIPT), self.coalescer.record(render_reply_container(model))]
+
+    def start_turn(self, model):
+        return []
+
+    def text(self, text):
+        return self.coalescer.add(text)
+
+    def flush(self):
+        return self.coalescer.flush()
+
+    def tool_call(self, func_name, func_args):
+        return self.coalescer.record(render_tool_call(func_name, func_args))
+
+    def tool_result(self, func_name, outcome):
+        return self.coalescer.record(render_tool_result(func_name, outcome))
+
+    def done(self, reply):
+        new_total_tokens = reply.chat['total_tokens'] + reply.tokens
+        return self.coalescer.record(render_reply_done(
+            reply.content, reply.tokens, reply.stopped, reply.chat['session_id'], new_total_tokens, reply.timer.timing()
+        ))
+
+    def error(self, error):
+        return self.coalescer.record(render_chat_error(error))
+
+    def log_stats(self, label, model):
+        stats = self.coalescer.stats
+        logger.debug(f"{label} for {model}: {stats['chunks']} chunks, {stats['flushes']} flushes, {stats['bytes']} bytes")
+        chat_metrics.record_stream('http', {k: stats[k] for k in ('chunks', 'frames', 'bytes')})
+
+
+class JsonReplyFrames:
+    """WebSocket frames; the consumer's FrameBuffer merges adjacent content frames itself."""
+
+    def start(self, model):
+        return []
+
+    def start_turn(self, model):
+        return [{'type': 'start_turn', 'model': model}]
+
+    def text(self, text):
+        return {'type': 'content', 'content': text} if text else None
+
+    def flush(self):
+        return None
+
+    def tool_call(self, func_name, func_args):
+        return {'type': 'tool_call', 'name': func_name, 'args': func_args}
+
+    def tool_result(self, func_name, outcome):
+        return {'type': 'tool_result', 'name': func_name, 'result': outcome['result'], 'duration_ms': outcome['duration_ms']}
+
+    def done(self, reply):
+        return {
+            'type': 'done',
+            'stopped': reply.stopped,
+            'timing': reply.timer.timing(),
+            'request_id': reply.cancel.request_id,
+            'full_content': reply.content,
+            'total_tokens': reply.tokens,
+            'session_id': reply.chat['session_id'],
+            # The client already has its own message
+            'history_delta': reply.session_messages()[1:]
+        }
+
+    def error(self, error):
+        return {'type': 'error', 'message': f"Ollama Error: {error}"}
+
+
+class ChatReply:
+    """One chat reply across its model turns and tool calls.
+
+    Methods return the frames to send, rendered by `frames`, so chat_send,
+    chat_send_async and the WebSocket consumer share all of it and only differ
+    in how they call Ollama, the cache and the tools.
+    """
+
+    def __init__(self, chat, frames, cancel):
+        self.chat = chat
+        self.model = chat['model']
+        self.frames = frames
+        self.cancel = cancel
+        self.messages = chat['api_messages'].copy()
+        self.tokens = 0
+        self.content = ""
+        self.stopped = False
+        self.timer = RequestTimer(self.model)
+        self.turn = None
+        self.calls = []
+        self.outcomes = []
+
+    def fit(self, summarizer=None):
+        # Fits the history into num_ctx, leaving room for the reply
+        chat = self.chat
+        chat['api_messages'] = context_window.fit_messages(
+            chat['api_messages'], chat['options']['num_ctx'], chat['context_strategy'], chat['api_tools'], summarizer
+        )
+        self.messages = chat['api_messages'].copy()
+
+    def start(self):
+        return self.frames.start(self.model)
+
+    def cache_key(self):
+        chat = self.chat
+        return response_cache.make_key(self.model, chat['digest'], self.messages, chat['api_tools'], chat['options'])
+
+    def chat_kwargs(self, messages):
+        # messages are self.messages with attachments resolved
+        return {
+            'model': self.model,
+            'messages': messages,
+            'keep_alive': self.chat['keep_alive'],
+            'tools': self.chat['api_tools'] if self.chat['api_tools'] else None,
+            'options': self.chat['options'],
+            'stream': True
+        }
+
+    def begin_turn(self):
+        self.turn = ReplyTurn()
+        return self.frames.start_turn(self.model)
+
+    def add(self, chunk):
+        # Returns a frame once there is text to send
+        text = self.turn.add(chunk)
+        self.timer.observe(chunk, text)
+        return self.frames.text(text)
+
+    def end_turn(self):
+        # Returns the frames that close the turn; self.calls holds the tool calls to run next
+        turn = self.turn
+        self.tokens += turn.tokens
+        self.stopped = self.stopped or (self.cancel.is_set() and not turn.done)
+        if self.stopped:
+            # The daemon only reports token counts at the end, so the interrupted turn is estimated
+            self.tokens += sum(context_window.token_estimator.estimate(m) for m in self.messages) + turn.chunks
+            turn.tool_calls = []
+
+        frames = []
+        # Anything still buffered goes out before tool output or the final frame
+        frame = self.frames.text(turn.finish()) or self.frames.flush()
+        if frame:
+            frames.append(frame)
+        self.content += turn.content
+
+        self.calls = []
+        if turn.tool_calls:
+            self.messages.append({'role': 'assistant', 'content': turn.content, 'tool_calls': turn.tool_calls})
+            for tool_call in turn.tool_calls:
+                func_name = tool_call.get('function', {}).get('name')
+                func_args = tool_call.get('function', {}).get('arguments', {})
+                frames.append(self.frames.tool_call(func_name, func_args))
+                self.calls.append((self.chat['tools'].find(func_name), func_name, func_args))
+        self.outcomes = [None] * len(self.calls)
+        return frames
+
+    def tool_result(self, i, outcome):
+        # Results are shown as each call finishes
+        self.outcomes[i] = outcome
+        return self.frames.tool_result(self.calls[i][1], outcome)
+
+    def end_tools(self):
+        # Returns whether the model gets another turn with the tool replies
+        if self.cancel.is_set():
+            # Stopped while tools ran; calls without replies are not kept
+            self.stopped = True
+            self.messages.pop()
+            return False
+        # The model expects tool replies in the order it made the calls
+        for outcome in self.outcomes:
+            self.messages.append({
+                'role': 'tool',
+                'content': outcome['result'],
+            })
+        return True
+
+    def session_messages(self):
+        # Only this turn is stored: the user message and everything the model added after it
+        turn_messages = self.messages[len(self.chat['api_messages']) - 1:]
+        turn_messages.append({"role": "assistant", "content": self.turn.content})
+        return turn_messages
+
+    def done(self):
+        chat_metrics.record(self.timer, self.stopped)
+        return self.frames.done(self)
+
+    def error(self, error):
+        return self.frames.error(error)
+
+    def log_stats(self, label):
+        self.frames.log_stats(label, self.model)
@@ -0,0 +1,123 @@
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from . import image_store
+
+logger = logging.getLogger(__name__)
+
+# Idle sessions expire after this many seconds; every turn renews the lease
+SESSION_TTL = 24 * 3600
+# Oldest messages are dropped once a session's serialized history grows past this
+MAX_SESSION_BYTES = 4 * 1024 * 1024
+# Least recently used sessions of a user are dropped beyond this count
+MAX_SESSIONS_PER_USER = 20
+# Session ids come from clients and end up in cache keys
+SESSION_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _session_key(user_id, session_id):
+    # Scoped by user so a guessed session id never exposes someone else's chat
+    return f'ollama_chat_session_{user_id}_{session_id}'
+
+
+def _index_key(user_id):
+    return f'ollama_chat_sessions_{user_id}'
+
+
+def message_size(message):
+    return len(json.dumps(message, ensure_ascii=False, default=str).encode('utf-8'))
+
+
+def trim_messages(messages, max_bytes):
+    # Drops whole exchanges from the front so the history never starts with a tool reply
+    sizes = [message_size(m) for m in messages]
+    total = sum(sizes)
+    start = 0
+    while total > max_bytes and start < len(messages):
+        total -= sizes[start]
+        start += 1
+        while start < len(messages) and messages[start].get('role') != 'user':
+            total -= sizes[start]
+            start += 1
+    return messages[start:], total
+
+
+class ChatSessionStore:
+    """Keeps chat histories on the server so clients only exchange deltas."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def _ttl(self):
+        return getattr(settings, 'OLLAMA_CHAT_SESSION_TTL', SESSION_TTL)
+
+    def _touch_index(self, user_id, session_id=None, remove=None):
+        max_sessions = getattr(settings, 'OLLAMA_CHAT_MAX_SESSIONS_PER_USER', MAX_SESSIONS_PER_USER)
+        with self._lock:
+            index = cache.get(_index_key(user_id)) or {}
+            if remove:
+                index.pop(remove, None)
+            if session_id:
+                index[session_id] = time.time()
+            evicted = []
+            while len(index) > max_sessions:
+                oldest = min(index, key=index.get)
+                index.pop(oldest)
+                evicted.append(oldest)
+            cache.set(_index_key(user_id), index, self._ttl())
+        if evicted:
+            cache.delete_many([_session_key(user_id, s) for s in evicted])
+
+    def get(self, user_id, session_id):
+        if not session_id:
+            return None
+        return cache.get(_session_key(user_id, session_id))
+
+    def get_messages(self, user_id, session_id):
+        session = self.get(user_id, session_id)
+        return list(session['messages']) if session else None
+
+    def resume(self, user_id, session_id, history=None):
+        # Returns (session_id, messages); unknown or expired sessions are recreated,
+        # seeded from a client-sent history when one is provided
+        if session_id and SESSION_ID_RE.match(session_id):
+            messages = self.get_messages(user_id, session_id)
+            if messages is not None:
+                return session_id, messages
+        else:
+            session_id = uuid.uuid4().hex
+        history = history or []
+        self._save(user_id, session_id, {'messages': [], 'size': 0, 'total_tokens': 0}, history)
+        return session_id, list(history)
+
+    def append(self, user_id, session_id, messages, tokens=0):
+        session = self.get(user_id, session_id) or {'messages': [], 'size': 0, 'total_tokens': 0}
+        session['total_tokens'] += tokens
+        return self._save(user_id, session_id, session, messages)
+
+    def _save(self, user_id, session_id, session, new_messages):
+        max_bytes = getattr(settings, 'OLLAMA_CHAT_SESSION_MAX_BYTES', MAX_SESSION_BYTES)
+        session['messages'] = session['messages'] + list(new_messages)
+        session['size'] += sum(message_size(m) for m in new_messages)
+        if session['size'] > max_bytes:
+            before = len(session['messages'])
+            session['messages'], session['size'] = trim_messages(session['messages'], max_bytes)
+            logger.debug(f"Trimmed {before - len(session['messages'])} messages from chat session {session_id}")
+        session['updated_at'] = time.time()
+        cache.set(_session_key(user_id, session_id), session, self._ttl())
+        self._touch_index(user_id, session_id)
+        # Keeps the attachments of a live session out of garbage collection
+        image_store.touch(image_store.message_refs(session['messages']))
+        return session
+
+    def delete(self, user_id, session_id):
+        cache.delete(_session_key(user_id, session_id))
+        self._touch_index(user_id, remove=session_id)
+
+
+chat_sessions = ChatSessionStore()
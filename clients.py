@@ -0,0 +1,135 @@
+import asyncio
+import atexit
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+import httpx
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = 'http://localhost:11434'
+MAX_CONNECTIONS = 20
+# Clients per pool, one for each distinct API token; evicting one closes no connections
+MAX_CLIENTS = 64
+MAX_KEEPALIVE_CONNECTIONS = 10
+# Idle keep-alive connections are dropped after this many seconds
+KEEPALIVE_EXPIRY = 30
+
+
+def get_host():
+    return getattr(settings, 'OLLAMA_HOST', DEFAULT_HOST)
+
+
+def auth_headers(api_token=None):
+    if api_token:
+        return {"Authorization": f"Bearer {api_token}"}
+    return {}
+
+
+def _limits():
+    return httpx.Limits(
+        max_connections=getattr(settings, 'OLLAMA_CLIENT_MAX_CONNECTIONS', MAX_CONNECTIONS),
+        max_keepalive_connections=getattr(settings, 'OLLAMA_CLIENT_MAX_KEEPALIVE', MAX_KEEPALIVE_CONNECTIONS),
+        keepalive_expiry=getattr(settings, 'OLLAMA_CLIENT_KEEPALIVE_EXPIRY', KEEPALIVE_EXPIRY)
+    )
+
+
+class ClientRegistry:
+    """Shares keep-alive connections to Ollama, one pool per host.
+
+    Clients differ only in their auth header, so every token gets a thin
+    client over the host's shared transport. Those are kept in a bounded LRU;
+    dropping one releases no connections, so in-flight streams are unaffected.
+    Async transports are bound to the event loop that created them, so they
+    are kept per loop and forgotten when the loop goes away.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._transports = {}
+        self._clients = OrderedDict()
+        self._async_pools = weakref.WeakKeyDictionary()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _key(self, host, api_token):
+        return (host or get_host(), auth_headers(api_token).get('Authorization'))
+
+    def _lookup(self, clients, key, create):
+        # Called with the lock held
+        client = clients.get(key)
+        if client is not None:
+            clients.move_to_end(key)
+            self.stats['hits'] += 1
+            return client
+        self.stats['misses'] += 1
+        client = clients[key] = create()
+        while len(clients) > getattr(settings, 'OLLAMA_CLIENT_CACHE_SIZE', MAX_CLIENTS):
+            clients.popitem(last=False)
+            self.stats['evictions'] += 1
+        return client
+
+    def get_client(self, api_token=None, host=None):
+        import ollama
+        key = self._key(host, api_token)
+        with self._lock:
+            transport = self._transports.get(key[0])
+            if transport is None:
+                transport = self._transports[key[0]] = httpx.HTTPTransport(limits=_limits())
+            # Generation and pulls can run for minutes, so reads are not timed out
+            return self._lookup(self._clients, key, lambda: ollama.Client(
+                host=key[0], headers=auth_headers(api_token), timeout=httpx.Timeout(None), transport=transport
+            ))
+
+    def get_async_client(self, api_token=None, host=None):
+        import ollama
+        key = self._key(host, api_token)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            pool = self._async_pools.setdefault(loop, {'transports': {}, 'clients': OrderedDict()})
+            transport = pool['transports'].get(key[0])
+            if transport is None:
+                transport = pool['transports'][key[0]] = httpx.AsyncHTTPTransport(limits=_limits())
+            return self._lookup(pool['clients'], key, lambda: ollama.AsyncClient(
+                host=key[0], headers=auth_headers(api_token), timeout=httpx.Timeout(None), transport=transport
+            ))
+
+    def pool_size(self):
+        # Connection pools, not clients: tokens on the same host share one
+        with self._lock:
+            return len(self._transports) + sum(len(p['transports']) for p in self._async_pools.values())
+
+    def close(self):
+        # Closes the sync pools; async pools are closed by aclose() on their own loop
+        with self._lock:
+            transports, self._transports = list(self._transports.values()), {}
+            self._clients = OrderedDict()
+        for transport in transports:
+            try:
+                transport.close()
+            except Exception as e:
+                logger.debug(f"Failed to close Ollama connection pool: {e}")
+
+    async def aclose(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            pool = self._async_pools.pop(loop, None)
+        for transport in (pool['transports'].values() if pool else []):
+            try:
+                await transport.aclose()
+            except Exception as e:
+                logger.debug(f"Failed to close Ollama async connection pool: {e}")
+
+    def clear(self):
+        self.close()
+        with self._lock:
+            self._async_pools = weakref.WeakKeyDictionary()
+            self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+client_registry = ClientRegistry()
+get_client = client_registry.get_client
+get_async_client = client_registry.get_async_client
+
+atexit.register(client_registry.close)
@@ -1,10 +1,25 @@
 import json
-import ollama
-import httpx
+import logging
 import asyncio
+import uuid
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
+from asgiref.sync import sync_to_async
 from channels.db import database_sync_to_async
 from core.models import Tool
+from . import context_window, image_store, model_cache, model_events, response_cache
+from .admission import QueueFull, QueueTimeout, admission
+from .cancellation import CancelToken, aiter_cancellable
+from .chat_reply import ChatReply, JsonReplyFrames
+from .chat_sessions import chat_sessions
+from .metrics import chat_metrics
+from .clients import get_async_client, get_client
+from .warm_pool import keep_alive_for
+from .tool_registry import tool_registry
+from .tool_runner import tool_runner
+from .streaming import FrameBuffer, SlowClientError
+
+logger = logging.getLogger(__name__)
 
 class OllamaChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -13,6 +28,8 @@ class OllamaChatConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
         self.chat_task = None
+        self.outgoing = None
+        self.cancel = None
         await self.accept()
 
     async def disconnect(self, close_code):
@@ -21,15 +38,19 @@ class OllamaChatConsumer(AsyncWebsocketConsumer):
 
     async def receive(self, text_data):
         try:
+            data = json.loads(text_data)
+            if data.get('type') == 'stop':
+                await self.stop_chat(data.get('request_id'))
+                return
+
             # Cancel any existing task if user sends a new message while one is processing
             if self.chat_task and not self.chat_task.done():
                 self.chat_task.cancel()
             
-            data = json.loads(text_data)
             # ... (rest of the logic)
             model = data.get('model')
             message = data.get('message')
-            history = data.get('history', [])
+            session_id = data.get('session_id') or ''
             system_prompt = data.get('system_prompt', '')
             temperature = float(data.get('temperature', 0.7))
             top_p = float(data.get('top_p', 0.9))
@@ -42,20 +63,12 @@ class OllamaChatConsumer(AsyncWebsocketConsumer):
                 await self.send_error("Model and message are required")
                 return
 
-            # Get tool definitions from DB
-            all_tools = await self.get_ollama_tools()
-            selected_tools = [t for t in all_tools if t['id'] in selected_tools_ids]
-            
-            api_tools = []
-            for t in selected_tools:
-                api_tools.append({
-                    'type': 'function',
-                    'function': {
-                        'name': t['name'],
-                        'description': t['description'],
-                        'parameters': t['parameters']
-                    }
-                })
+            # History lives on the server; only older clients still send it, to seed a new session
+            session_id, history = await sync_to_async(chat_sessions.resume)(self.user.pk, session_id, data.get('history'))
+
+            # Tool definitions and their API schemas come from the in-process registry
+            tools = await self.get_ollama_tools()
+            api_tools = tools.select(selected_tools_ids)
 
             # Prepare messages
             api_messages = []
@@ -81,6 +94,8 @@ class OllamaChatConsumer(AsyncWebsocketConsumer):
                 msg = {"role": m["role"], "content": m["content"]}
                 if "images" in m:
                     msg["images"] = m["images"]
+                if "image_refs" in m:
+                    msg["image_refs"] = m["image_refs"]
                 if "tool_calls" in m:
                     msg["tool_calls"] = m["tool_calls"]
                 api_messages.append(msg)
@@ -88,169 +103,225 @@ class OllamaChatConsumer(AsyncWebsocketConsumer):
             # Add current user message
             user_msg = {"role": "user", "content": message}
             if data.get('images'):
-                user_msg["images"] = data.get('images')
+                # Stored once by content hash; the session only keeps the references
+                user_msg["image_refs"] = [await asyncio.to_thread(image_store.put_base64, image) for image in data['images']]
             api_messages.append(user_msg)
 
+            chat = {
+                'model': model,
+                'session_id': session_id,
+                'api_token': api_token,
+                'api_messages': api_messages,
+                'context_strategy': data.get('context_strategy'),
+                'api_tools': api_tools,
+                'tools': tools,
+                # Pinned models keep their own lease instead of the daemon default
+                'keep_alive': await database_sync_to_async(keep_alive_for)(model),
+                # Deterministic requests can be replayed from the response cache; the digest ties entries to the model version
+                'digest': await database_sync_to_async(response_cache.get_model_digest)(model) if response_cache.is_enabled() else None,
+                'options': {
+                    "temperature": temperature,
+                    "top_p": top_p,
+                    "num_ctx": num_ctx
+                }
+            }
+
             # Start Ollama interaction in a task so it can be cancelled
-            self.chat_task = asyncio.create_task(
-                self.process_chat(model, api_messages, api_tools, temperature, top_p, num_ctx, api_token, all_tools)
-            )
+            cancel = self.cancel = CancelToken(data.get('request_id') or uuid.uuid4().hex, self.user.pk)
+            self.chat_task = asyncio.create_task(self.process_chat(chat, cancel))
 
         except Exception as e:
             await self.send_error(str(e))
 
-    async def process_chat(self, model, messages, api_tools, temperature, top_p, num_ctx, api_token, all_tools_defs):
-        headers = {}
-        if api_token:
-            headers["Authorization"] = f"Bearer {api_token}"
-
-        client = ollama.AsyncClient(
-            host='http://localhost:11434', 
-            headers=headers,
-            timeout=httpx.Timeout(None)
-        )
-
-        current_messages = messages.copy()
-        total_tokens = 0
-        accumulated_content = ""
-
-        while True:
-            full_content = ""
-            is_reasoning_mode = False
-            tool_calls = []
-            
-            # Notify client that we are starting a new turn
-            await self.send(json.dumps({
-                'type': 'start_turn',
-                'model': model
-            }))
+    async def stop_chat(self, request_id=None):
+        # Stops the queue wait, the stream and running tools; the reply still ends with a done frame carrying the partial answer
+        cancel = self.cancel
+        if cancel is None or not self.chat_task or self.chat_task.done():
+            return
+        if request_id and request_id != cancel.request_id:
+            return
+        cancel.cancel()
 
-            try:
-                async for chunk in await client.chat(
-                    model=model,
-                    messages=current_messages,
-                    tools=api_tools if api_tools else None,
-                    options={
-                        "temperature": temperature,
-                        "top_p": top_p,
-                        "num_ctx": num_ctx
-                    },
-                    stream=True
-                ):
-                    # Handle thinking/reasoning content
-                    reasoning = chunk.get('message', {}).get('reasoning_content', '')
-                    content = chunk.get('message', {}).get('content', '')
-                    
-                    # Collect tool calls
-                    chunk_tool_calls = chunk.get('message', {}).get('tool_calls', [])
-                    if chunk_tool_calls:
-                        tool_calls.extend(chunk_tool_calls)
-
-                    if reasoning:
-                        if not is_reasoning_mode:
-                            is_reasoning_mode = True
-                            full_content += "<thought>\n"
-                            await self.send_content("<thought>\n")
-                        full_content += reasoning
-                        await self.send_content(reasoning)
-
-                    if content:
-                        # If we were in reasoning mode from reasoning_content, close it
-                        if is_reasoning_mode: 
-                            is_reasoning_mode = False
-                            full_content += "\n</thought>\n\n"
-                            await self.send_content("\n</thought>\n\n")
-                        
-                        full_content += content
-                        await self.send_content(content)
-
-                    if chunk.get('done'):
-                        total_tokens += (chunk.get('prompt_eval_count', 0) + chunk.get('eval_count', 0))
+    async def process_chat(self, chat, cancel):
+        # Every frame of this reply goes through one buffer and one writer task
+        outgoing = self.outgoing = FrameBuffer(self.send).start()
+        ticket = None
+        try:
+            # Requests beyond the per-model and global limits wait here instead of piling onto the daemon
+            ticket = admission.enqueue(chat['model'], self.user.pk)
+            async for position in admission.wait_positions_async(ticket, cancel=cancel):
+                await outgoing.put({'type': 'queued', 'position': position})
+            if cancel.is_set():
+                # Stopped while still waiting for a slot
+                await outgoing.put({
+                    'type': 'done', 'stopped': True, 'request_id': cancel.request_id, 'full_content': '',
+                    'total_tokens': 0, 'session_id': chat['session_id'], 'history_delta': []
+                })
+            else:
+                await self.stream_chat(chat, cancel)
+            await outgoing.close()
+        except (QueueFull, QueueTimeout) as e:
+            await outgoing.put({'type': 'error', 'message': str(e)})
+            await outgoing.close()
+        except SlowClientError as e:
+            # A client that cannot keep up is dropped instead of buffering without bound
+            logger.warning(f"Closing Ollama chat for slow client: {e}")
+            outgoing.abort()
+            await self.close(code=4008)
+        except asyncio.CancelledError:
+            # Replaced by a newer message or the client went away
+            outgoing.abort()
+            raise
+        finally:
+            if ticket is not None:
+                admission.release(ticket)
+            self.stream_stats = outgoing.stats
+            chat_metrics.record_stream('websocket', {k: outgoing.stats[k] for k in ('chunks', 'frames', 'bytes')})
+            logger.debug(
+                f"Ollama chat stream: {outgoing.stats['chunks']} chunks in {outgoing.stats['frames']} frames "
+                f"({outgoing.stats['merged']} merged, {outgoing.stats['bytes']} bytes)"
+            )
 
-            except Exception as e:
-                await self.send_error(f"Ollama Error: {str(e)}")
-                return
+    async def stream_chat(self, chat, cancel):
+        # Turn handling is shared with chat_send through ChatReply; this only moves frames and calls Ollama
+        reply = ChatReply(chat, JsonReplyFrames(), cancel)
+        outgoing = self.outgoing
+        try:
+            # One keep-alive pool per event loop is shared by every chat on this worker
+            client = get_async_client(chat['api_token'])
+            for frame in reply.start():
+                await outgoing.put(frame)
+            # Summarizing older turns calls the model, so it only happens once admitted
+            await asyncio.to_thread(reply.fit, context_window.model_summarizer(get_client(chat['api_token']), chat['model']))
 
-            if is_reasoning_mode:
-                full_content += "\n</thought>"
-                await self.send_content("\n</thought>")
-
-            accumulated_content += full_content
-
-            if tool_calls:
-                # Add assistant message with tool calls to history
-                assistant_msg = {'role': 'assistant', 'content': full_content, 'tool_calls': tool_calls}
-                current_messages.append(assistant_msg)
-                
-                # Execute tools
-                for tool_call in tool_calls:
-                    func_name = tool_call.get('function', {}).get('name')
-                    func_args = tool_call.get('function', {}).get('arguments', {})
-                    
-                    await self.send(json.dumps({
-                        'type': 'tool_call',
-                        'name': func_name,
-                        'args': func_args
-                    }))
-                    
-                    result = "Tool execution failed or not implemented."
-                    tool_def = next((t for t in all_tools_defs if t['name'] == func_name), None)
-                    
-                    if tool_def and tool_def.get('python_code'):
-                        try:
-                            # Run in a separate thread to not block the event loop
-                            result = await asyncio.to_thread(self.execute_python_tool, tool_def['python_code'], func_args)
-                        except Exception as e:
-                            result = f"Error executing tool: {str(e)}"
-                    elif tool_def:
-                        result = f"Mock result for {func_name}"
-                    
-                    current_messages.append({
-                        'role': 'tool',
-                        'content': result,
-                    })
-                    
-                    await self.send(json.dumps({
-                        'type': 'tool_result',
-                        'name': func_name,
-                        'result': result
-                    }))
-                
-                # Continue the loop for the next model response
-                continue
-            else:
-                # No tool calls, we are done
-                break
+            while True:
+                for frame in reply.begin_turn():
+                    await outgoing.put(frame)
+                cache_key = reply.cache_key()
+                cached = await sync_to_async(response_cache.response_cache.get)(cache_key) if cache_key else None
+                if cached is not None:
+                    stream = response_cache.areplay(cached)
+                else:
+                    # Only loading attachments touches the disk; plain text messages skip the thread hop
+                    messages = reply.messages
+                    if image_store.message_refs(messages):
+                        messages = await asyncio.to_thread(image_store.resolve_images, messages)
+                    stream = await client.chat(**reply.chat_kwargs(messages))
+                    if cache_key:
+                        stream = response_cache.arecord(cache_key, chat['model'], chat['digest'], stream)
+                # A stop is seen even while the daemon is still evaluating the prompt
+                stream = aiter_cancellable(stream, cancel)
 
-        # Finalize
-        await self.send(json.dumps({
-            'type': 'done',
-            'full_content': accumulated_content,
-            'total_tokens': total_tokens,
-            'history_update': current_messages # Send back the full history for the client to store
-        }))
+                try:
+                    async for chunk in stream:
+                        if cancel.is_set():
+                            reply.stopped = True
+                            break
+                        frame = reply.add(chunk)
+                        if frame:
+                            await outgoing.put(frame)
+                finally:
+                    # Closing the stream stops the daemon from generating the rest, or for nobody
+                    await stream.aclose()
+                for frame in reply.end_turn():
+                    await outgoing.put(frame)
+                if not reply.calls:
+                    break
 
-    def execute_python_tool(self, code, args):
-        exec_globals = {'args': args, 'result': None}
-        exec(code, exec_globals)
-        return str(exec_globals.get('result', 'Success (no result returned)'))
+                # Calls run concurrently in worker processes with a timeout; each result is sent as it finishes
+                async for i, outcome in tool_runner.iter_many_async(reply.calls, cancel):
+                    await outgoing.put(reply.tool_result(i, outcome))
+                if not reply.end_tools():
+                    break
+
+            await sync_to_async(chat_sessions.append)(self.user.pk, chat['session_id'], reply.session_messages(), reply.tokens)
+            await outgoing.put(reply.done())
+        except SlowClientError:
+            raise
+        except Exception as e:
+            await outgoing.put(reply.error(e))
 
     @database_sync_to_async
     def get_ollama_tools(self):
-        try:
-            tool_obj = Tool.objects.get(name='ollama')
-            return tool_obj.config_data.get('ollama_tools', [])
-        except Tool.DoesNotExist:
-            return []
+        # Only reaches the database after a tool was saved or deleted
+        return tool_registry.get()
 
     async def send_content(self, content):
-        await self.send(json.dumps({
+        # Adjacent content frames are merged in the buffer before they reach the client
+        await self.outgoing.put({
             'type': 'content',
             'content': content
-        }))
+        })
 
     async def send_error(self, message):
         await self.send(json.dumps({
             'type': 'error',
             'message': message
         }))
+
+
+class OllamaModelsConsumer(AsyncWebsocketConsumer):
+    # A single reconcile loop per process is shared by every open Models tab,
+    # so idle dashboards only receive events instead of polling
+    subscribers = 0
+    reconcile_task = None
+
+    async def connect(self):
+        self.user = self.scope.get('user')
+        self.subscribed = False
+        if not self.user or not self.user.is_authenticated or self.channel_layer is None:
+            await self.close()
+            return
+        await self.channel_layer.group_add(model_events.GROUP_NAME, self.channel_name)
+        await self.accept()
+        self.subscribed = True
+        OllamaModelsConsumer.subscribers += 1
+        self.ensure_reconcile_task()
+
+        # The client compares this with the fingerprint it rendered to catch missed events
+        await self.send(json.dumps({
+            'type': 'hello',
+            'fingerprint': await self.get_fingerprint()
+        }))
+
+    async def disconnect(self, close_code):
+        if self.subscribed:
+            self.subscribed = False
+            OllamaModelsConsumer.subscribers -= 1
+            await self.channel_layer.group_discard(model_events.GROUP_NAME, self.channel_name)
+
+    async def models_event(self, event):
+        await self.send(json.dumps(event['event']))
+
+    @classmethod
+    def ensure_reconcile_task(cls):
+        if cls.reconcile_task is None or cls.reconcile_task.done():
+            cls.reconcile_task = asyncio.create_task(cls.reconcile())
+
+    @classmethod
+    async def reconcile(cls):
+        # Picks up changes made outside the dashboard, e.g. `ollama pull` on the host
+        interval = getattr(settings, 'OLLAMA_MODELS_RECONCILE_SECONDS', 30)
+        while cls.subscribers > 0:
+            await asyncio.sleep(interval)
+            try:
+                await database_sync_to_async(cls.refresh_model_list)()
+            except Exception as e:
+                logger.warning(f"Ollama model list reconcile failed: {e}")
+
+    @staticmethod
+    def refresh_model_list():
+        tool = Tool.objects.get(name='ollama')
+        if tool.status != 'installed':
+            return
+        client = get_client()
+        # Stale lists are refreshed in the background, which publishes the diff
+        model_cache.get_models(tool.id, lambda: model_cache.list_models(client))
+
+    @database_sync_to_async
+    def get_fingerprint(self):
+        try:
+            tool = Tool.objects.get(name='ollama')
+        except Tool.DoesNotExist:
+            return None
+        return model_cache.get_fingerprint(tool.id)
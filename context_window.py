@@ -0,0 +1,200 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Rough average for English text and code across common tokenizers
+CHARS_PER_TOKEN = 4
+# Role markers and separators the chat template adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+# Typical cost of one image for vision models such as llava
+IMAGE_TOKENS = 768
+# Share of num_ctx kept free for the reply, bounded below by MIN_RESERVE_TOKENS
+RESERVE_RATIO = 0.25
+MIN_RESERVE_TOKENS = 256
+# Turns kept by the system_recent strategy
+RECENT_TURNS = 6
+DEFAULT_STRATEGY = 'drop_oldest'
+CACHE_SIZE = 4096
+
+SUMMARY_PROMPT = (
+    "Summarize the following conversation in a few sentences. "
+    "Keep facts, decisions and open questions that later messages may depend on."
+)
+
+
+class TokenEstimator:
+    """Estimates message token costs, memoized by message content."""
+
+    def __init__(self, max_entries=CACHE_SIZE):
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def _key(self, message):
+        digest = hashlib.sha1()
+        digest.update(str(message.get('role', '')).encode())
+        digest.update(b'\0')
+        digest.update(str(message.get('content', '')).encode())
+        digest.update(b'\0')
+        if message.get('tool_calls'):
+            digest.update(json.dumps(message['tool_calls'], sort_keys=True, default=str).encode())
+        digest.update(b'\0')
+        digest.update(str(len(message.get('images', [])) + len(message.get('image_refs', []))).encode())
+        return digest.hexdigest()
+
+    def count(self, message):
+        chars = len(str(message.get('content', '')))
+        if message.get('tool_calls'):
+            chars += len(json.dumps(message['tool_calls'], default=str))
+        images = len(message.get('images', [])) + len(message.get('image_refs', []))
+        return MESSAGE_OVERHEAD_TOKENS + -(-chars // CHARS_PER_TOKEN) + images * IMAGE_TOKENS
+
+    def estimate(self, message):
+        key = self._key(message)
+        with self._lock:
+            tokens = self._cache.get(key)
+            if tokens is not None:
+                self._cache.move_to_end(key)
+                self.stats['hits'] += 1
+                return tokens
+            self.stats['misses'] += 1
+        tokens = self.count(message)
+        with self._lock:
+            self._cache[key] = tokens
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return tokens
+
+    def estimate_text(self, text):
+        return -(-len(text) // CHARS_PER_TOKEN)
+
+
+token_estimator = TokenEstimator()
+_summary_cache = OrderedDict()
+_summary_lock = threading.Lock()
+
+
+def get_budget(num_ctx, reserve=None):
+    if reserve is None:
+        reserve = getattr(settings, 'OLLAMA_CONTEXT_RESERVE_TOKENS', None)
+    if reserve is None:
+        reserve = max(int(num_ctx * RESERVE_RATIO), MIN_RESERVE_TOKENS)
+    return max(num_ctx - reserve, 0)
+
+
+def _turn_starts(history):
+    # A turn starts at a user message; dropping whole turns never orphans a tool reply
+    return [i for i, m in enumerate(history) if m.get('role') == 'user']
+
+
+def _drop_to_fit(history, budget):
+    costs = [token_estimator.estimate(m) for m in history]
+    total = sum(costs)
+    start = 0
+    # Cut points stop at the newest user message, which is sent even if it alone exceeds the budget
+    for turn_start in [i for i in _turn_starts(history) if i > 0]:
+        if total <= budget:
+            break
+        total -= sum(costs[start:turn_start])
+        start = turn_start
+    return history[start:]
+
+
+def drop_oldest(history, budget, **kwargs):
+    return _drop_to_fit(history, budget)
+
+
+def system_recent(history, budget, **kwargs):
+    recent_turns = getattr(settings, 'OLLAMA_CONTEXT_RECENT_TURNS', RECENT_TURNS)
+    starts = _turn_starts(history)
+    if len(starts) > recent_turns:
+        history = history[starts[-recent_turns]:]
+    return _drop_to_fit(history, budget)
+
+
+def _messages_key(messages):
+    return hashlib.sha1(''.join(token_estimator._key(m) for m in messages).encode()).hexdigest()
+
+
+def _get_summary(messages):
+    with _summary_lock:
+        return _summary_cache.get(_messages_key(messages))
+
+
+def summarize(history, budget, summarizer=None, **kwargs):
+    kept = _drop_to_fit(history, budget)
+    dropped = history[:len(history) - len(kept)]
+    if not dropped or summarizer is None:
+        return kept
+
+    summary = _get_summary(dropped)
+    if summary is None:
+        # Each turn only summarizes what fell out since the last summary
+        previous, rest = None, dropped
+        for cut in reversed([i for i in _turn_starts(dropped) if i > 0]):
+            previous = _get_summary(dropped[:cut])
+            if previous is not None:
+                rest = dropped[cut:]
+                break
+        transcript = "\n".join(f"{m.get('role')}: {m.get('content', '')}" for m in rest)
+        if previous is not None:
+            transcript = f"Summary so far: {previous}\n{transcript}"
+        try:
+            summary = summarizer(transcript)
+        except Exception as e:
+            logger.warning(f"Failed to summarize older chat turns, dropping them instead: {e}")
+            return kept
+        with _summary_lock:
+            _summary_cache[_messages_key(dropped)] = summary
+            while len(_summary_cache) > CACHE_SIZE:
+                _summary_cache.popitem(last=False)
+
+    summary_msg = {'role': 'system', 'content': f"Summary of the earlier conversation:\n{summary}"}
+    # The summary itself has to fit; without room for it the older turns are simply dropped
+    kept = _drop_to_fit(kept, budget - token_estimator.estimate(summary_msg))
+    return [summary_msg] + kept
+
+
+STRATEGIES = {
+    'drop_oldest': drop_oldest,
+    'system_recent': system_recent,
+    'summarize': summarize,
+}
+
+
+def register_strategy(name, strategy):
+    STRATEGIES[name] = strategy
+
+
+def fit_messages(messages, num_ctx, strategy=None, tools=None, summarizer=None):
+    # System messages are always kept; only the conversation is fitted
+    system = [m for m in messages if m.get('role') == 'system']
+    history = [m for m in messages if m.get('role') != 'system']
+
+    budget = get_budget(num_ctx)
+    budget -= sum(token_estimator.estimate(m) for m in system)
+    if tools:
+        budget -= token_estimator.estimate_text(json.dumps(tools))
+
+    name = strategy or getattr(settings, 'OLLAMA_CONTEXT_STRATEGY', DEFAULT_STRATEGY)
+    fitted = STRATEGIES.get(name, drop_oldest)(history, budget, summarizer=summarizer)
+    if len(fitted) != len(history):
+        logger.debug(f"Fitted chat history into {num_ctx} ctx with {name}: {len(history)} -> {len(fitted)} messages")
+    return system + fitted
+
+
+def model_summarizer(client, model):
+    def summarizer(transcript):
+        response = client.chat(
+            model=model,
+            messages=[{'role': 'system', 'content': SUMMARY_PROMPT}, {'role': 'user', 'content': transcript}],
+            stream=False
+        )
+        return response['message']['content']
+    return summarizer
@@ -0,0 +1,163 @@
+import base64
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# Blobs not referenced by any chat turn for this long are removed; never less than the chat session TTL
+BLOB_MAX_AGE = 24 * 3600
+# Minimum seconds between garbage collection runs across all workers
+GC_INTERVAL = 3600
+GC_LOCK_KEY = 'ollama_image_store_gc_lock'
+
+
+def get_store_dir():
+    default_root = getattr(settings, 'MEDIA_ROOT', '') or tempfile.gettempdir()
+    return getattr(settings, 'OLLAMA_IMAGE_STORE_DIR', os.path.join(default_root, 'ollama_images'))
+
+
+def _blob_path(ref):
+    # Refs are sha256 hex digests; anything else never reaches the filesystem
+    if len(ref) != 64 or any(c not in '0123456789abcdef' for c in ref):
+        raise ValueError(f"Invalid image reference: {ref}")
+    return os.path.join(get_store_dir(), ref[:2], ref)
+
+
+def downscale(data):
+    # Optional: only applies when a pixel budget is configured and Pillow is installed
+    max_pixels = getattr(settings, 'OLLAMA_IMAGE_MAX_PIXELS', None)
+    if not max_pixels:
+        return data
+    try:
+        from PIL import Image
+    except ImportError:
+        return data
+    import io
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+            if width * height <= max_pixels:
+                return data
+            scale = (max_pixels / float(width * height)) ** 0.5
+            image = image.convert('RGB')
+            image.thumbnail((max(1, int(width * scale)), max(1, int(height * scale))))
+            output = io.BytesIO()
+            image.save(output, format='JPEG', quality=90)
+            return output.getvalue()
+    except Exception as e:
+        logger.warning(f"Failed to downscale image attachment: {e}")
+        return data
+
+
+def put(data):
+    # Identical uploads hash to the same ref, so each image is written and downscaled once
+    ref = hashlib.sha256(data).hexdigest()
+    path = _blob_path(ref)
+    if os.path.exists(path):
+        touch([ref])
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(downscale(data))
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    collect_garbage_in_background()
+    return ref
+
+
+def put_base64(value):
+    return put(base64.b64decode(value))
+
+
+def get_base64(ref):
+    with open(_blob_path(ref), 'rb') as f:
+        return base64.b64encode(f.read()).decode('utf-8')
+
+
+def message_refs(messages):
+    return {ref for m in messages for ref in m.get('image_refs', [])}
+
+
+def touch(refs):
+    # A blob's mtime records when a chat last referenced it
+    now = time.time()
+    for ref in refs:
+        try:
+            os.utime(_blob_path(ref), (now, now))
+        except (OSError, ValueError):
+            pass
+
+
+def resolve_images(messages):
+    # Image payloads are only loaded when the request for Ollama is built
+    resolved = []
+    for m in messages:
+        if not m.get('image_refs'):
+            resolved.append(m)
+            continue
+        msg = {k: v for k, v in m.items() if k != 'image_refs'}
+        images = list(msg.get('images', []))
+        for ref in m['image_refs']:
+            try:
+                images.append(get_base64(ref))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Image attachment {ref} is no longer available: {e}")
+        if images:
+            msg['images'] = images
+        resolved.append(msg)
+    return resolved
+
+
+def get_max_age(max_age=None):
+    # Sessions touch their blobs on every write and expire a TTL later, so a blob
+    # younger than the session TTL may still be referenced by a live session
+    from .chat_sessions import SESSION_TTL
+    if max_age is None:
+        max_age = getattr(settings, 'OLLAMA_IMAGE_MAX_AGE', BLOB_MAX_AGE)
+    return max(max_age, getattr(settings, 'OLLAMA_CHAT_SESSION_TTL', SESSION_TTL))
+
+
+def collect_garbage(max_age=None):
+    cutoff = time.time() - get_max_age(max_age)
+    removed = 0
+    store_dir = get_store_dir()
+    if not os.path.isdir(store_dir):
+        return 0
+    for root, dirs, files in os.walk(store_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+    if removed:
+        logger.info(f"Removed {removed} unreferenced Ollama image attachments")
+    return removed
+
+
+def collect_garbage_in_background():
+    # The lock doubles as the interval, so one worker collects at most once per GC_INTERVAL
+    if not cache.add(GC_LOCK_KEY, True, getattr(settings, 'OLLAMA_IMAGE_GC_INTERVAL', GC_INTERVAL)):
+        return False
+
+    def run_gc():
+        try:
+            collect_garbage()
+        except Exception as e:
+            logger.warning(f"Ollama image garbage collection failed: {e}")
+
+    threading.Thread(target=run_gc, daemon=True).start()
+    return True
@@ -0,0 +1,209 @@
+import threading
+import time
+from django.conf import settings
+
+# A load longer than this means the model was not resident and had to be read from disk
+COLD_LOAD_THRESHOLD = 0.5
+
+
+def _seconds(nanoseconds):
+    return (nanoseconds or 0) / 1e9
+
+
+def _rate(count, seconds):
+    return round(count / seconds, 2) if seconds else None
+
+
+class RequestTimer:
+    """Timing of one chat request across all of its model turns.
+
+    Ollama reports durations in nanoseconds on the final chunk of every turn;
+    time to first token is measured here, from when the request got its slot.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.started = time.monotonic()
+        self.ttft = None
+        self.turns = 0
+        self.totals = {'total': 0.0, 'load': 0.0, 'prompt_eval': 0.0, 'eval': 0.0, 'prompt_eval_count': 0, 'eval_count': 0}
+
+    def first_token(self):
+        if self.ttft is None:
+            self.ttft = time.monotonic() - self.started
+
+    def observe(self, chunk, text):
+        # Called with every chunk and the text it added to the reply
+        if text:
+            self.first_token()
+        if chunk.get('done'):
+            self.add_done(chunk)
+
+    def add_done(self, chunk):
+        # Replayed responses carry no durations and only count towards TTFT
+        if not chunk.get('eval_duration'):
+            return
+        self.turns += 1
+        self.totals['total'] += _seconds(chunk.get('total_duration'))
+        self.totals['load'] += _seconds(chunk.get('load_duration'))
+        self.totals['prompt_eval'] += _seconds(chunk.get('prompt_eval_duration'))
+        self.totals['eval'] += _seconds(chunk.get('eval_duration'))
+        self.totals['prompt_eval_count'] += chunk.get('prompt_eval_count', 0) or 0
+        self.totals['eval_count'] += chunk.get('eval_count', 0) or 0
+
+    def timing(self):
+        # Shape of the timing field in done frames
+        return {
+            'ttft_ms': int(self.ttft * 1000) if self.ttft is not None else None,
+            'load_ms': int(self.totals['load'] * 1000),
+            'total_ms': int(self.totals['total'] * 1000),
+            'prompt_tokens_per_sec': _rate(self.totals['prompt_eval_count'], self.totals['prompt_eval']),
+            'eval_tokens_per_sec': _rate(self.totals['eval_count'], self.totals['eval']),
+        }
+
+
+class ChatMetrics:
+    """Process-wide chat counters, labelled by model, for the Prometheus endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.models = {}
+        self.streams = {}
+
+    def record(self, timer, stopped=False):
+        cold_threshold = getattr(settings, 'OLLAMA_COLD_LOAD_THRESHOLD', COLD_LOAD_THRESHOLD)
+        with self._lock:
+            m = self.models.setdefault(timer.model, {
+                'requests': 0, 'stopped': 0, 'ttft_sum': 0.0, 'ttft_count': 0,
+                'load_sum': 0.0, 'cold_loads': 0, 'total_sum': 0.0, 'turns': 0,
+                'prompt_tokens': 0, 'prompt_eval_seconds': 0.0, 'eval_tokens': 0, 'eval_seconds': 0.0,
+                'prompt_tokens_per_sec': None, 'eval_tokens_per_sec': None
+            })
+            m['requests'] += 1
+            if stopped:
+                m['stopped'] += 1
+            if timer.ttft is not None:
+                m['ttft_sum'] += timer.ttft
+                m['ttft_count'] += 1
+            if not timer.turns:
+                return
+            m['turns'] += timer.turns
+            m['load_sum'] += timer.totals['load']
+            if timer.totals['load'] >= cold_threshold:
+                m['cold_loads'] += 1
+            m['total_sum'] += timer.totals['total']
+            m['prompt_tokens'] += timer.totals['prompt_eval_count']
+            m['prompt_eval_seconds'] += timer.totals['prompt_eval']
+            m['eval_tokens'] += timer.totals['eval_count']
+            m['eval_seconds'] += timer.totals['eval']
+            timing = timer.timing()
+            m['prompt_tokens_per_sec'] = timing['prompt_tokens_per_sec']
+            m['eval_tokens_per_sec'] = timing['eval_tokens_per_sec']
+
+    def record_stream(self, transport, stats):
+        with self._lock:
+            totals = self.streams.setdefault(transport, {})
+            for key, value in stats.items():
+                totals[key] = totals.get(key, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return {model: dict(m) for model, m in self.models.items()}, {t: dict(s) for t, s in self.streams.items()}
+
+    def clear(self):
+        with self._lock:
+            self.models = {}
+            self.streams = {}
+
+
+chat_metrics = ChatMetrics()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Exposition:
+    def __init__(self):
+        self.lines = []
+
+    def add(self, name, kind, help_text, samples):
+        # samples: (labels dict or None, value); metrics without samples are left out
+        samples = [(labels, value) for labels, value in samples if value is not None]
+        if not samples:
+            return
+        self.lines.append(f'# HELP {name} {help_text}')
+        self.lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in (labels or {}).items())
+            self.lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def render_prometheus():
+    # Values are per worker process; Prometheus aggregates across workers by instance
+    from .admission import admission
+    from .clients import client_registry
+    from .context_window import token_estimator
+    from .response_cache import response_cache
+    from .tool_registry import tool_registry
+    from .tool_runner import tool_runner
+
+    out = _Exposition()
+    models, streams = chat_metrics.snapshot()
+
+    def per_model(key):
+        return [({'model': model}, m[key]) for model, m in sorted(models.items())]
+
+    out.add('ollama_chat_requests_total', 'counter', 'Chat requests served.', per_model('requests'))
+    out.add('ollama_chat_stopped_total', 'counter', 'Chat requests stopped by the client.', per_model('stopped'))
+    out.add('ollama_chat_ttft_seconds_total', 'counter', 'Sum of times to first token.', per_model('ttft_sum'))
+    out.add('ollama_chat_ttft_measured_total', 'counter', 'Requests with a measured time to first token.', per_model('ttft_count'))
+    out.add('ollama_chat_turns_total', 'counter', 'Model turns with timing reported by Ollama.', per_model('turns'))
+    out.add('ollama_chat_duration_seconds_total', 'counter', 'Sum of Ollama total_duration.', per_model('total_sum'))
+    out.add('ollama_model_load_seconds_total', 'counter', 'Sum of Ollama load_duration.', per_model('load_sum'))
+    out.add('ollama_model_cold_loads_total', 'counter', 'Requests whose model load exceeded the cold load threshold.', per_model('cold_loads'))
+    out.add('ollama_chat_prompt_tokens_total', 'counter', 'Prompt tokens evaluated.', per_model('prompt_tokens'))
+    out.add('ollama_chat_prompt_eval_seconds_total', 'counter', 'Time spent evaluating prompts.', per_model('prompt_eval_seconds'))
+    out.add('ollama_chat_generated_tokens_total', 'counter', 'Tokens generated.', per_model('eval_tokens'))
+    out.add('ollama_chat_eval_seconds_total', 'counter', 'Time spent generating tokens.', per_model('eval_seconds'))
+    out.add('ollama_chat_prompt_tokens_per_second', 'gauge', 'Prompt throughput of the latest request.', per_model('prompt_tokens_per_sec'))
+    out.add('ollama_chat_generation_tokens_per_second', 'gauge', 'Generation throughput of the latest request.', per_model('eval_tokens_per_sec'))
+
+    queue = admission.metrics()
+    out.add('ollama_admission_queue_depth', 'gauge', 'Chat requests waiting for a slot.', [(None, queue['depth'])])
+    out.add('ollama_admission_queue_depth_by_model', 'gauge', 'Chat requests waiting for a slot, by model.',
+            [({'model': model}, depth) for model, depth in sorted(queue['depth_per_model'].items())])
+    out.add('ollama_admission_active', 'gauge', 'Chat requests holding a slot.', [(None, queue['active'])])
+    out.add('ollama_admission_active_by_model', 'gauge', 'Chat requests holding a slot, by model.',
+            [({'model': model}, active) for model, active in sorted(queue['active_per_model'].items())])
+    out.add('ollama_admission_oldest_wait_seconds', 'gauge', 'Wait of the oldest queued request.', [(None, round(queue['oldest_wait_seconds'], 3))])
+    for key, help_text in [('admitted', 'Chat requests given a slot.'), ('queued', 'Chat requests that had to wait for a slot.'),
+                           ('rejected', 'Chat requests turned away by a full queue.'), ('timeouts', 'Chat requests that gave up waiting for a slot.')]:
+        out.add(f'ollama_admission_{key}_total', 'counter', help_text, [(None, queue[key])])
+    out.add('ollama_admission_wait_seconds_total', 'counter', 'Total time admitted requests waited.', [(None, round(queue['wait_seconds_total'], 3))])
+    out.add('ollama_admission_wait_seconds_max', 'gauge', 'Longest wait of an admitted request.', [(None, round(queue['wait_seconds_max'], 3))])
+
+    out.add('ollama_client_pool_lookups_total', 'counter', 'Pooled Ollama client lookups.',
+            [({'result': key}, client_registry.stats[key]) for key in ['hits', 'misses']])
+    out.add('ollama_client_evictions_total', 'counter', 'Per-token clients dropped from the client cache.', [(None, client_registry.stats['evictions'])])
+    out.add('ollama_client_pool_size', 'gauge', 'Ollama connection pools.', [(None, client_registry.pool_size())])
+    out.add('ollama_token_estimator_lookups_total', 'counter', 'Token estimate cache lookups.',
+            [({'result': key}, value) for key, value in sorted(token_estimator.stats.items())])
+    out.add('ollama_response_cache_events_total', 'counter', 'Response cache events.',
+            [({'event': key}, value) for key, value in sorted(response_cache.stats.items())])
+    out.add('ollama_tool_registry_lookups_total', 'counter', 'Tool registry lookups.',
+            [({'result': key}, value) for key, value in sorted(tool_registry.stats.items())])
+    out.add('ollama_tool_calls_total', 'counter', 'Tool call outcomes.',
+            [({'result': key}, tool_runner.stats[key]) for key in ['calls', 'errors', 'timeouts', 'cancelled']])
+    out.add('ollama_tool_compile_cache_total', 'counter', 'Compiled tool cache lookups in the workers.',
+            [({'result': 'hits'}, tool_runner.stats['compile_hits']), ({'result': 'misses'}, tool_runner.stats['compile_misses'])])
+    out.add('ollama_tool_duration_seconds_total', 'counter', 'Sum of tool call durations.', [(None, tool_runner.stats['duration_ms_total'] / 1000)])
+    out.add('ollama_tool_pool_restarts_total', 'counter', 'Tool worker pool restarts.', [(None, tool_runner.stats['restarts'])])
+
+    for key in ['chunks', 'frames', 'bytes']:
+        out.add(f'ollama_stream_{key}_total', 'counter', f'Streamed {key}, by transport.',
+                [({'transport': transport}, s[key]) for transport, s in sorted(streams.items()) if key in s])
+    return out.render()
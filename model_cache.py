@@ -0,0 +1,139 @@
+import hashlib
+import logging
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from . import model_events
+from .capabilities import get_model_field
+
+logger = logging.getLogger(__name__)
+
+# How long a model list is served without triggering a background refresh
+FRESH_SECONDS = 10
+# How long a stale list may be served before a render has to wait for the daemon
+MAX_STALE_SECONDS = 300
+# Upper bound on how long a crashed refresh can hold the lock
+REFRESH_LOCK_TIMEOUT = 30
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def _data_key(tool_id):
+    return f'ollama_raw_data_{tool_id}'
+
+
+def _fingerprint_key(tool_id):
+    return f'ollama_models_fingerprint_{tool_id}'
+
+
+def _lock_key(tool_id):
+    return f'ollama_models_refresh_lock_{tool_id}'
+
+
+def list_models(client):
+    models_response = client.list()
+    # Handle both dict and object responses
+    if hasattr(models_response, 'models'):
+        return models_response.models
+    elif isinstance(models_response, dict):
+        return models_response.get('models', [])
+    return []
+
+
+def compute_fingerprint(models):
+    digest = hashlib.sha1()
+    rows = sorted(
+        (str(get_model_field(m, 'model', '')), str(get_model_field(m, 'digest', '')), str(get_model_field(m, 'modified_at', '')))
+        for m in models
+    )
+    for row in rows:
+        digest.update('\0'.join(row).encode())
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def get_fingerprint(tool_id):
+    # Cheap to compare: callers do not need to unpickle the model list
+    return cache.get(_fingerprint_key(tool_id))
+
+
+def refresh(tool_id, fetch_models):
+    # Single-flight across workers: only the caller that wins the lock talks to the daemon
+    if not cache.add(_lock_key(tool_id), True, REFRESH_LOCK_TIMEOUT):
+        return None
+    try:
+        models = fetch_models()
+        raw_data = {
+            'models': models,
+            'timestamp': time.time(),
+            'fingerprint': compute_fingerprint(models)
+        }
+        previous = cache.get(_data_key(tool_id))
+        max_stale = getattr(settings, 'OLLAMA_MODEL_LIST_MAX_STALE', MAX_STALE_SECONDS)
+        cache.set(_data_key(tool_id), raw_data, max_stale)
+        cache.set(_fingerprint_key(tool_id), raw_data['fingerprint'], max_stale)
+
+        # Push only the rows that changed to open Models tabs
+        if previous is None:
+            # Nothing to diff against; tabs compare the fingerprint with what they rendered
+            model_events.publish({'type': 'models_fingerprint', 'fingerprint': raw_data['fingerprint']})
+        elif previous.get('fingerprint') != raw_data['fingerprint']:
+            model_events.publish_model_list(previous['models'], models, raw_data['fingerprint'])
+        return raw_data
+    finally:
+        cache.delete(_lock_key(tool_id))
+
+
+def refresh_in_background(tool_id, fetch_models):
+    with _refreshing_lock:
+        if tool_id in _refreshing:
+            return False
+        _refreshing.add(tool_id)
+
+    def run_refresh():
+        try:
+            refresh(tool_id, fetch_models)
+        except Exception as e:
+            logger.warning(f"Background refresh of Ollama model list failed: {e}")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(tool_id)
+
+    threading.Thread(target=run_refresh, daemon=True).start()
+    return True
+
+
+def get_models(tool_id, fetch_models, force_refresh=False):
+    raw_data = cache.get(_data_key(tool_id))
+
+    if raw_data is None or force_refresh:
+        refreshed = refresh(tool_id, fetch_models)
+        if refreshed is not None:
+            return refreshed['models']
+        if raw_data is None:
+            # Another viewer is refreshing a cold cache; answer this render directly
+            return fetch_models()
+        return raw_data['models']
+
+    fresh_seconds = getattr(settings, 'OLLAMA_MODEL_LIST_FRESH_SECONDS', FRESH_SECONDS)
+    if time.time() - raw_data['timestamp'] > fresh_seconds:
+        refresh_in_background(tool_id, fetch_models)
+    return raw_data['models']
+
+
+def find_cached_model(tool_id, model_name):
+    # Looks a model up in the cached list only; never talks to the daemon
+    raw_data = cache.get(_data_key(tool_id))
+    if raw_data is None:
+        return None
+    names = {model_name, model_name if ':' in model_name else f'{model_name}:latest'}
+    for m in raw_data['models']:
+        if get_model_field(m, 'model') in names:
+            return m
+    return None
+
+
+def invalidate(tool_id):
+    cache.delete_many([_data_key(tool_id), _fingerprint_key(tool_id)])
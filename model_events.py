@@ -0,0 +1,74 @@
+import logging
+from asgiref.sync import async_to_sync
+from .capabilities import get_model_field
+
+logger = logging.getLogger(__name__)
+
+# Channel layer group joined by every open Models tab
+GROUP_NAME = 'ollama_models'
+
+
+def model_rows(models):
+    rows = {}
+    for m in models:
+        name = get_model_field(m, 'model', '')
+        modified_at = get_model_field(m, 'modified_at')
+        rows[name] = {
+            'model': name,
+            'size': get_model_field(m, 'size', 0),
+            'digest': get_model_field(m, 'digest'),
+            'modified_at': str(modified_at) if modified_at else None
+        }
+    return rows
+
+
+def diff_rows(old_rows, new_rows):
+    added = [new_rows[k] for k in new_rows if k not in old_rows]
+    removed = [k for k in old_rows if k not in new_rows]
+    changed = [new_rows[k] for k in new_rows if k in old_rows and new_rows[k] != old_rows[k]]
+    return {'added': added, 'removed': removed, 'changed': changed}
+
+
+def live_updates_enabled():
+    # Without a channel layer the Models tab polls instead of opening a socket
+    from channels.layers import get_channel_layer
+    return get_channel_layer() is not None
+
+
+def publish(event):
+    from channels.layers import get_channel_layer
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        # No channel layer configured: the Models tab polls instead
+        return False
+    try:
+        async_to_sync(channel_layer.group_send)(GROUP_NAME, {'type': 'models.event', 'event': event})
+        return True
+    except Exception as e:
+        logger.warning(f"Failed to publish Ollama models event: {e}")
+        return False
+
+
+def publish_model_list(old_models, new_models, fingerprint):
+    diff = diff_rows(model_rows(old_models or []), model_rows(new_models))
+    if not (diff['added'] or diff['removed'] or diff['changed']):
+        return False
+    diff.update({'type': 'models_diff', 'fingerprint': fingerprint})
+    return publish(diff)
+
+
+def publish_pull_progress(model_name, progress=None, status=None, done=False, error=None, **stats):
+    event = {'type': 'pull_progress', 'model': model_name, 'done': done}
+    event.update(stats)
+    if progress is not None:
+        event['progress'] = progress
+    if status is not None:
+        event['status'] = status
+    if error is not None:
+        event['error'] = error
+    return publish(event)
+
+
+def publish_capabilities(model_name):
+    # Rows rendered while capabilities were pending are re-rendered by open tabs
+    return publish({'type': 'models_capabilities', 'model': model_name})
@@ -1,6 +1,5 @@
 import threading
 import subprocess
-import requests
 import logging
 import os
 import time
@@ -8,9 +7,38 @@ from django.shortcuts import render
 from django.urls import path
 from core.plugin_system import BaseModule
 from core.utils import run_command
+from . import model_cache, model_events, service_status, warm_pool
+from .clients import get_client
+from .pulls import get_pulls
+from .capabilities import capability_refresher, capability_store, get_model_field, get_model_key, is_stale, DEFAULT_CAPABILITIES
 
 logger = logging.getLogger(__name__)
 
+# Version lookups fork git/ollama, so they are computed once per process
+# and only recomputed after an install or update completes
+_version_cache = {}
+_version_cache_lock = threading.Lock()
+subprocess_timings = {}
+
+# Polling is paused while the user is typing a model name or editing a form
+MODELS_POLL_TRIGGER = "every 5s [document.getElementById('ollama-pull-input') && document.getElementById('ollama-pull-input').value === '' && document.activeElement.tagName !== 'INPUT' && document.activeElement.tagName !== 'SELECT' && document.activeElement.tagName !== 'TEXTAREA']"
+
+def _cached_version(key, compute):
+    with _version_cache_lock:
+        if key in _version_cache:
+            return _version_cache[key]
+        started = time.monotonic()
+        value = compute()
+        duration = time.monotonic() - started
+        _version_cache[key] = value
+        subprocess_timings[key] = duration
+    logger.debug(f"Ollama module: {key} lookup took {duration * 1000:.1f} ms")
+    return value
+
+def clear_version_cache():
+    with _version_cache_lock:
+        _version_cache.clear()
+
 class Module(BaseModule):
     @property
     def module_id(self):
@@ -24,12 +52,18 @@ class Module(BaseModule):
     
     @property
     def version(self):
+        return _cached_version('module_version', self._read_module_version)
+
+    def _read_module_version(self):
         try:
             return subprocess.check_output(['git', '-C', os.path.dirname(__file__), 'describe', '--tags', '--abbrev=0']).decode().strip()
         except:
             return "1.1.0"
 
     def get_service_version(self):
+        return _cached_version('service_version', self._read_service_version)
+
+    def _read_service_version(self):
         try:
             process = subprocess.run(["ollama", "--version"], capture_output=True, text=True)
             if process.returncode == 0:
@@ -39,7 +73,10 @@ class Module(BaseModule):
             pass
         return None
 
-    def get_service_status(self, tool):
+    def _probe_service_status(self):
+        # A cheap HTTP health check avoids forking systemctl while the daemon is up
+        if service_status.check_http_health():
+            return 'running'
         try:
             status_process = run_command(["systemctl", "is-active", "ollama"], log_errors=False)
             status = status_process.decode().strip()
@@ -51,14 +88,20 @@ class Module(BaseModule):
         except Exception:
             return 'stopped'
 
+    def get_service_status(self, tool):
+        return service_status.get_status(self._probe_service_status)
+
     def service_start(self, tool):
         run_command(["systemctl", "start", "ollama"])
+        service_status.invalidate()
 
     def service_stop(self, tool):
         run_command(["systemctl", "stop", "ollama"])
+        service_status.invalidate()
 
     def service_restart(self, tool):
         run_command(["systemctl", "restart", "ollama"])
+        service_status.invalidate()
 
     def update(self, request, tool):
         if tool.status != 'installed':
@@ -79,123 +122,54 @@ class Module(BaseModule):
                 tool.status = 'error'
                 tool.config_data['error_log'] = str(e)
             tool.save()
+            clear_version_cache()
+            service_status.invalidate()
 
         threading.Thread(target=run_update).start()
 
     def get_context_data(self, request, tool, force_refresh=False):
         context = {}
         context['config_data'] = tool.config_data
+        context['live_updates'] = model_events.live_updates_enabled()
         
-        # Check service status
-        try:
-            status_process = run_command(["systemctl", "is-active", "ollama"])
-            context['service_active'] = (status_process.decode().strip() == "active")
+        # Check service status through the shared, cached probe
+        context['service_status'] = self.get_service_status(tool)
+        context['service_active'] = (context['service_status'] == 'running')
             
-            # If service is active but tool status is not 'installed', we might want to sync it
-            if context['service_active'] and tool.status == 'not_installed':
-                tool.status = 'installed'
-                tool.save()
-        except Exception:
-            context['service_active'] = False
+        # If service is active but tool status is not 'installed', we might want to sync it
+        if context['service_active'] and tool.status == 'not_installed':
+            tool.status = 'installed'
+            tool.save()
 
         if tool.status == 'installed':
             try:
-                import ollama
-                from django.core.cache import cache
-                client = ollama.Client(host='http://localhost:11434')
-                
-                # Fetch raw data with caching
-                cache_key_raw = f'ollama_raw_data_{tool.id}'
-                raw_data = cache.get(cache_key_raw)
-                
-                if not raw_data or force_refresh:
-                    models_response = client.list()
-                    # Handle both dict and object responses
-                    if hasattr(models_response, 'models'):
-                        models = models_response.models
-                    elif isinstance(models_response, dict):
-                        models = models_response.get('models', [])
-                    else:
-                        models = []
-                    
-                    raw_data = {
-                        'models': models,
-                        'timestamp': time.time()
-                    }
-                    # Cache for 5 minutes
-                    cache.set(cache_key_raw, raw_data, 300)
+                client = get_client()
                 
-                models = raw_data['models']
-
-                # Fetch and enrich model capabilities
-                enriched_models = []
-                capabilities_cache = tool.config_data.get('capabilities_cache', {})
-                cache_updated = False
-
-                # Auto-cleanup stale pull progress if model is already in list or progress is 100%
-                pulling_model = tool.config_data.get('pulling_model')
-                if pulling_model:
-                    is_pulled = any((m.model if hasattr(m, 'model') else m.get('model')) == pulling_model for m in models)
-                    if is_pulled or tool.config_data.get('pull_progress') == 100:
-                        tool.config_data.pop('pulling_model', None)
-                        tool.config_data.pop('pull_progress', None)
-                        tool.config_data.pop('pull_status', None)
-                        tool.save()
-
-                for model in models:
-                    # Get the base model name (e.g., 'llama3.1:latest' -> 'llama3.1')
-                    model_full_name = model.model if hasattr(model, 'model') else model.get('model', '')
-                    model_base_name = model_full_name.split(':')[0] if ':' in model_full_name else model_full_name
-                    
-                    # Check cache (valid for 24 hours)
-                    cache_entry = capabilities_cache.get(model_base_name)
-                    current_time = time.time()
-                    
-                    if not cache_entry or (current_time - cache_entry.get('timestamp', 0) > 86400):
-                        # Fetch from Ollama library
-                        try:
-                            response = requests.get(f"https://ollama.com/library/{model_base_name}", timeout=5)
-                            if response.status_code == 200:
-                                html = response.text
-                                caps = {
-                                    'tools': 'tools' in html.lower(),
-                                    'thinking': 'thinking' in html.lower(),
-                                    'vision': 'vision' in html.lower(),
-                                    'embedding': 'embedding' in html.lower(),
-                                    'timestamp': current_time
-                                }
-                                capabilities_cache[model_base_name] = caps
-                                cache_updated = True
-                            else:
-                                caps = cache_entry or {'tools': False, 'thinking': False, 'vision': False, 'embedding': False}
-                        except Exception:
-                            caps = cache_entry or {'tools': False, 'thinking': False, 'vision': False, 'embedding': False}
-                    else:
-                        caps = cache_entry
-
-                    # Create a dictionary representation of the model to avoid Pydantic/object immutability issues
-                    if hasattr(model, 'model_dump'): # Pydantic v2
-                        model_dict = model.model_dump()
-                    elif hasattr(model, 'dict'): # Pydantic v1
-                        model_dict = model.dict()
-                    elif hasattr(model, '__dict__'):
-                        model_dict = model.__dict__.copy()
-                    else:
-                        model_dict = dict(model)
-                    
-                    model_dict['capabilities'] = caps.copy() # Use copy to avoid shared dict issues
-                    
-                    # Determine cloud status based on tag ONLY
-                    model_tag = model_full_name.split(':')[-1] if ':' in model_full_name else 'latest'
-                    model_dict['capabilities']['cloud'] = 'cloud' in model_tag.lower()
-                    
-                    enriched_models.append(model_dict)
-
-                if cache_updated:
-                    tool.config_data['capabilities_cache'] = capabilities_cache
+                # Serve the cached model list immediately; stale lists are refreshed in the background
+                models = model_cache.get_models(tool.id, lambda: model_cache.list_models(client), force_refresh=force_refresh)
+                context['models_fingerprint'] = model_cache.get_fingerprint(tool.id)
+
+                # Pinned models are kept resident by a per-process reconcile loop
+                pins = warm_pool.get_pins()
+                if pins:
+                    warm_pool.warm_pool.ensure_scheduler()
+                warm_status = warm_pool.get_status()
+                running = warm_pool.get_running()
+                context['keep_alive_choices'] = warm_pool.KEEP_ALIVE_CHOICES
+
+                # Live pull progress comes from the shared cache, not from config_data
+                context['pulls'] = get_pulls()
+
+                # Drop single-pull keys written by older versions of this module
+                legacy_keys = [k for k in ('pulling_model', 'pull_progress', 'pull_status') if k in tool.config_data]
+                if legacy_keys:
+                    for key in legacy_keys:
+                        tool.config_data.pop(key, None)
                     tool.save()
 
-                # Search and Pagination
+                # Search and paginate over lightweight records, then enrich only the visible page
+                records = [self._build_model_record(model) for model in models]
+
                 from core.utils import paginate_list
                 if request:
                     search_query = request.GET.get('search', '')
@@ -207,13 +181,34 @@ class Module(BaseModule):
                     per_page = 10
                 
                 pagination = paginate_list(
-                    enriched_models, 
+                    records, 
                     page, 
                     per_page, 
                     search_query=search_query, 
                     search_fields=['model']
                 )
-                
+
+                # Capabilities live in their own store; the legacy copy in config_data is dropped once
+                if tool.config_data.pop('capabilities_cache', None) is not None:
+                    tool.save()
+                capability_store.prune([get_model_key(r) for r in records], context['models_fingerprint'])
+                capabilities_cache = capability_store.get_many([get_model_key(r) for r in pagination['items']])
+                stale_models = {}
+                enriched_models = []
+                for record in pagination['items']:
+                    model_dict = self._enrich_model_record(record, capabilities_cache)
+                    model_dict['pinned'] = pins.get(record['model'])
+                    model_dict['warm'] = warm_status.get(record['model'])
+                    model_dict['running'] = record['model'] in running
+                    if model_dict['capabilities']['pending']:
+                        stale_models[get_model_key(record)] = record['model']
+                    enriched_models.append(model_dict)
+
+                # Stale capabilities are resolved in the background; the page renders from cache
+                if stale_models:
+                    capability_refresher.schedule(sorted(stale_models.items()))
+
+                pagination['items'] = enriched_models
                 context['models'] = pagination['items']
                 context['pagination'] = pagination
                 context['search_query'] = search_query
@@ -221,6 +216,41 @@ class Module(BaseModule):
                 context['ollama_error'] = f"Could not connect to Ollama API: {str(e)}"
         return context
 
+    def _build_model_record(self, model):
+        return {
+            'model': get_model_field(model, 'model', ''),
+            'size': get_model_field(model, 'size', 0),
+            'digest': get_model_field(model, 'digest'),
+            'modified_at': get_model_field(model, 'modified_at'),
+            'raw': model
+        }
+
+    def _enrich_model_record(self, record, capabilities_cache):
+        model = record['raw']
+        model_full_name = record['model']
+
+        # Capabilities are indexed by digest, so each model is resolved once per version
+        cache_entry = capabilities_cache.get(get_model_key(record))
+        caps = cache_entry or DEFAULT_CAPABILITIES
+
+        # Create a dictionary representation of the model to avoid Pydantic/object immutability issues
+        if hasattr(model, 'model_dump'): # Pydantic v2
+            model_dict = model.model_dump()
+        elif hasattr(model, 'dict'): # Pydantic v1
+            model_dict = model.dict()
+        elif hasattr(model, '__dict__'):
+            model_dict = model.__dict__.copy()
+        else:
+            model_dict = dict(model)
+
+        model_dict['capabilities'] = caps.copy() # Use copy to avoid shared dict issues
+        model_dict['capabilities']['pending'] = is_stale(cache_entry)
+
+        # Determine cloud status based on tag ONLY
+        model_tag = model_full_name.split(':')[-1] if ':' in model_full_name else 'latest'
+        model_dict['capabilities']['cloud'] = 'cloud' in model_tag.lower()
+        return model_dict
+
     def handle_hx_request(self, request, tool, target):
         context = self.get_context_data(request, tool)
         context['tool'] = tool
@@ -252,18 +282,18 @@ class Module(BaseModule):
                 tool.status = 'error'
                 tool.config_data['error_log'] = str(e)
             tool.save()
+            clear_version_cache()
+            service_status.invalidate()
 
         threading.Thread(target=run_install).start()
 
     def get_resource_tabs(self):
+        # Live updates arrive over ws/ollama/models/; without a channel layer the tab polls as before
+        models_tab = {'id': 'models', 'label': 'Models', 'template': 'core/partials/ollama_models.html', 'hx_get': '/tool/ollama/?tab=models'}
+        if not model_events.live_updates_enabled():
+            models_tab['hx_auto_refresh'] = MODELS_POLL_TRIGGER
         return [
-            {
-                'id': 'models', 
-                'label': 'Models', 
-                'template': 'core/partials/ollama_models.html', 
-                'hx_get': '/tool/ollama/?tab=models', 
-                'hx_auto_refresh': 'every 5s [document.getElementById(\'ollama-pull-input\') && document.getElementById(\'ollama-pull-input\').value === \'\' && document.activeElement.tagName !== \'INPUT\' && document.activeElement.tagName !== \'SELECT\' && document.activeElement.tagName !== \'TEXTAREA\']'
-            },
+            models_tab,
             {'id': 'chat', 'label': 'Demo Chat', 'template': 'core/partials/ollama_chat.html', 'hx_get': '/tool/ollama/?tab=chat'},
             {'id': 'tools', 'label': 'Tools', 'template': 'core/partials/ollama_tools.html', 'hx_get': '/tool/ollama/?tab=tools'},
         ]
@@ -272,10 +302,16 @@ class Module(BaseModule):
         from . import views
         return [
             path('ollama/model/pull/', views.pull_model, name='ollama_pull_model'),
+            path('ollama/model/pull/cancel/', views.cancel_pull, name='ollama_cancel_pull'),
             path('ollama/model/delete/', views.delete_model, name='ollama_delete_model'),
+            path('ollama/model/pin/', views.pin_model, name='ollama_pin_model'),
+            path('ollama/model/preload/', views.preload_model, name='ollama_preload_model'),
             path('ollama/chat/send/', views.chat_send, name='ollama_chat_send'),
+            path('ollama/chat/send/async/', views.chat_send_async, name='ollama_chat_send_async'),
+            path('ollama/chat/cancel/', views.chat_cancel, name='ollama_chat_cancel'),
             path('ollama/tools/save/', views.save_tool, name='ollama_save_tool'),
             path('ollama/tools/delete/', views.delete_tool, name='ollama_delete_tool'),
+            path('ollama/metrics/', views.metrics, name='ollama_metrics'),
         ]
 
     def get_websocket_urls(self):
@@ -283,6 +319,7 @@ class Module(BaseModule):
         from . import consumers
         return [
             re_path(r'ws/ollama/chat/$', consumers.OllamaChatConsumer.as_asgi()),
+            re_path(r'ws/ollama/models/$', consumers.OllamaModelsConsumer.as_asgi()),
         ]
 
     def get_icon_class(self):
@@ -0,0 +1,325 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
+from . import model_events
+from .clients import get_client
+
+logger = logging.getLogger(__name__)
+
+# Pull progress lives in the cache backend so every worker sees it without touching Tool.config_data
+INDEX_KEY = 'ollama_pulls_index'
+# Minimum seconds between progress writes for one pull
+UPDATE_INTERVAL = 0.5
+# A progress entry from a crashed worker disappears on its own
+PROGRESS_TIMEOUT = 3600
+# Running pulls refresh their claim this often, even while the daemon sends nothing
+HEARTBEAT_INTERVAL = 10
+# A claim not refreshed for this long belongs to a worker that died; it may be taken over or cleared
+STALE_AFTER = 60
+TAKEOVER_LOCK_TIMEOUT = 10
+MAX_CONCURRENT_PULLS = 2
+# Weight of the newest sample in the smoothed throughput
+RATE_SMOOTHING = 0.3
+
+
+def _job_key(model_name):
+    return f'ollama_pull_{model_name}'
+
+
+def _cancel_key(model_name):
+    return f'ollama_pull_cancel_{model_name}'
+
+
+def _takeover_key(model_name):
+    return f'ollama_pull_takeover_{model_name}'
+
+
+def is_abandoned(state):
+    return time.time() - state.get('updated_at', 0) > getattr(settings, 'OLLAMA_PULL_STALE_AFTER', STALE_AFTER)
+
+
+def get_pulls():
+    # Pulls of dead workers are not shown; their progress would never move
+    names = cache.get(INDEX_KEY) or []
+    found = cache.get_many([_job_key(n) for n in names])
+    return [found[_job_key(n)] for n in names if _job_key(n) in found and not is_abandoned(found[_job_key(n)])]
+
+
+def get_pull_progress(model_name):
+    state = cache.get(_job_key(model_name))
+    return None if state is None or is_abandoned(state) else state
+
+
+class PullCancelled(Exception):
+    pass
+
+
+class PullJob:
+    """Tracks one pull per layer and coalesces its progress into throttled cache writes."""
+
+    def __init__(self, model_name, interval=None, owner=None):
+        self.model_name = model_name
+        self.owner = owner
+        self.interval = interval if interval is not None else getattr(settings, 'OLLAMA_PULL_PROGRESS_INTERVAL', UPDATE_INTERVAL)
+        self.layers = {}
+        self.state = 'queued'
+        self.status = None
+        self.rate = 0.0
+        self.started_at = None
+        self.cancel_event = threading.Event()
+        self.finished = False
+        # Progress is written by the pull thread and the manager's heartbeat
+        self._lock = threading.RLock()
+        self.last_flush = 0
+        self.last_sample = None
+        self.flushes = 0
+        self.parts = 0
+
+    @property
+    def completed(self):
+        return sum(layer['completed'] for layer in self.layers.values())
+
+    @property
+    def total(self):
+        return sum(layer['total'] for layer in self.layers.values())
+
+    @property
+    def progress(self):
+        total = self.total
+        return int(self.completed * 100 / total) if total else 0
+
+    @property
+    def eta(self):
+        if self.rate <= 0:
+            return None
+        return int((self.total - self.completed) / self.rate)
+
+    def as_dict(self):
+        return {
+            'model': self.model_name,
+            'owner': self.owner,
+            'state': self.state,
+            'status': self.status,
+            'progress': self.progress,
+            'completed': self.completed,
+            'total': self.total,
+            'layers': self.layers,
+            'rate': int(self.rate),
+            'eta': self.eta,
+            'started_at': self.started_at,
+            'updated_at': time.time()
+        }
+
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    def start(self):
+        self.state = 'running'
+        self.started_at = time.time()
+        self.last_sample = (time.monotonic(), 0)
+        self.flush()
+
+    def update(self, part):
+        with self._lock:
+            self.parts += 1
+            if part.get('total'):
+                # Older daemons do not report a digest; treat their progress as a single layer
+                digest = part.get('digest') or 'layer'
+                self.layers[digest] = {'completed': part.get('completed') or 0, 'total': part['total']}
+
+            status = part.get('status')
+            status_changed = status is not None and status != self.status
+            if status is not None:
+                self.status = status
+            # Status changes are rare and meaningful, byte counts are throttled
+            if status_changed or time.monotonic() - self.last_flush >= self.interval:
+                self.flush()
+
+    def _sample_rate(self):
+        now = time.monotonic()
+        completed = self.completed
+        if self.last_sample is not None:
+            elapsed = now - self.last_sample[0]
+            if elapsed > 0:
+                sample = max(completed - self.last_sample[1], 0) / elapsed
+                self.rate = sample if not self.rate else RATE_SMOOTHING * sample + (1 - RATE_SMOOTHING) * self.rate
+        self.last_sample = (now, completed)
+
+    def flush(self):
+        with self._lock:
+            self.last_flush = time.monotonic()
+            self.flushes += 1
+            self._sample_rate()
+            # Cancels requested through another worker arrive through the cache
+            if cache.get(_cancel_key(self.model_name)):
+                self.cancel_event.set()
+            state = self.as_dict()
+            cache.set(_job_key(self.model_name), state, PROGRESS_TIMEOUT)
+            model_events.publish_pull_progress(
+                self.model_name, progress=state['progress'], status=state['status'],
+                state=state['state'], completed=state['completed'], total=state['total'],
+                rate=state['rate'], eta=state['eta']
+            )
+
+    def heartbeat(self):
+        # Keeps the claim fresh while the daemon is quiet, e.g. while it verifies a layer
+        with self._lock:
+            if self.finished:
+                return
+            if cache.get(_cancel_key(self.model_name)):
+                self.cancel_event.set()
+            cache.set(_job_key(self.model_name), self.as_dict(), PROGRESS_TIMEOUT)
+
+    def finish(self, error=None, cancelled=False):
+        with self._lock:
+            self.finished = True
+            cache.delete_many([_job_key(self.model_name), _cancel_key(self.model_name)])
+        if cancelled:
+            model_events.publish_pull_progress(self.model_name, done=True, state='cancelled')
+        else:
+            model_events.publish_pull_progress(self.model_name, progress=None if error else 100, done=True, error=error)
+
+
+class PullManager:
+    """Runs pulls through a bounded worker pool, one job per model."""
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._jobs = {}
+        # Written into every claim, so other workers can tell whose pull it is
+        self.owner = uuid.uuid4().hex
+        self._heartbeat = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            max_workers = self.max_workers or getattr(settings, 'OLLAMA_MAX_CONCURRENT_PULLS', MAX_CONCURRENT_PULLS)
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ollama-pull')
+        return self._executor
+
+    def _update_index(self, add=None, remove=None):
+        with self._lock:
+            names = cache.get(INDEX_KEY) or []
+            if add and add not in names:
+                names.append(add)
+            if remove in names:
+                names.remove(remove)
+            cache.set(INDEX_KEY, names, PROGRESS_TIMEOUT)
+
+    def _claim(self, job):
+        # The cache entry doubles as a claim, so two workers never pull the same model
+        if cache.add(_job_key(job.model_name), job.as_dict(), PROGRESS_TIMEOUT):
+            return True
+        return self._with_abandoned_claim(job.model_name, lambda state: cache.set(_job_key(job.model_name), job.as_dict(), PROGRESS_TIMEOUT))
+
+    def _with_abandoned_claim(self, model_name, action):
+        # Runs action on a claim whose owner died; the takeover lock keeps two workers from both acting on it
+        state = cache.get(_job_key(model_name))
+        if state is None or not is_abandoned(state):
+            return False
+        if not cache.add(_takeover_key(model_name), self.owner, TAKEOVER_LOCK_TIMEOUT):
+            return False
+        try:
+            state = cache.get(_job_key(model_name))
+            if state is None or not is_abandoned(state):
+                return False
+            logger.warning(f"Pull of {model_name} by {state.get('owner')} was abandoned")
+            action(state)
+            return True
+        finally:
+            cache.delete(_takeover_key(model_name))
+
+    def _beat(self):
+        interval = getattr(settings, 'OLLAMA_PULL_HEARTBEAT_INTERVAL', HEARTBEAT_INTERVAL)
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                jobs = list(self._jobs.values())
+                if not jobs:
+                    self._heartbeat = None
+                    return
+            for job in jobs:
+                job.heartbeat()
+
+    def submit(self, tool_pk, model_name):
+        job = PullJob(model_name, owner=self.owner)
+        with self._lock:
+            if model_name in self._jobs:
+                return self._jobs[model_name]
+            if not self._claim(job):
+                return None
+            self._jobs[model_name] = job
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._beat, name='ollama-pull-heartbeat', daemon=True)
+                self._heartbeat.start()
+        cache.delete(_cancel_key(model_name))
+        self._update_index(add=model_name)
+        self._get_executor().submit(self._run, tool_pk, job)
+        return job
+
+    def cancel(self, model_name):
+        cache.set(_cancel_key(model_name), True, PROGRESS_TIMEOUT)
+        with self._lock:
+            job = self._jobs.get(model_name)
+        if job:
+            job.cancel_event.set()
+            return True
+
+        def clear(state):
+            # Nobody would ever read the cancel flag; clearing the claim lets the model be pulled again
+            cache.delete_many([_job_key(model_name), _cancel_key(model_name)])
+            self._update_index(remove=model_name)
+            model_events.publish_pull_progress(model_name, done=True, state='cancelled')
+
+        self._with_abandoned_claim(model_name, clear)
+        return False
+
+    def _run(self, tool_pk, job):
+        from django import db
+        from core.models import Tool
+        try:
+            if job.is_cancelled():
+                raise PullCancelled()
+            job.start()
+            client = get_client()
+            stream = client.pull(job.model_name, stream=True)
+            try:
+                for part in stream:
+                    if job.is_cancelled():
+                        raise PullCancelled()
+                    # If status is 'success', we can finish early
+                    if part.get('status') == 'success':
+                        break
+                    job.update(part)
+            finally:
+                # Closing the generator closes the HTTP stream, which stops the daemon's download
+                close = getattr(stream, 'close', None)
+                if close:
+                    close()
+            job.finish()
+            # Refreshing the list pushes the new model row to open Models tabs
+            from . import model_cache
+            model_cache.refresh_in_background(tool_pk, lambda: model_cache.list_models(client))
+        except PullCancelled:
+            job.finish(cancelled=True)
+        except Exception as e:
+            job.finish(error=str(e))
+            try:
+                tool = Tool.objects.get(pk=tool_pk)
+                tool.config_data['pull_error'] = f"{job.model_name}: {e}"
+                tool.save()
+            except Exception:
+                pass
+        finally:
+            with self._lock:
+                self._jobs.pop(job.model_name, None)
+            self._update_index(remove=job.model_name)
+            db.connection.close()
+
+
+pull_manager = PullManager()
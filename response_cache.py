@@ -0,0 +1,211 @@
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from .capabilities import get_model_field
+
+logger = logging.getLogger(__name__)
+
+INDEX_KEY = 'ollama_response_cache_index'
+TTL = 24 * 3600
+MAX_ENTRIES = 512
+MAX_BYTES = 16 * 1024 * 1024
+# Replayed chunks never wait longer than this, even if the original stream stalled
+MAX_REPLAY_DELAY = 0.25
+
+
+def _entry_key(key):
+    return f'ollama_response_{key}'
+
+
+def is_enabled():
+    return getattr(settings, 'OLLAMA_RESPONSE_CACHE', False)
+
+
+def is_deterministic(options):
+    # Sampling at temperature 0 is greedy; anything else may legitimately differ between runs
+    return float(options.get('temperature', 1)) == 0
+
+
+def get_model_digest(model_name):
+    from core.models import Tool
+    from . import model_cache
+    tool = Tool.objects.filter(name='ollama').first()
+    if tool is None:
+        return None
+    model = model_cache.find_cached_model(tool.id, model_name)
+    return get_model_field(model, 'digest') if model is not None else None
+
+
+def make_key(model, digest, messages, tools, options):
+    # Returns None when the request must not be served from the cache
+    if not is_enabled() or not digest or not is_deterministic(options):
+        return None
+    payload = json.dumps({
+        'model': model,
+        'digest': digest,
+        'messages': messages,
+        'tools': tools or [],
+        'options': options
+    }, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """Recorded chat streams in the cache backend, bounded by entry count and total size."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'invalidations': 0}
+
+    def _get_index(self):
+        return cache.get(INDEX_KEY) or {}
+
+    def get(self, key):
+        if key is None:
+            return None
+        entry = cache.get(_entry_key(key))
+        with self._lock:
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            index = self._get_index()
+            if key in index:
+                index[key]['used_at'] = time.time()
+                cache.set(INDEX_KEY, index, None)
+        return entry
+
+    def set(self, key, model, digest, entry):
+        size = len(json.dumps(entry, ensure_ascii=False).encode('utf-8'))
+        max_bytes = getattr(settings, 'OLLAMA_RESPONSE_CACHE_MAX_BYTES', MAX_BYTES)
+        if size > max_bytes:
+            return False
+        cache.set(_entry_key(key), entry, getattr(settings, 'OLLAMA_RESPONSE_CACHE_TTL', TTL))
+        with self._lock:
+            index = self._get_index()
+            # A new digest means the model changed; everything recorded for the old one is dropped
+            stale = [k for k, meta in index.items() if meta['model'] == model and meta['digest'] != digest]
+            self.stats['invalidations'] += len(stale)
+            for k in stale:
+                index.pop(k)
+            index[key] = {'model': model, 'digest': digest, 'size': size, 'used_at': time.time()}
+
+            max_entries = getattr(settings, 'OLLAMA_RESPONSE_CACHE_MAX_ENTRIES', MAX_ENTRIES)
+            evicted = []
+            total = sum(meta['size'] for meta in index.values())
+            for k in sorted(index, key=lambda k: index[k]['used_at']):
+                if len(index) <= max_entries and total <= max_bytes:
+                    break
+                total -= index[k]['size']
+                index.pop(k)
+                evicted.append(k)
+            self.stats['evictions'] += len(evicted)
+            self.stats['stores'] += 1
+            cache.set(INDEX_KEY, index, None)
+        if stale or evicted:
+            cache.delete_many([_entry_key(k) for k in stale + evicted])
+        return True
+
+    def clear(self):
+        with self._lock:
+            index = self._get_index()
+            cache.delete_many([_entry_key(k) for k in index] + [INDEX_KEY])
+
+
+response_cache = ResponseCache()
+
+
+def _chunk_text(chunk):
+    message = chunk.get('message', {}) or {}
+    return message.get('reasoning_content', '') or '', message.get('content', '') or ''
+
+
+def _replay_chunks(entry):
+    for delay, reasoning, content in entry['chunks']:
+        yield delay, {'message': {'role': 'assistant', 'content': content, 'reasoning_content': reasoning}, 'done': False}
+    yield 0, {
+        'message': {'role': 'assistant', 'content': ''},
+        'done': True,
+        'prompt_eval_count': entry.get('prompt_eval_count', 0),
+        'eval_count': entry.get('eval_count', 0)
+    }
+
+
+def _replay_delay(delay):
+    if getattr(settings, 'OLLAMA_RESPONSE_CACHE_REPLAY', 'instant') != 'simulated':
+        return 0
+    return min(delay, MAX_REPLAY_DELAY)
+
+
+def replay(entry):
+    # Yields chunks shaped like Ollama's so the normal streaming code renders them
+    for delay, chunk in _replay_chunks(entry):
+        delay = _replay_delay(delay)
+        if delay:
+            time.sleep(delay)
+        yield chunk
+
+
+async def areplay(entry):
+    for delay, chunk in _replay_chunks(entry):
+        delay = _replay_delay(delay)
+        if delay:
+            await asyncio.sleep(delay)
+        yield chunk
+
+
+class _Recording:
+    def __init__(self, key, model, digest):
+        self.key = key
+        self.model = model
+        self.digest = digest
+        self.chunks = []
+        self.last = time.monotonic()
+        self.cacheable = True
+
+    def add(self, chunk):
+        now = time.monotonic()
+        message = chunk.get('message', {}) or {}
+        if message.get('tool_calls'):
+            # Tool calls have side effects and their results may change; such turns are never replayed
+            self.cacheable = False
+        reasoning, content = _chunk_text(chunk)
+        if reasoning or content:
+            self.chunks.append((round(now - self.last, 4), reasoning, content))
+        self.last = now
+        if chunk.get('done') and self.cacheable:
+            response_cache.set(self.key, self.model, self.digest, {
+                'chunks': self.chunks,
+                'prompt_eval_count': chunk.get('prompt_eval_count', 0) or 0,
+                'eval_count': chunk.get('eval_count', 0) or 0
+            })
+
+
+def record(key, model, digest, stream):
+    # Passes the live stream through unchanged and stores it once it completes
+    recording = _Recording(key, model, digest)
+    try:
+        for chunk in stream:
+            recording.add(chunk)
+            yield chunk
+    finally:
+        close = getattr(stream, 'close', None)
+        if close:
+            close()
+
+
+async def arecord(key, model, digest, stream):
+    recording = _Recording(key, model, digest)
+    try:
+        async for chunk in stream:
+            recording.add(chunk)
+            yield chunk
+    finally:
+        aclose = getattr(stream, 'aclose', None)
+        if aclose:
+            await aclose()
@@ -0,0 +1,72 @@
+import logging
+import threading
+import time
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from . import model_events
+from .clients import get_host
+
+logger = logging.getLogger(__name__)
+
+# How long a probed status is served before it is re-checked in the background
+STATUS_CACHE_SECONDS = 5
+REFRESH_LOCK_TIMEOUT = 30
+
+STATUS_KEY = 'ollama_service_status'
+# Served until the first probe lands, so a render never waits on systemctl
+UNKNOWN_STATUS = 'unknown'
+LOCK_KEY = 'ollama_service_status_refresh_lock'
+
+
+def check_http_health(timeout=1):
+    # The version endpoint is the cheapest request the daemon answers
+    try:
+        response = requests.get(f'{get_host()}/api/version', timeout=timeout)
+        return response.status_code == 200
+    except requests.RequestException:
+        return False
+
+
+def refresh(probe):
+    status = probe()
+    previous = cache.get(STATUS_KEY)
+    cache.set(STATUS_KEY, {'status': status, 'timestamp': time.time()}, None)
+    if previous is None or previous['status'] != status:
+        # Open Models tabs rendered the old (or provisional) status
+        model_events.publish({'type': 'service_status', 'status': status})
+    return status
+
+
+def refresh_in_background(probe):
+    # Single-flight across workers so a busy dashboard triggers one probe per interval
+    if not cache.add(LOCK_KEY, True, REFRESH_LOCK_TIMEOUT):
+        return False
+
+    def run_refresh():
+        try:
+            refresh(probe)
+        except Exception as e:
+            logger.warning(f"Ollama service status probe failed: {e}")
+        finally:
+            cache.delete(LOCK_KEY)
+
+    threading.Thread(target=run_refresh, daemon=True).start()
+    return True
+
+
+def get_status(probe):
+    # Renders never wait for the probe: the last known status is served while it runs
+    entry = cache.get(STATUS_KEY)
+    interval = getattr(settings, 'OLLAMA_STATUS_CACHE_SECONDS', STATUS_CACHE_SECONDS)
+    if entry is None or time.time() - entry['timestamp'] > interval:
+        refresh_in_background(probe)
+    return entry['status'] if entry else UNKNOWN_STATUS
+
+
+def invalidate():
+    # Marks the status stale after a start/stop/install; the old value is kept for the next render
+    entry = cache.get(STATUS_KEY)
+    if entry is not None:
+        entry['timestamp'] = 0
+        cache.set(STATUS_KEY, entry, None)
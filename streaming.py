@@ -0,0 +1,348 @@
+import asyncio
+import json
+import time
+from django.conf import settings
+
+# Buffered content is flushed after this many seconds or characters, whichever comes first
+FLUSH_INTERVAL = 0.04
+FLUSH_CHARS = 256
+
+# Defined once per response; every flush then only ships the text and a short call
+STREAM_HELPERS_SCRIPT = (
+    '<script>'
+    'window.ollamaStreamAppend = function(text) {'
+    'var target = document.getElementById("streaming-text-target");'
+    'var loader = document.getElementById("streaming-loader");'
+    'if(loader) loader.remove();'
+    'target.appendChild(document.createTextNode(text));'
+    'var history = document.getElementById("chat-history-container");'
+    'history.scrollTop = history.scrollHeight;'
+    '};'
+    '</script>'
+)
+
+
+def render_append_frame(text):
+    return f'<script>ollamaStreamAppend({json.dumps(text, ensure_ascii=False)});</script>'
+
+
+def render_queued_frame(position):
+    # Creates the queue notice on first use and updates it afterwards
+    return (
+        '<script>(function() {'
+        'var notice = document.getElementById("ollama-queue-notice");'
+        'if (!notice) {'
+        'notice = document.createElement("div");'
+        'notice.id = "ollama-queue-notice";'
+        'notice.className = "text-muted small mb-3";'
+        'document.getElementById("chat-history-container").appendChild(notice);'
+        '}'
+        f'notice.innerText = "Waiting for a free model slot (position {int(position)})";'
+        '})();</script>'
+    )
+
+
+QUEUE_CLEAR_SCRIPT = '<script>var notice = document.getElementById("ollama-queue-notice"); if(notice) notice.remove();</script>'
+
+
+# HTML fragments of the chat_send stream, shared by the sync and async views
+def render_reply_container(model):
+    return f'<div class="d-flex mb-4 animate-fade-in" id="streaming-response-container">' \
+           f'<div class="flex-shrink-0 me-3">' \
+           f'<div class="rounded-circle bg-primary d-flex align-items-center justify-content-center" style="width: 32px; height: 32px;">' \
+           f'<i class="bi bi-robot text-white"></i>' \
+           f'</div>' \
+           f'</div>' \
+           f'<div class="flex-grow-1">' \
+           f'<div class="fw-bold small mb-1">Ollama <span class="text-muted fw-normal">({model})</span></div>' \
+           f'<div class="p-3 rounded-3 border border-secondary border-opacity-25 text-main small shadow-sm markdown-content" ' \
+           f'style="max-width: 85%; background-color: var(--card-bg);" id="streaming-text-target">' \
+           f'<div id="streaming-loader" class="py-1 d-flex gap-1">' \
+           f'<span class="spinner-grow spinner-grow-sm text-primary" role="status" style="width: 8px; height: 8px;"></span>' \
+           f'<span class="spinner-grow spinner-grow-sm text-primary" role="status" style="width: 8px; height: 8px; animation-delay: 0.2s"></span>' \
+           f'<span class="spinner-grow spinner-grow-sm text-primary" role="status" style="width: 8px; height: 8px; animation-delay: 0.4s"></span>' \
+           f'</div>' \
+           f'</div>' \
+           f'<div class="mt-1 ms-1" id="streaming-tokens-target" style="display:none; font-size: 10px; color: var(--muted);">' \
+           f'<i class="bi bi-lightning-charge-fill me-1"></i><span class="token-count">0</span> tokens' \
+           f'</div>' \
+           f'</div></div>'
+
+
+def render_tool_call(func_name, func_args):
+    return f'<script>' \
+           f'var target = document.getElementById("streaming-text-target");' \
+           f'var loader = document.getElementById("streaming-loader");' \
+           f'if(loader) loader.remove();' \
+           f'target.innerHTML += \'<div class="alert alert-info py-2 px-3 mt-2 mb-0 d-flex align-items-center gap-2 small border-0 shadow-sm" style="background: rgba(var(--bs-info-rgb), 0.1);"><i class="bi bi-cpu"></i> Calling tool: <b>{func_name}</b>({json.dumps(func_args)})</div>\';' \
+           f'document.getElementById("chat-history-container").scrollTop = document.getElementById("chat-history-container").scrollHeight;' \
+           f'</script>'
+
+
+def render_tool_result(func_name, outcome):
+    return f'<script>' \
+           f'var target = document.getElementById("streaming-text-target");' \
+           f'target.innerHTML += \'<div class="alert alert-success py-1 px-3 mt-1 mb-2 d-flex align-items-center gap-2 x-small border-0 shadow-sm" style="background: rgba(var(--bs-success-rgb), 0.1); font-family: monospace;"><i class="bi bi-check-circle"></i> Result from <b>{func_name}</b>: {json.dumps(outcome["result"])} <span class="text-muted">({outcome["duration_ms"]} ms)</span></div>\';' \
+           f'document.getElementById("chat-history-container").scrollTop = document.getElementById("chat-history-container").scrollHeight;' \
+           f'</script>'
+
+
+def format_timing(timing):
+    # Short throughput summary shown next to the token count
+    parts = []
+    if timing and timing.get('eval_tokens_per_sec'):
+        parts.append(f"{timing['eval_tokens_per_sec']:.1f} tok/s")
+    if timing and timing.get('ttft_ms') is not None:
+        parts.append(f"first token {timing['ttft_ms']} ms")
+    return ' · '.join(parts)
+
+
+def render_reply_done(full_content, message_tokens, stopped, session_id, total_tokens, timing=None):
+    safe_full_content = json.dumps(full_content, ensure_ascii=False)
+    timing_text = format_timing(timing)
+    return f'<script>' \
+           f'var container = document.getElementById("streaming-response-container");' \
+           f'var target = document.getElementById("streaming-text-target");' \
+           f'var tokensTarget = document.getElementById("streaming-tokens-target");' \
+           f'var loader = document.getElementById("streaming-loader");' \
+           f'if(loader) loader.remove();' \
+           f'target.setAttribute("data-raw-content", {safe_full_content});' \
+           f'target.removeAttribute("id");' \
+           f'if(tokensTarget) {{' \
+           f'  tokensTarget.querySelector(".token-count").innerText = "{message_tokens}";' \
+           f'  if({json.dumps(stopped)}) tokensTarget.insertAdjacentText("beforeend", " (stopped)");' \
+           f'  if({json.dumps(timing_text)}) tokensTarget.insertAdjacentText("beforeend", {json.dumps(" · " + timing_text, ensure_ascii=False)});' \
+           f'  tokensTarget.style.display = "block";' \
+           f'  tokensTarget.removeAttribute("id");' \
+           f'}}' \
+           f'container.removeAttribute("id");' \
+           f'if(window.renderMarkdown) window.renderMarkdown(target);' \
+           f'target.setAttribute("data-rendered", "true");' \
+           f'document.getElementById("session-id-input").value = "{session_id}";' \
+           f'document.getElementById("total-tokens-input").value = "{total_tokens}";' \
+           f'document.getElementById("total-tokens-display").innerText = "{total_tokens}";' \
+           f'</script>'
+
+
+def render_chat_error(error):
+    error_msg = str(error)
+    if "unauthorized" in error_msg.lower() or "401" in error_msg:
+        error_msg = "Ollama is unauthorized to use this model."
+    return f'<div class="alert alert-danger small mt-2">{error_msg}</div>'
+
+
+def plain_tool_calls(tool_calls):
+    # ollama-python yields pydantic ToolCall objects; sessions and frames are JSON, so they become dicts
+    return [call.model_dump(exclude_none=True) if hasattr(call, 'model_dump') else call for call in tool_calls or []]
+
+
+class ReplyTurn:
+    """Text, tool calls and token count of one model turn, built from Ollama chunks.
+
+    Reasoning content is wrapped in <thought> tags, the way the chat UI renders it.
+    """
+
+    def __init__(self):
+        self.content = ""
+        self.tool_calls = []
+        self.chunks = 0
+        self.tokens = 0
+        self.done = False
+        self.reasoning = False
+
+    def add(self, chunk):
+        # Returns the text this chunk adds to the reply
+        self.chunks += 1
+        message = chunk.get('message', {})
+        reasoning = message.get('reasoning_content', '')
+        content = message.get('content', '')
+
+        # Collect tool calls if present
+        if message.get('tool_calls', []):
+            self.tool_calls.extend(plain_tool_calls(message['tool_calls']))
+
+        text = ""
+        if reasoning:
+            if not self.reasoning:
+                self.reasoning = True
+                text += "<thought>\n"
+            text += reasoning
+
+        if content:
+            if self.reasoning:
+                self.reasoning = False
+                text += "\n</thought>\n\n"
+            text += content
+
+        if chunk.get('done'):
+            self.done = True
+            self.tokens = chunk.get('prompt_eval_count', 0) + chunk.get('eval_count', 0)
+        self.content += text
+        return text
+
+    def finish(self):
+        # Closes a reasoning block the model never left
+        if not self.reasoning:
+            return ""
+        self.reasoning = False
+        self.content += "\n</thought>"
+        return "\n</thought>"
+
+
+class FrameCoalescer:
+    """Batches streamed text into flushes bounded by time and size."""
+
+    def __init__(self, render_frame, flush_interval=None, flush_chars=None):
+        self.render_frame = render_frame
+        self.flush_interval = flush_interval if flush_interval is not None else getattr(settings, 'OLLAMA_STREAM_FLUSH_INTERVAL', FLUSH_INTERVAL)
+        self.flush_chars = flush_chars if flush_chars is not None else getattr(settings, 'OLLAMA_STREAM_FLUSH_CHARS', FLUSH_CHARS)
+        self.buffer = []
+        self.buffered_chars = 0
+        self.last_flush = time.monotonic()
+        self.stats = {'chunks': 0, 'flushes': 0, 'frames': 0, 'bytes': 0}
+
+    def add(self, text):
+        # Returns a frame when a threshold is reached, otherwise None
+        if not text:
+            return None
+        self.stats['chunks'] += 1
+        self.buffer.append(text)
+        self.buffered_chars += len(text)
+        if self.buffered_chars >= self.flush_chars or time.monotonic() - self.last_flush >= self.flush_interval:
+            return self.flush()
+        return None
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return None
+        text = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered_chars = 0
+        self.stats['flushes'] += 1
+        return self.record(self.render_frame(text))
+
+    def record(self, frame):
+        # Every frame written to the response goes through here so byte counts are complete
+        self.stats['frames'] += 1
+        self.stats['bytes'] += len(frame.encode('utf-8'))
+        return frame
+
+
+# WebSocket consumer batching
+WS_FLUSH_INTERVAL = 0.04
+WS_FLUSH_CHARS = 512
+# Content buffered for a client beyond this pauses generation until the client catches up
+WS_MAX_BUFFER_CHARS = 65536
+# A client that stays behind this long is disconnected
+WS_SLOW_CLIENT_TIMEOUT = 30
+
+
+class SlowClientError(Exception):
+    pass
+
+
+class FrameBuffer:
+    """Bounded outgoing buffer drained by a single writer task.
+
+    Adjacent content frames are merged while they wait, so a slow client
+    receives fewer, larger frames. Once more than max_buffer_chars are
+    queued or in flight, put() blocks the producer, which stops reading
+    from Ollama. If the client has not caught up after slow_client_timeout
+    seconds, put() raises SlowClientError.
+    """
+
+    def __init__(self, send, flush_interval=None, flush_chars=None, max_buffer_chars=None, slow_client_timeout=None):
+        self.send = send
+        self.flush_interval = flush_interval if flush_interval is not None else getattr(settings, 'OLLAMA_WS_FLUSH_INTERVAL', WS_FLUSH_INTERVAL)
+        self.flush_chars = flush_chars if flush_chars is not None else getattr(settings, 'OLLAMA_WS_FLUSH_CHARS', WS_FLUSH_CHARS)
+        self.max_buffer_chars = max_buffer_chars if max_buffer_chars is not None else getattr(settings, 'OLLAMA_WS_MAX_BUFFER_CHARS', WS_MAX_BUFFER_CHARS)
+        self.slow_client_timeout = slow_client_timeout if slow_client_timeout is not None else getattr(settings, 'OLLAMA_WS_SLOW_CLIENT_TIMEOUT', WS_SLOW_CLIENT_TIMEOUT)
+        self.frames = []
+        # Characters queued or currently being sent
+        self.buffered_chars = 0
+        self.closed = False
+        self.error = None
+        self.writer_task = None
+        self.stats = {'chunks': 0, 'merged': 0, 'frames': 0, 'bytes': 0}
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.flush_now = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.drained.set()
+        self.writer_task = asyncio.create_task(self._writer())
+        return self
+
+    async def put(self, frame):
+        if self.error is not None:
+            raise SlowClientError(f"Client connection failed: {self.error}")
+
+        if frame.get('type') == 'content':
+            self.stats['chunks'] += 1
+            self.buffered_chars += len(frame['content'])
+            if self.frames and self.frames[-1].get('type') == 'content':
+                self.frames[-1]['content'] += frame['content']
+                self.stats['merged'] += 1
+            else:
+                self.frames.append(dict(frame))
+            if self.buffered_chars >= self.flush_chars:
+                self.flush_now.set()
+        else:
+            # Control frames are not merged and go out without waiting for the timer
+            self.frames.append(frame)
+            self.flush_now.set()
+        self.wakeup.set()
+
+        if self.buffered_chars >= self.max_buffer_chars:
+            self.drained.clear()
+            try:
+                await asyncio.wait_for(self.drained.wait(), self.slow_client_timeout)
+            except asyncio.TimeoutError:
+                raise SlowClientError(f"Client fell {self.buffered_chars} characters behind")
+
+    async def _writer(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                if not self.closed and not self.flush_now.is_set():
+                    # Give the model a moment to produce more tokens so they share one frame
+                    try:
+                        await asyncio.wait_for(self.flush_now.wait(), self.flush_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                self.flush_now.clear()
+                await self._drain()
+                if self.closed and not self.frames:
+                    return
+        except Exception as e:
+            self.error = e
+            self.drained.set()
+
+    async def _drain(self):
+        batch, self.frames = self.frames, []
+        for frame in batch:
+            text = json.dumps(frame)
+            await self.send(text)
+            self.stats['frames'] += 1
+            self.stats['bytes'] += len(text.encode('utf-8'))
+            if frame.get('type') == 'content':
+                self.buffered_chars -= len(frame['content'])
+        if self.buffered_chars < self.max_buffer_chars:
+            self.drained.set()
+
+    async def close(self):
+        # Flushes whatever is left and waits for the writer to finish
+        if self.writer_task is None:
+            return
+        self.closed = True
+        self.flush_now.set()
+        self.wakeup.set()
+        await self.writer_task
+
+    def abort(self):
+        # Drops pending frames, used when the client is going away
+        self.frames = []
+        if self.writer_task is not None and not self.writer_task.done():
+            self.writer_task.cancel()
@@ -19,15 +19,25 @@ class MockModel:
 class OllamaModuleTest(TestCase):
     def setUp(self):
         cache.clear()
+        from modules.ollama.module import clear_version_cache
+        clear_version_cache()
+        from modules.ollama.clients import client_registry
+        # Pooled clients would otherwise outlive the ollama.Client patches of earlier tests
+        client_registry.clear()
+        import time
+        from modules.ollama import service_status
+        # A known status keeps renders from starting probe threads that outlive a test's patches
+        cache.set(service_status.STATUS_KEY, {'status': 'running', 'timestamp': time.time()}, None)
         self.client = Client()
         self.user = User.objects.create_superuser(username='admin', password='password', email='admin@test.com')
         self.client.login(username='admin', password='password')
         self.tool = Tool.objects.create(name="ollama", status="installed")
 
+    @patch('modules.ollama.service_status.check_http_health', return_value=False)
     @patch('ollama.Client')
     @patch('modules.ollama.module.run_command')
     @patch('django.core.cache.cache.set')
-    def test_ollama_models_partial(self, mock_cache_set, mock_run, mock_ollama):
+    def test_ollama_models_partial(self, mock_cache_set, mock_run, mock_ollama, mock_health):
         mock_run.return_value = b"active"
         mock_client = MagicMock()
         
@@ -85,6 +95,8 @@ class OllamaModuleTest(TestCase):
             'history': '[]'
         })
         self.assertEqual(response.status_code, 200)
+        # Without a request_id one is generated and returned so the stream can still be stopped
+        self.assertTrue(response['X-Request-Id'])
         # Streaming response check
         content = b"".join(response.streaming_content).decode()
         self.assertIn("Hello", content)
@@ -115,9 +127,10 @@ class OllamaModuleTest(TestCase):
         # It should have finished and cleaned up config_data
         self.assertNotIn('pulling_model', self.tool.config_data)
 
+    @patch('modules.ollama.service_status.check_http_health', return_value=False)
     @patch('modules.ollama.module.run_command')
     @patch('django.core.cache.cache.set')
-    def test_ollama_module_logic(self, mock_cache_set, mock_run):
+    def test_ollama_module_logic(self, mock_cache_set, mock_run, mock_health):
         from modules.ollama.module import Module
         module = Module()
         
@@ -127,7 +140,7 @@ class OllamaModuleTest(TestCase):
             self.assertEqual(module.get_service_version(), "0.15.4")
         
         mock_run.return_value = b"active"
-        self.assertEqual(module.get_service_status(self.tool), "running")
+        self.assertEqual(module._probe_service_status(), "running")
         
         module.service_start(self.tool)
         mock_run.assert_called_with(["systemctl", "start", "ollama"])
@@ -150,9 +163,10 @@ class OllamaModuleTest(TestCase):
         self.assertEqual(self.tool.status, 'installing')
         mock_thread.assert_called_once()
 
+    @patch('modules.ollama.service_status.check_http_health', return_value=False)
     @patch('modules.ollama.module.run_command')
     @patch('ollama.Client')
-    def test_ollama_get_context_data(self, mock_ollama, mock_run):
+    def test_ollama_get_context_data(self, mock_ollama, mock_run, mock_health):
         from modules.ollama.module import Module
         module = Module()
         mock_run.return_value = b"active"
@@ -160,6 +174,8 @@ class OllamaModuleTest(TestCase):
         mock_client.list.return_value = {'models': []}
         mock_ollama.return_value = mock_client
         
+        from modules.ollama import service_status
+        service_status.refresh(module._probe_service_status)
         context = module.get_context_data(None, self.tool)
         self.assertTrue(context['service_active'])
         
@@ -196,7 +212,7 @@ class OllamaModuleTest(TestCase):
         time.sleep(0.5)
         self.tool.refresh_from_db()
 
-    @patch('modules.ollama.views.ollama.Client')
+    @patch('ollama.Client')
     def test_chat_send_error(self, mock_ollama):
         mock_client = MagicMock()
         mock_client.chat.side_effect = Exception("chat error")
@@ -222,19 +238,33 @@ class OllamaModuleTest(TestCase):
         response = self.client.post(url, {'model': 'm', 'message': 'h', 'temperature': 'invalid'})
         self.assertEqual(response.status_code, 400)
 
+    # Without this, a daemon running on the test machine would answer the HTTP probe
+    @patch('modules.ollama.service_status.check_http_health', return_value=False)
     @patch('modules.ollama.module.run_command')
-    def test_ollama_status_detection(self, mock_run):
+    def test_ollama_status_detection(self, mock_run, mock_health):
         mock_run.return_value = b"active"
         from core.plugin_system import plugin_registry
+        from modules.ollama import service_status
         module = plugin_registry.get_module("ollama")
-        status = module.get_service_status(self.tool)
-        self.assertEqual(status, "running")
-        
+        cache.delete(service_status.STATUS_KEY)
+        # A cold cache never blocks the render on systemctl; the probe runs in the background
+        with patch('modules.ollama.service_status.threading.Thread') as mock_thread:
+            self.assertEqual(module.get_service_status(self.tool), "unknown")
+            mock_thread.assert_called_once()
+        mock_run.assert_not_called()
+
+        self.assertEqual(service_status.refresh(module._probe_service_status), "running")
         mock_run.return_value = b"inactive"
-        self.assertEqual(module.get_service_status(self.tool), "stopped")
-        
+        self.assertEqual(module._probe_service_status(), "stopped")
         mock_run.return_value = b"unknown"
-        self.assertEqual(module.get_service_status(self.tool), "error")
+        self.assertEqual(module._probe_service_status(), "error")
+
+        # After a start/stop the last known status is served while it is re-probed
+        cache.delete(service_status.LOCK_KEY)
+        module.service_stop(self.tool)
+        with patch('modules.ollama.service_status.threading.Thread') as mock_thread:
+            self.assertEqual(module.get_service_status(self.tool), "running")
+            mock_thread.assert_called_once()
 
     @patch('modules.ollama.module.run_command')
     @patch('modules.ollama.module.threading.Thread')
@@ -354,3 +384,1054 @@ class OllamaModuleTest(TestCase):
             'history': 'invalid-json'
         })
         self.assertEqual(response.status_code, 200) # It falls back to empty history
+
+    @patch('modules.ollama.service_status.check_http_health', return_value=False)
+    @patch('modules.ollama.module.capability_refresher')
+    @patch('modules.ollama.module.run_command')
+    @patch('ollama.Client')
+    def test_capabilities_refreshed_in_background(self, mock_ollama, mock_run, mock_refresher, mock_health):
+        from modules.ollama.module import Module
+        mock_run.return_value = b"active"
+        mock_client = MagicMock()
+        mock_client.list.return_value = {'models': [
+            {'model': 'llama3:latest', 'size': 1, 'digest': 'sha-a'},
+            {'model': 'llama3:8b', 'size': 1, 'digest': 'sha-a'},
+        ]}
+        mock_ollama.return_value = mock_client
+
+        with patch('modules.ollama.capabilities.requests.get') as mock_get:
+            context = Module().get_context_data(None, self.tool)
+            mock_get.assert_not_called()
+
+        self.assertTrue(all(m['capabilities']['pending'] for m in context['models']))
+        mock_refresher.schedule.assert_called_once_with([('sha-a', 'llama3:8b')])
+
+    def test_capability_refresher_dedupes_in_flight(self):
+        import threading
+        from modules.ollama.capabilities import CapabilityRefresher
+        release = threading.Event()
+        refresher = CapabilityRefresher(max_workers=2)
+        with patch('modules.ollama.capabilities.resolve_capabilities', side_effect=lambda client, name: release.wait(1) and None) as mock_resolve:
+            self.assertEqual(refresher.schedule([('sha-a', 'llama3'), ('sha-b', 'mistral')]), ['sha-a', 'sha-b'])
+            self.assertEqual(refresher.schedule([('sha-a', 'llama3')]), [])
+            self.assertTrue(refresher.is_pending('sha-a'))
+            release.set()
+            refresher._executor.shutdown(wait=True)
+        self.assertEqual(mock_resolve.call_count, 2)
+        self.assertFalse(refresher.is_pending('sha-a'))
+
+    @patch('modules.ollama.model_events.publish')
+    def test_capability_refresh_publishes_resolved_models(self, mock_publish):
+        from modules.ollama.capabilities import CapabilityRefresher, capability_store
+        refresher = CapabilityRefresher(max_workers=1)
+        caps = {'tools': True, 'source': 'local', 'timestamp': 0}
+        with patch('modules.ollama.capabilities.resolve_capabilities', side_effect=[caps, None]):
+            refresher.schedule([('sha-a', 'llama3')])
+            refresher.schedule([('sha-b', 'mistral')])
+            refresher._executor.shutdown(wait=True)
+        self.assertEqual(capability_store.get('sha-a'), caps)
+        # Unresolved models stay pending and are retried on the next render, so nothing is published
+        mock_publish.assert_called_once_with({'type': 'models_capabilities', 'model': 'llama3'})
+
+    def test_resolve_local_capabilities_from_show(self):
+        from modules.ollama.capabilities import resolve_capabilities, is_stale
+        mock_client = MagicMock()
+        mock_client.show.return_value = {
+            'capabilities': ['completion', 'tools', 'vision'],
+            'details': {'family': 'llama', 'quantization_level': 'Q4_K_M'},
+            'modelinfo': {'llama.context_length': 131072},
+        }
+        with patch('modules.ollama.capabilities.requests.get') as mock_get:
+            caps = resolve_capabilities(mock_client, 'llama3:latest')
+            mock_get.assert_not_called()
+        self.assertTrue(caps['tools'])
+        self.assertTrue(caps['vision'])
+        self.assertFalse(caps['thinking'])
+        self.assertEqual(caps['context_length'], 131072)
+        self.assertEqual(caps['quantization'], 'Q4_K_M')
+        self.assertEqual(caps['family'], 'llama')
+        self.assertFalse(is_stale(caps, now=caps['timestamp'] + 10 * 86400))
+
+    def test_resolve_capabilities_remote_fallback(self):
+        from modules.ollama.capabilities import resolve_capabilities
+        mock_client = MagicMock()
+        mock_client.show.return_value = {'details': {'family': 'custom'}, 'modelinfo': {}}
+        with patch('modules.ollama.capabilities.requests.get') as mock_get:
+            mock_get.return_value = MagicMock(status_code=200, text="tools")
+            caps = resolve_capabilities(mock_client, 'custom:latest')
+            mock_get.assert_called_once_with("https://ollama.com/library/custom", timeout=5)
+        self.assertEqual(caps['source'], 'library')
+        self.assertTrue(caps['tools'])
+        self.assertEqual(caps['family'], 'custom')
+
+        with self.settings(OLLAMA_CAPABILITIES_REMOTE_FALLBACK=False):
+            with patch('modules.ollama.capabilities.requests.get') as mock_get:
+                caps = resolve_capabilities(mock_client, 'custom:latest')
+                mock_get.assert_not_called()
+        self.assertEqual(caps['source'], 'local')
+        self.assertFalse(caps['tools'])
+
+    @patch('modules.ollama.service_status.check_http_health', return_value=False)
+    @patch('modules.ollama.module.capability_refresher')
+    @patch('modules.ollama.module.run_command')
+    @patch('ollama.Client')
+    def test_only_visible_page_is_enriched(self, mock_ollama, mock_run, mock_refresher, mock_health):
+        from modules.ollama.module import Module
+        mock_run.return_value = b"active"
+        mock_client = MagicMock()
+        mock_client.list.return_value = {'models': [
+            {'model': f'model{i}:latest', 'size': i, 'digest': f'sha-{i}'} for i in range(25)
+        ]}
+        mock_ollama.return_value = mock_client
+
+        with patch.object(Module, '_enrich_model_record', autospec=True, side_effect=Module._enrich_model_record) as mock_enrich:
+            context = Module().get_context_data(None, self.tool)
+
+        self.assertEqual(len(context['models']), 10)
+        self.assertEqual(mock_enrich.call_count, 10)
+        self.assertIn('capabilities', context['models'][0])
+        scheduled = mock_refresher.schedule.call_args[0][0]
+        self.assertEqual(len(scheduled), 10)
+
+    def test_model_list_cache_serves_stale_and_refreshes_once(self):
+        from modules.ollama import model_cache
+        fetch = MagicMock(return_value=[{'model': 'llama3:latest', 'digest': 'sha-a', 'modified_at': '2024-01-01'}])
+        self.assertEqual(model_cache.get_models(self.tool.id, fetch), fetch.return_value)
+        self.assertEqual(fetch.call_count, 1)
+
+        fingerprint = model_cache.get_fingerprint(self.tool.id)
+        self.assertEqual(fingerprint, model_cache.compute_fingerprint(fetch.return_value))
+
+        # Make the cached entry stale; concurrent viewers get it instantly and start a single refresh
+        raw_data = cache.get(model_cache._data_key(self.tool.id))
+        raw_data['timestamp'] -= 3600
+        cache.set(model_cache._data_key(self.tool.id), raw_data)
+        with patch('modules.ollama.model_cache.threading.Thread') as mock_thread:
+            for _ in range(3):
+                self.assertEqual(model_cache.get_models(self.tool.id, fetch), fetch.return_value)
+            mock_thread.assert_called_once()
+        self.assertEqual(fetch.call_count, 1)
+        model_cache._refreshing.clear()
+
+    def test_model_list_force_refresh_is_single_flight(self):
+        from modules.ollama import model_cache
+        fetch = MagicMock(return_value=[])
+        model_cache.get_models(self.tool.id, fetch)
+        cache.add(model_cache._lock_key(self.tool.id), True)
+        model_cache.get_models(self.tool.id, fetch, force_refresh=True)
+        self.assertEqual(fetch.call_count, 1)
+
+    def test_model_list_fingerprint_tracks_digest(self):
+        from modules.ollama.model_cache import compute_fingerprint
+        a = [{'model': 'llama3:latest', 'digest': 'sha-a', 'modified_at': '2024-01-01'}]
+        b = [{'model': 'llama3:latest', 'digest': 'sha-b', 'modified_at': '2024-01-01'}]
+        self.assertEqual(compute_fingerprint(a), compute_fingerprint(list(a)))
+        self.assertNotEqual(compute_fingerprint(a), compute_fingerprint(b))
+
+    def test_capability_store_ttl_lru_and_prune(self):
+        from modules.ollama.capabilities import CapabilityStore
+        store = CapabilityStore(max_entries=2)
+        self.assertEqual(store._get_ttl({'source': 'library'}), 2 * 86400)
+        store.set('sha-a', {'tools': True, 'source': 'local'})
+        store.set('sha-b', {'tools': False, 'source': 'local'})
+        store.set('sha-c', {'vision': True, 'source': 'local'})
+        # Oldest entry is evicted once the store is over capacity
+        self.assertIsNone(store.get('sha-a'))
+        self.assertEqual(set(store.get_many(['sha-a', 'sha-b', 'sha-c'])), {'sha-b', 'sha-c'})
+
+        self.assertEqual(store.prune(['sha-c'], fingerprint='fp-1'), ['sha-b'])
+        self.assertIsNone(store.get('sha-b'))
+        # Same fingerprint: nothing changed, nothing to do
+        self.assertEqual(store.prune([], fingerprint='fp-1'), [])
+        self.assertTrue(store.get('sha-c')['vision'])
+
+        # Reads count as use, so the model that was just viewed outlives an older write
+        store.set('sha-d', {'tools': True, 'source': 'local'})
+        store.get_many(['sha-c'])
+        store.set('sha-e', {'tools': True, 'source': 'local'})
+        self.assertEqual(set(store.get_many(['sha-c', 'sha-d', 'sha-e'])), {'sha-c', 'sha-e'})
+        # The index lock is taken through the shared cache, so other workers wait for it
+        self.assertIsNone(cache.get(store.lock_key))
+
+    @patch('modules.ollama.service_status.check_http_health', return_value=False)
+    @patch('modules.ollama.module.capability_refresher')
+    @patch('modules.ollama.module.run_command')
+    @patch('ollama.Client')
+    def test_legacy_capabilities_cache_removed_from_config_data(self, mock_ollama, mock_run, mock_refresher, mock_health):
+        from modules.ollama.module import Module
+        mock_run.return_value = b"active"
+        mock_client = MagicMock()
+        mock_client.list.return_value = {'models': []}
+        mock_ollama.return_value = mock_client
+        self.tool.config_data['capabilities_cache'] = {'llama3': {'tools': True}}
+        self.tool.save()
+        Module().get_context_data(None, self.tool)
+        self.tool.refresh_from_db()
+        self.assertNotIn('capabilities_cache', self.tool.config_data)
+
+    @patch('modules.ollama.service_status.requests.get')
+    @patch('modules.ollama.module.run_command')
+    def test_service_status_prefers_http_and_is_cached(self, mock_run, mock_get):
+        from modules.ollama.module import Module
+        from modules.ollama import service_status
+        module = Module()
+        mock_get.return_value = MagicMock(status_code=200)
+        service_status.refresh(module._probe_service_status)
+        for _ in range(5):
+            self.assertEqual(module.get_service_status(self.tool), 'running')
+        mock_get.assert_called_once()
+        mock_run.assert_not_called()
+
+        # A stale status is still served while the probe runs out-of-band
+        entry = cache.get(service_status.STATUS_KEY)
+        entry['timestamp'] -= 3600
+        cache.set(service_status.STATUS_KEY, entry, None)
+        with patch('modules.ollama.service_status.threading.Thread') as mock_thread:
+            self.assertEqual(module.get_service_status(self.tool), 'running')
+            self.assertEqual(module.get_service_status(self.tool), 'running')
+            mock_thread.assert_called_once()
+
+    @patch('modules.ollama.module.run_command')
+    @patch('modules.ollama.module.subprocess.check_output')
+    @patch('modules.ollama.module.subprocess.run')
+    def test_versions_memoized_until_install(self, mock_sub_run, mock_check_output, mock_run):
+        from modules.ollama.module import Module, subprocess_timings
+        module = Module()
+        mock_sub_run.return_value = MagicMock(returncode=0, stdout="ollama version is 0.15.4")
+        mock_check_output.return_value = b"v1.2.0\n"
+        for _ in range(3):
+            self.assertEqual(module.get_service_version(), "0.15.4")
+            self.assertEqual(module.version, "v1.2.0")
+        mock_sub_run.assert_called_once()
+        mock_check_output.assert_called_once()
+        self.assertIn('service_version', subprocess_timings)
+        self.assertIn('module_version', subprocess_timings)
+
+        # Completing an install invalidates the memoized values
+        self.tool.status = 'not_installed'
+        self.tool.save()
+        with patch('modules.ollama.module.threading.Thread') as mock_thread:
+            module.install(None, self.tool)
+            mock_thread.call_args[1]['target']()
+        mock_sub_run.return_value = MagicMock(returncode=0, stdout="ollama version is 0.16.0")
+        self.assertEqual(module.get_service_version(), "0.16.0")
+
+    def test_models_tab_uses_push_instead_of_polling(self):
+        from modules.ollama.module import Module
+        module = Module()
+        with patch('modules.ollama.model_events.live_updates_enabled', return_value=True):
+            models_tab = next(t for t in module.get_resource_tabs() if t['id'] == 'models')
+        self.assertNotIn('hx_auto_refresh', models_tab)
+        # Without a channel layer the socket is refused, so the tab keeps polling
+        with patch('modules.ollama.model_events.live_updates_enabled', return_value=False):
+            models_tab = next(t for t in module.get_resource_tabs() if t['id'] == 'models')
+        self.assertTrue(models_tab['hx_auto_refresh'].startswith('every 5s'))
+        routes = [str(p.pattern) for p in module.get_websocket_urls()]
+        self.assertIn('ws/ollama/models/$', routes)
+
+    def test_model_list_diff(self):
+        from modules.ollama.model_events import diff_rows, model_rows
+        old = model_rows([
+            {'model': 'llama3:latest', 'size': 1, 'digest': 'sha-a'},
+            {'model': 'mistral:latest', 'size': 2, 'digest': 'sha-b'},
+        ])
+        new = model_rows([
+            {'model': 'llama3:latest', 'size': 3, 'digest': 'sha-c'},
+            {'model': 'qwen:latest', 'size': 4, 'digest': 'sha-d'},
+        ])
+        diff = diff_rows(old, new)
+        self.assertEqual([r['model'] for r in diff['added']], ['qwen:latest'])
+        self.assertEqual(diff['removed'], ['mistral:latest'])
+        self.assertEqual([r['digest'] for r in diff['changed']], ['sha-c'])
+
+    @patch('modules.ollama.model_events.publish')
+    def test_model_list_refresh_publishes_only_on_change(self, mock_publish):
+        from modules.ollama import model_cache
+        models = [{'model': 'llama3:latest', 'digest': 'sha-a'}]
+        model_cache.refresh(self.tool.id, lambda: models)
+        mock_publish.reset_mock()
+        model_cache.refresh(self.tool.id, lambda: models)
+        mock_publish.assert_not_called()
+
+        model_cache.refresh(self.tool.id, lambda: models + [{'model': 'qwen:latest', 'digest': 'sha-b'}])
+        event = mock_publish.call_args[0][0]
+        self.assertEqual(event['type'], 'models_diff')
+        self.assertEqual([r['model'] for r in event['added']], ['qwen:latest'])
+
+    def test_pull_job_tracks_layers_and_throttles_writes(self):
+        from modules.ollama.pulls import PullJob, get_pull_progress
+        job = PullJob('mistral', interval=60)
+        with patch('modules.ollama.pulls.model_events.publish_pull_progress') as mock_publish:
+            job.start()
+            for completed in range(1, 1001):
+                job.update({'digest': 'sha-a', 'completed': completed, 'total': 1000})
+                job.update({'digest': 'sha-b', 'completed': completed, 'total': 3000})
+            job.update({'status': 'verifying sha256 digest'})
+            self.assertEqual(job.flushes, 2)
+            self.assertEqual(mock_publish.call_count, 2)
+            progress = get_pull_progress('mistral')
+            self.assertEqual(progress['status'], 'verifying sha256 digest')
+            self.assertEqual(progress['completed'], 2000)
+            self.assertEqual(progress['total'], 4000)
+            self.assertEqual(progress['progress'], 50)
+            self.assertEqual(set(progress['layers']), {'sha-a', 'sha-b'})
+            job.finish()
+        self.assertIsNone(get_pull_progress('mistral'))
+
+    def test_pull_manager_dedupes_and_cancels(self):
+        import threading
+        import time
+        from modules.ollama.pulls import PullManager, get_pulls
+        started = threading.Event()
+
+        def slow_pull(model_name, stream=True):
+            started.set()
+            for i in range(1000):
+                yield {'digest': 'sha-a', 'completed': i, 'total': 1000}
+                time.sleep(0.01)
+
+        manager = PullManager(max_workers=2)
+        with patch('ollama.Client') as mock_ollama, patch('modules.ollama.pulls.model_events.publish_pull_progress'):
+            mock_ollama.return_value.pull.side_effect = slow_pull
+            job = manager.submit(self.tool.pk, 'mistral')
+            self.assertIs(manager.submit(self.tool.pk, 'mistral'), job)
+            started.wait(2)
+            self.assertEqual([p['model'] for p in get_pulls()], ['mistral'])
+            self.assertTrue(manager.cancel('mistral'))
+            manager._executor.shutdown(wait=True)
+        self.assertLess(job.parts, 1000)
+        self.assertEqual(get_pulls(), [])
+
+    def test_pull_claims_of_dead_workers_are_released(self):
+        import time
+        from modules.ollama.pulls import INDEX_KEY, PullManager, get_pull_progress, get_pulls
+        manager = PullManager(max_workers=1)
+        # A claim left behind by a worker that died mid-pull
+        cache.set('ollama_pull_mistral', {'model': 'mistral', 'owner': 'dead', 'updated_at': time.time() - 3600}, 3600)
+        cache.set(INDEX_KEY, ['mistral'], 3600)
+        # A claim whose owner is still alive
+        cache.set('ollama_pull_llama3', {'model': 'llama3', 'owner': 'other', 'updated_at': time.time()}, 3600)
+
+        self.assertEqual(get_pulls(), [])
+        self.assertIsNone(get_pull_progress('mistral'))
+        with patch('modules.ollama.pulls.model_events.publish_pull_progress') as mock_publish:
+            self.assertFalse(manager.cancel('mistral'))
+        self.assertIsNone(cache.get('ollama_pull_mistral'))
+        mock_publish.assert_called_once_with('mistral', done=True, state='cancelled')
+
+        with patch.object(manager, '_get_executor'):
+            self.assertIsNone(manager.submit(self.tool.pk, 'llama3'))
+            manager.cancel('llama3')
+            self.assertEqual(cache.get('ollama_pull_llama3')['owner'], 'other')
+            # An abandoned claim is taken over by the next submit
+            cache.set('ollama_pull_llama3', {'model': 'llama3', 'owner': 'other', 'updated_at': time.time() - 3600}, 3600)
+            job = manager.submit(self.tool.pk, 'llama3')
+        self.assertIsNotNone(job)
+        self.assertEqual(cache.get('ollama_pull_llama3')['owner'], manager.owner)
+        # Stops the heartbeat, which would otherwise keep refreshing the claim
+        manager._jobs.clear()
+
+    @patch('modules.ollama.views.pull_manager')
+    def test_pull_model_submits_job(self, mock_manager):
+        response = self.client.post('/ollama/model/pull/', {'model_name': 'mistral'})
+        self.assertEqual(response.status_code, 302)
+        mock_manager.submit.assert_called_once_with(self.tool.pk, 'mistral')
+
+        response = self.client.post('/ollama/model/pull/cancel/', {'model_name': 'mistral'})
+        self.assertEqual(response.status_code, 302)
+        mock_manager.cancel.assert_called_once_with('mistral')
+
+    @patch('ollama.Client')
+    def test_chat_send_coalesces_frames(self, mock_ollama):
+        mock_client = MagicMock()
+        chunks = [{'message': {'content': 'tok '}, 'done': False} for _ in range(500)]
+        chunks.append({'message': {'content': ''}, 'done': True, 'prompt_eval_count': 1, 'eval_count': 500})
+        mock_client.chat.return_value = chunks
+        mock_ollama.return_value = mock_client
+
+        with self.settings(OLLAMA_STREAM_FLUSH_INTERVAL=60, OLLAMA_STREAM_FLUSH_CHARS=400):
+            response = self.client.post('/ollama/chat/send/', {'model': 'llama3', 'message': 'Hi', 'history': '[]'})
+            content = b"".join(response.streaming_content).decode()
+
+        stats = response.stream_stats
+        self.assertEqual(stats['chunks'], 500)
+        self.assertEqual(stats['flushes'], 5)
+        self.assertEqual(stats['bytes'], len(content.encode()))
+        self.assertEqual(content.count('ollamaStreamAppend("'), 5) # one append call per flush
+
+    def test_frame_buffer_merges_content_frames(self):
+        import asyncio
+        from modules.ollama.streaming import FrameBuffer
+        sent = []
+
+        async def send(text):
+            await asyncio.sleep(0.01)
+            sent.append(json.loads(text))
+
+        async def run():
+            buffer = FrameBuffer(send, flush_interval=0.02, flush_chars=1000).start()
+            await buffer.put({'type': 'start_turn', 'model': 'llama3'})
+            for i in range(100):
+                await buffer.put({'type': 'content', 'content': 'x'})
+            await buffer.put({'type': 'done'})
+            await buffer.close()
+            return buffer.stats
+
+        stats = asyncio.run(run())
+        self.assertEqual(stats['chunks'], 100)
+        self.assertLess(stats['frames'], 10)
+        self.assertEqual(sent[0]['type'], 'start_turn')
+        self.assertEqual(sent[-1]['type'], 'done')
+        self.assertEqual(''.join(f.get('content', '') for f in sent), 'x' * 100)
+
+    def test_frame_buffer_gives_up_on_slow_client(self):
+        import asyncio
+        from modules.ollama.streaming import FrameBuffer, SlowClientError
+
+        async def stuck_send(text):
+            await asyncio.sleep(10)
+
+        async def run():
+            buffer = FrameBuffer(stuck_send, flush_interval=0, flush_chars=1, max_buffer_chars=10, slow_client_timeout=0.1).start()
+            try:
+                with self.assertRaises(SlowClientError):
+                    for i in range(20):
+                        await buffer.put({'type': 'content', 'content': 'abc'})
+            finally:
+                buffer.abort()
+
+        asyncio.run(run())
+
+    @patch('ollama.AsyncClient')
+    @patch('ollama.Client')
+    def test_client_registry_pools_per_host_and_token(self, mock_ollama, mock_async_ollama):
+        import asyncio
+        from django.test import override_settings
+        from modules.ollama.clients import ClientRegistry
+        mock_ollama.side_effect = lambda **kwargs: MagicMock()
+        mock_async_ollama.side_effect = lambda **kwargs: MagicMock()
+        registry = ClientRegistry()
+
+        self.assertIs(registry.get_client(), registry.get_client())
+        self.assertIsNot(registry.get_client('token'), registry.get_client())
+        self.assertEqual(mock_ollama.call_count, 2)
+        self.assertEqual(mock_ollama.call_args.kwargs['headers'], {'Authorization': 'Bearer token'})
+        self.assertEqual(registry.stats, {'hits': 2, 'misses': 2, 'evictions': 0})
+        # Tokens share the host's connection pool
+        self.assertIs(mock_ollama.call_args_list[0].kwargs['transport'], mock_ollama.call_args_list[1].kwargs['transport'])
+        self.assertEqual(registry.pool_size(), 1)
+
+        async def use_async():
+            return registry.get_async_client() is registry.get_async_client()
+
+        # Each event loop gets its own async client
+        self.assertTrue(asyncio.run(use_async()))
+        self.assertTrue(asyncio.run(use_async()))
+        self.assertEqual(mock_async_ollama.call_count, 2)
+
+        # Closed pools are rebuilt on the next request
+        registry.close()
+        registry.get_client()
+        self.assertEqual(mock_ollama.call_count, 3)
+
+        # One client per token is kept, but only up to the cache size
+        with override_settings(OLLAMA_CLIENT_CACHE_SIZE=2):
+            for token in ['a', 'b', 'c']:
+                registry.get_client(token)
+        self.assertEqual(registry.stats['evictions'], 2)
+        self.assertEqual(registry.pool_size(), 1)
+
+    def test_chat_session_store_appends_and_evicts(self):
+        from modules.ollama.chat_sessions import ChatSessionStore
+        store = ChatSessionStore()
+        session_id, history = store.resume(self.user.pk, '', [{'role': 'user', 'content': 'First'}])
+        self.assertEqual(len(session_id), 32)
+        self.assertEqual(history, [{'role': 'user', 'content': 'First'}])
+        store.append(self.user.pk, session_id, [{'role': 'assistant', 'content': 'Reply'}])
+        self.assertEqual(store.resume(self.user.pk, session_id)[1][-1]['content'], 'Reply')
+        # Sessions are scoped to their user
+        self.assertIsNone(store.get(self.user.pk + 1, session_id))
+
+        with self.settings(OLLAMA_CHAT_SESSION_MAX_BYTES=300):
+            for i in range(10):
+                store.append(self.user.pk, session_id, [
+                    {'role': 'user', 'content': f'question {i}'},
+                    {'role': 'assistant', 'content': 'x' * 50}
+                ])
+        session = store.get(self.user.pk, session_id)
+        self.assertLessEqual(session['size'], 300)
+        self.assertEqual(session['messages'][0]['role'], 'user')
+        self.assertEqual(session['messages'][-2]['content'], 'question 9')
+
+        with self.settings(OLLAMA_CHAT_MAX_SESSIONS_PER_USER=2):
+            store.resume(self.user.pk, '')
+            store.resume(self.user.pk, '')
+        self.assertIsNone(store.get(self.user.pk, session_id))
+
+    @patch('ollama.Client')
+    def test_chat_send_keeps_history_on_server(self, mock_ollama):
+        mock_client = MagicMock()
+        mock_client.chat.side_effect = lambda **kwargs: iter([{'message': {'content': 'Response'}, 'done': True}])
+        mock_ollama.return_value = mock_client
+
+        response = self.client.post('/ollama/chat/send/', {'model': 'llama3', 'message': 'First'})
+        content = b"".join(response.streaming_content).decode()
+        self.assertNotIn('history-input', content)
+        session_id = content.split('session-id-input").value = "')[1].split('"')[0]
+
+        response = self.client.post('/ollama/chat/send/', {'model': 'llama3', 'message': 'Second', 'session_id': session_id})
+        b"".join(response.streaming_content)
+        messages = [m for m in mock_client.chat.call_args.kwargs['messages'] if m['role'] != 'system']
+        self.assertEqual([m['content'] for m in messages], ['First', 'Response', 'Second'])
+
+    def test_image_store_dedupes_resolves_and_collects(self):
+        import os
+        import tempfile
+        from modules.ollama import image_store
+        with tempfile.TemporaryDirectory() as store_dir, self.settings(OLLAMA_IMAGE_STORE_DIR=store_dir):
+            ref = image_store.put(b'image-bytes')
+            self.assertEqual(image_store.put(b'image-bytes'), ref)
+            self.assertEqual(sum(len(files) for _, _, files in os.walk(store_dir)), 1)
+
+            messages = [{'role': 'user', 'content': 'What is this?', 'image_refs': [ref]}]
+            resolved = image_store.resolve_images(messages)
+            self.assertEqual(resolved[0]['images'], ['aW1hZ2UtYnl0ZXM='])
+            self.assertNotIn('image_refs', resolved[0])
+            self.assertNotIn('images', messages[0])
+
+            with self.assertRaises(ValueError):
+                image_store.get_base64('../../etc/passwd')
+
+            self.assertEqual(image_store.collect_garbage(max_age=3600), 0)
+            old = os.path.getmtime(image_store._blob_path(ref)) - 7200
+            os.utime(image_store._blob_path(ref), (old, old))
+            # Sessions still live for the default TTL may reference it
+            self.assertEqual(image_store.collect_garbage(max_age=3600), 0)
+            with self.settings(OLLAMA_CHAT_SESSION_TTL=3600):
+                self.assertEqual(image_store.collect_garbage(max_age=3600), 1)
+
+    @patch('ollama.Client')
+    def test_chat_send_stores_image_by_reference(self, mock_ollama):
+        import tempfile
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from modules.ollama.chat_sessions import chat_sessions
+        mock_client = MagicMock()
+        mock_client.chat.return_value = [{'message': {'content': 'A cat'}, 'done': True}]
+        mock_ollama.return_value = mock_client
+
+        with tempfile.TemporaryDirectory() as store_dir, self.settings(OLLAMA_IMAGE_STORE_DIR=store_dir):
+            attachment = SimpleUploadedFile('cat.png', b'image-bytes', content_type='image/png')
+            response = self.client.post('/ollama/chat/send/', {'model': 'llava', 'message': 'What is this?', 'attachment': attachment})
+            content = b"".join(response.streaming_content).decode()
+
+        sent = mock_client.chat.call_args.kwargs['messages'][-1]
+        self.assertEqual(sent['images'], ['aW1hZ2UtYnl0ZXM='])
+        session_id = content.split('session-id-input").value = "')[1].split('"')[0]
+        stored = chat_sessions.get_messages(self.user.pk, session_id)
+        self.assertEqual(len(stored[0]['image_refs']), 1)
+        self.assertNotIn('images', stored[0])
+
+    def test_context_window_fits_history_into_budget(self):
+        from modules.ollama.context_window import TokenEstimator, fit_messages, get_budget, token_estimator
+        messages = [{'role': 'system', 'content': 'Be brief.'}]
+        for i in range(20):
+            messages += [{'role': 'user', 'content': f'{i} ' + 'q' * 400}, {'role': 'assistant', 'content': 'a' * 400}]
+        messages.append({'role': 'user', 'content': 'Latest question'})
+
+        fitted = fit_messages(messages, 2048)
+        self.assertEqual(fitted[0]['content'], 'Be brief.')
+        self.assertEqual(fitted[1]['role'], 'user')
+        self.assertEqual(fitted[-1]['content'], 'Latest question')
+        self.assertLessEqual(sum(token_estimator.estimate(m) for m in fitted), get_budget(2048))
+        self.assertLess(len(fitted), len(messages))
+        # The next turn only estimates the messages it has not seen yet
+        misses = token_estimator.stats['misses']
+        fit_messages(messages + [{'role': 'assistant', 'content': 'Answer'}, {'role': 'user', 'content': 'Next'}], 2048)
+        self.assertEqual(token_estimator.stats['misses'] - misses, 2)
+
+        # The newest user message is always kept
+        huge = [{'role': 'user', 'content': 'x' * 100000}]
+        self.assertEqual(fit_messages(huge, 2048), huge)
+        self.assertEqual(TokenEstimator().count({'role': 'user', 'content': '', 'image_refs': ['a']}), 4 + 768)
+
+    def test_context_window_summarizes_incrementally(self):
+        from modules.ollama.context_window import fit_messages
+        transcripts = []
+
+        def summarizer(transcript):
+            transcripts.append(transcript)
+            return f'summary {len(transcripts)}'
+
+        messages = []
+        for i in range(20):
+            messages += [{'role': 'user', 'content': f'{i} ' + 'q' * 400}, {'role': 'assistant', 'content': 'a' * 400}]
+        fitted = fit_messages(messages + [{'role': 'user', 'content': 'Now'}], 2048, 'summarize', summarizer=summarizer)
+        self.assertEqual(fitted[0]['role'], 'system')
+        self.assertIn('summary 1', fitted[0]['content'])
+        self.assertEqual(fitted[-1]['content'], 'Now')
+
+        messages += [{'role': 'user', 'content': 'Now'}, {'role': 'assistant', 'content': 'a' * 400}]
+        fit_messages(messages + [{'role': 'user', 'content': 'Then'}], 2048, 'summarize', summarizer=summarizer)
+        self.assertEqual(len(transcripts), 2)
+        self.assertTrue(transcripts[1].startswith('Summary so far: summary 1'))
+
+    @patch('ollama.Client')
+    def test_chat_send_summarizes_only_once_admitted(self, mock_ollama):
+        from modules.ollama.admission import admission
+        history = []
+        for i in range(20):
+            history += [{'role': 'user', 'content': f'{i} ' + 'q' * 400}, {'role': 'assistant', 'content': 'a' * 400}]
+        active_during_summary = []
+
+        def chat(**kwargs):
+            if kwargs.get('stream') is False:
+                active_during_summary.append(admission.metrics()['active'])
+                return {'message': {'content': 'earlier turns'}}
+            return [{'message': {'content': 'Hi'}, 'done': True}]
+
+        mock_client = MagicMock()
+        mock_client.chat.side_effect = chat
+        mock_ollama.return_value = mock_client
+        response = self.client.post('/ollama/chat/send/', {
+            'model': 'llama3', 'message': 'Now', 'history': json.dumps(history),
+            'num_ctx': '2048', 'context_strategy': 'summarize'
+        })
+        # Nothing reaches the model before the request holds a slot
+        mock_client.chat.assert_not_called()
+        content = b"".join(response.streaming_content).decode()
+        self.assertIn('Hi', content)
+        self.assertEqual(active_during_summary, [1])
+        messages = mock_client.chat.call_args_list[-1].kwargs['messages']
+        self.assertTrue(any(m['content'].endswith('earlier turns') for m in messages if m['role'] == 'system'))
+        self.assertEqual(messages[-1]['content'], 'Now')
+
+    @patch('modules.ollama.views.warm_pool')
+    def test_pin_and_preload_model(self, mock_pool):
+        from modules.ollama.warm_pool import get_pins, keep_alive_for
+        response = self.client.post('/ollama/model/pin/', {'model_name': 'llama3:latest', 'keep_alive': '-1'})
+        self.assertEqual(response.status_code, 302)
+        self.tool.refresh_from_db()
+        self.assertEqual(self.tool.config_data['warm_pool'], {'llama3:latest': '-1'})
+        self.assertEqual(keep_alive_for('llama3:latest'), -1)
+        mock_pool.preload.assert_called_once_with('llama3:latest', -1, reason='pin', dedupe=False)
+
+        response = self.client.post('/ollama/model/pin/', {'model_name': 'llama3:latest', 'keep_alive': 'soon'})
+        self.assertEqual(response.status_code, 400)
+
+        mock_pool.preload.return_value = True
+        response = self.client.post('/ollama/model/preload/', {'model_name': 'llama3:latest'})
+        self.assertEqual(response.json(), {'queued': True})
+        mock_pool.preload.assert_called_with('llama3:latest', -1)
+
+        self.client.post('/ollama/model/pin/', {'model_name': 'llama3:latest', 'keep_alive': ''})
+        self.assertEqual(get_pins(), {})
+        mock_pool.release.assert_called_once_with('llama3:latest')
+
+    def test_warm_pool_reloads_evicted_pins(self):
+        from modules.ollama.warm_pool import WarmPool, get_running, get_status, set_pin
+        set_pin(self.tool, 'llama3:latest', '1h')
+        set_pin(self.tool, 'mistral:latest', '-1')
+        pool = WarmPool(max_workers=1)
+        with patch('ollama.Client') as mock_ollama:
+            mock_ollama.return_value.ps.return_value = {'models': [{'model': 'llama3:latest'}]}
+            mock_ollama.return_value.generate.return_value = {'load_duration': 1500000000}
+            self.assertEqual(pool.reconcile(), ['mistral:latest'])
+            # A second reconcile while the load is deduped does not queue it again
+            self.assertEqual(pool.reconcile(), [])
+            pool._executor.shutdown(wait=True)
+            mock_ollama.return_value.generate.assert_called_once_with(model='mistral:latest', prompt='', keep_alive=-1)
+        self.assertEqual(get_running(), ['llama3:latest'])
+        self.assertEqual(get_status()['mistral:latest']['daemon_load_ms'], 1500)
+
+    def test_warm_pool_release_only_touches_loaded_models(self):
+        from modules.ollama.warm_pool import WarmPool
+        pool = WarmPool(max_workers=1)
+        with patch('ollama.Client') as mock_ollama:
+            mock_ollama.return_value.ps.return_value = {'models': [{'model': 'llama3:latest'}]}
+            # Unpinning a model that is not loaded must not load it
+            self.assertFalse(pool._release('mistral:latest'))
+            self.assertTrue(pool._release('llama3:latest'))
+            pool._executor.shutdown(wait=True)
+            mock_ollama.return_value.generate.assert_called_once_with(model='llama3:latest', prompt='', keep_alive=None)
+
+    @patch('ollama.Client')
+    def test_chat_send_keeps_pinned_model_alive(self, mock_ollama):
+        from modules.ollama.warm_pool import set_pin
+        set_pin(self.tool, 'llama3', '24h')
+        mock_client = MagicMock()
+        mock_client.chat.return_value = [{'message': {'content': 'Hi'}, 'done': True}]
+        mock_ollama.return_value = mock_client
+        response = self.client.post('/ollama/chat/send/', {'model': 'llama3', 'message': 'Hi'})
+        b"".join(response.streaming_content)
+        self.assertEqual(mock_client.chat.call_args.kwargs['keep_alive'], '24h')
+
+    def test_admission_limits_and_round_robin(self):
+        from modules.ollama.admission import AdmissionController, QueueFull
+        controller = AdmissionController(max_concurrent=2, max_per_model=1, policy='round_robin', max_queue=4)
+        first = controller.enqueue('llama3', 'alice')
+        other_model = controller.enqueue('mistral', 'alice')
+        self.assertTrue(first.admitted and other_model.admitted)
+
+        waiting = [controller.enqueue('llama3', user) for user in ['alice', 'alice', 'bob', 'carol']]
+        # bob and carol have not been served yet, so they go ahead of alice's second and third requests
+        self.assertEqual([controller.position(t) for t in waiting], [3, 4, 1, 2])
+        with self.assertRaises(QueueFull):
+            controller.enqueue('llama3', 'dave')
+
+        controller.release(first)
+        self.assertTrue(waiting[2].admitted)
+        metrics = controller.metrics()
+        self.assertEqual(metrics['depth'], 3)
+        self.assertEqual(metrics['active_per_model'], {'llama3': 1, 'mistral': 1})
+        self.assertEqual(metrics['rejected'], 1)
+
+        # Releasing a waiting ticket just removes it from the queue
+        controller.release(waiting[0])
+        self.assertEqual(controller.metrics()['depth'], 2)
+
+    @patch('ollama.Client')
+    def test_chat_send_reports_queue_position(self, mock_ollama):
+        import threading
+        from modules.ollama import admission as admission_module
+        mock_client = MagicMock()
+        mock_client.chat.return_value = [{'message': {'content': 'Hi'}, 'done': True}]
+        mock_ollama.return_value = mock_client
+
+        controller = admission_module.AdmissionController(max_concurrent=1)
+        busy = controller.enqueue('llama3', 'someone-else')
+        threading.Timer(0.3, controller.release, [busy]).start()
+        with patch('modules.ollama.views.admission', controller):
+            response = self.client.post('/ollama/chat/send/', {'model': 'llama3', 'message': 'Hi'})
+            content = b"".join(response.streaming_content).decode()
+        self.assertIn('Waiting for a free model slot (position 1)', content)
+        self.assertIn('ollama-queue-notice"); if(notice) notice.remove()', content)
+        self.assertIn('Hi', content)
+        self.assertEqual(controller.metrics()['active'], 0)
+        self.assertGreater(controller.stats['wait_seconds_max'], 0.2)
+
+    @patch('ollama.Client')
+    def test_chat_send_replays_deterministic_responses(self, mock_ollama):
+        from django.test import override_settings
+        from modules.ollama import model_cache
+        from modules.ollama.response_cache import response_cache
+        mock_client = MagicMock()
+        mock_client.chat.side_effect = lambda **kwargs: iter([
+            {'message': {'content': 'Hel'}, 'done': False},
+            {'message': {'content': 'lo'}, 'done': True, 'eval_count': 2}
+        ])
+        mock_ollama.return_value = mock_client
+        model_cache.get_models(self.tool.id, lambda: [{'model': 'llama3:latest', 'digest': 'sha-a', 'modified_at': '2024-01-01'}])
+        hits = response_cache.stats['hits']
+
+        with override_settings(OLLAMA_RESPONSE_CACHE=True):
+            for _ in range(2):
+                response = self.client.post('/ollama/chat/send/', {'model': 'llama3', 'message': 'Hi', 'temperature': '0'})
+                content = b"".join(response.streaming_content).decode()
+                self.assertIn('Hel', content)
+                self.assertIn('lo', content)
+            self.assertEqual(mock_client.chat.call_count, 1)
+            self.assertEqual(response_cache.stats['hits'], hits + 1)
+
+            # Sampled requests are never cached
+            response = self.client.post('/ollama/chat/send/', {'model': 'llama3', 'message': 'Hi', 'temperature': '0.7'})
+            b"".join(response.streaming_content)
+            self.assertEqual(mock_client.chat.call_count, 2)
+
+    def test_response_cache_invalidates_on_digest_and_evicts(self):
+        from django.test import override_settings
+        from modules.ollama.response_cache import ResponseCache, make_key
+        store = ResponseCache()
+        entry = {'chunks': [[0, '', 'Hello']], 'prompt_eval_count': 1, 'eval_count': 1}
+        options = {'temperature': 0}
+        with override_settings(OLLAMA_RESPONSE_CACHE=True, OLLAMA_RESPONSE_CACHE_MAX_ENTRIES=2):
+            old = make_key('llama3', 'sha-a', [{'role': 'user', 'content': 'a'}], None, options)
+            self.assertIsNone(make_key('llama3', None, [], None, options))
+            store.set(old, 'llama3', 'sha-a', entry)
+            self.assertEqual(store.get(old), entry)
+
+            # A pulled update changes the digest and drops what the old version recorded
+            new = make_key('llama3', 'sha-b', [{'role': 'user', 'content': 'a'}], None, options)
+            self.assertNotEqual(old, new)
+            store.set(new, 'llama3', 'sha-b', entry)
+            self.assertIsNone(store.get(old))
+            self.assertEqual(store.stats['invalidations'], 1)
+
+            keys = [make_key('mistral', 'sha-m', [{'role': 'user', 'content': str(i)}], None, options) for i in range(2)]
+            for key in keys:
+                store.set(key, 'mistral', 'sha-m', entry)
+            self.assertIsNone(store.get(new))
+            self.assertEqual(store.stats['evictions'], 1)
+
+    def test_tool_runner_caches_code_and_enforces_timeout(self):
+        from modules.ollama.tool_runner import ToolRunner
+        runner = ToolRunner(max_workers=1, timeout=1, memory_limit_mb=0)
+        try:
+            tool_def = {'id': '1', 'updated_at': 1, 'python_code': 'result = args["a"] + 1'}
+            first = runner.run(tool_def, 'add', {'a': 1})
+            second = runner.run(tool_def, 'add', {'a': 2})
+            self.assertEqual((first['result'], second['result']), ('2', '3'))
+            self.assertEqual((first['cached'], second['cached']), (False, True))
+            self.assertIn('duration_ms', second)
+
+            # Saving the tool changes updated_at, which compiles the new source
+            changed = runner.run(dict(tool_def, updated_at=2, python_code='result = args["a"] * 10'), 'add', {'a': 2})
+            self.assertEqual(changed['result'], '20')
+
+            looping = runner.run({'id': '2', 'python_code': 'while True: pass'}, 'loop', {})
+            self.assertTrue(looping['timed_out'])
+            self.assertIn('timed out after 1s', looping['result'])
+            # The worker survives the timeout
+            self.assertEqual(runner.run(tool_def, 'add', {'a': 3})['result'], '4')
+            self.assertEqual(runner.stats['timeouts'], 1)
+            self.assertEqual(runner.run(None, 'missing', {})['result'], "Tool execution failed or not implemented.")
+        finally:
+            runner.shutdown()
+
+    def test_tool_runner_limits_memory_of_fresh_workers(self):
+        from modules.ollama.tool_runner import ToolRunner
+        runner = ToolRunner(max_workers=1, timeout=5, memory_limit_mb=64)
+        try:
+            # The cap applies to what the tool allocates, not to the web process the pool was started from
+            self.assertEqual(runner.run({'id': '1', 'python_code': 'result = len(bytearray(16 * 1024 * 1024))'}, 'small', {})['result'], str(16 * 1024 * 1024))
+            self.assertIn('MemoryError', runner.run({'id': '2', 'python_code': 'result = len(bytearray(256 * 1024 * 1024))'}, 'large', {})['result'])
+        finally:
+            runner.shutdown()
+
+    @patch('ollama.Client')
+    def test_chat_send_runs_tool_calls_concurrently(self, mock_ollama):
+        import time
+        from modules.ollama.tool_runner import tool_runner
+        self.tool.config_data['ollama_tools'] = [
+            {'id': '1', 'name': 'slow', 'description': '', 'parameters': {}, 'python_code': 'import time\ntime.sleep(0.5)\nresult = "slow done"'},
+            {'id': '2', 'name': 'fast', 'description': '', 'parameters': {}, 'python_code': 'result = "fast done"'}
+        ]
+        self.tool.save()
+        mock_client = MagicMock()
+        mock_client.chat.side_effect = [
+            [{'message': {'content': '', 'tool_calls': [
+                {'function': {'name': 'slow', 'arguments': {}}},
+                {'function': {'name': 'fast', 'arguments': {}}}
+            ]}, 'done': True}],
+            [{'message': {'content': 'Both done'}, 'done': True}]
+        ]
+        mock_ollama.return_value = mock_client
+
+        start = time.monotonic()
+        try:
+            response = self.client.post('/ollama/chat/send/', {'model': 'llama3', 'message': 'Hi', 'selected_tools': ['1', '2']})
+            content = b"".join(response.streaming_content).decode()
+        finally:
+            tool_runner.shutdown()
+        # The fast result is streamed first, but the model gets the replies in call order
+        self.assertLess(content.index('fast done'), content.index('slow done'))
+        tool_messages = [m['content'] for m in mock_client.chat.call_args_list[1].kwargs['messages'] if m['role'] == 'tool']
+        self.assertEqual(tool_messages, ['slow done', 'fast done'])
+        self.assertIn('Both done', content)
+        self.assertLess(time.monotonic() - start, 5)
+
+    @patch('ollama.Client')
+    def test_chat_send_stores_pydantic_tool_calls(self, mock_ollama):
+        from ollama import ChatResponse, Message
+        from modules.ollama.chat_sessions import chat_sessions
+        self.tool.config_data['ollama_tools'] = [{'id': '1', 'name': 'lookup', 'description': '', 'parameters': {}}]
+        self.tool.save()
+        call = Message.ToolCall(function=Message.ToolCall.Function(name='lookup', arguments={'q': 'x'}))
+        mock_ollama.return_value.chat.side_effect = [
+            [ChatResponse(model='llama3', done=True, message=Message(role='assistant', content='', tool_calls=[call]))],
+            [ChatResponse(model='llama3', done=True, message=Message(role='assistant', content='Found it'))]
+        ]
+        response = self.client.post('/ollama/chat/send/', {'model': 'llama3', 'message': 'Hi', 'selected_tools': ['1']})
+        content = b"".join(response.streaming_content).decode()
+        # The turn completes instead of failing to serialize the tool calls
+        self.assertIn('Found it', content)
+        session_id = content.split('session-id-input").value = "')[1].split('"')[0]
+        messages = chat_sessions.get_messages(self.user.pk, session_id)
+        self.assertEqual(messages[1]['tool_calls'], [{'function': {'name': 'lookup', 'arguments': {'q': 'x'}}}])
+        json.dumps(messages)
+
+    def test_tool_registry_reloads_only_after_save_or_delete(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from modules.ollama.tool_registry import tool_registry
+        tool_registry.clear()
+        self.client.post('/ollama/tools/save/', {'tool_id': '1', 'name': 'echo', 'description': 'Echo', 'parameters': '{}', 'python_code': 'result = args'})
+        tools = tool_registry.get()
+        self.assertEqual(tools.find('echo')['id'], '1')
+        self.assertEqual(tools.select(['1', 'missing']), [{'type': 'function', 'function': {'name': 'echo', 'description': 'Echo', 'parameters': {}}}])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertIs(tool_registry.get(), tools)
+        self.assertEqual(len(queries), 0)
+
+        self.client.post('/ollama/tools/delete/', {'tool_id': '1'})
+        self.assertIsNone(tool_registry.get().find('echo'))
+
+    @patch('ollama.Client')
+    def test_chat_send_stops_on_cancel(self, mock_ollama):
+        from modules.ollama.cancellation import chat_cancels
+        closed = []
+
+        def stream():
+            try:
+                yield {'message': {'content': 'First part'}, 'done': False}
+                chat_cancels.cancel(self.user.pk, 'req-1')
+                yield {'message': {'content': ' never shown'}, 'done': False}
+                yield {'message': {'content': ''}, 'done': True, 'prompt_eval_count': 5, 'eval_count': 2}
+            finally:
+                closed.append(True)
+
+        mock_client = MagicMock()
+        mock_client.chat.return_value = stream()
+        mock_ollama.return_value = mock_client
+        response = self.client.post('/ollama/chat/send/', {'model': 'llama3', 'message': 'Hi', 'request_id': 'req-1'})
+        self.assertEqual(response['X-Request-Id'], 'req-1')
+        content = b"".join(response.streaming_content).decode()
+        self.assertIn('First part', content)
+        self.assertNotIn('never shown', content)
+        self.assertIn('(stopped)', content)
+        self.assertEqual(closed, [True])
+
+        # The partial reply is kept, so the next turn sees it
+        session_id = content.split('document.getElementById("session-id-input").value = "')[1].split('"')[0]
+        from modules.ollama.chat_sessions import chat_sessions
+        self.assertEqual(chat_sessions.get_messages(self.user.pk, session_id)[-1]['content'], 'First part')
+
+        response = self.client.post('/ollama/chat/cancel/', {'request_id': 'unknown'})
+        self.assertEqual(response.json(), {'request_id': 'unknown', 'cancelled': True, 'local': False})
+
+    def test_tool_runner_interrupts_cancelled_calls(self):
+        import threading
+        import time
+        from modules.ollama.cancellation import CancelToken
+        from modules.ollama.tool_runner import ToolRunner
+        runner = ToolRunner(max_workers=1, timeout=5, memory_limit_mb=0)
+        cancel = CancelToken('req-2')
+        threading.Timer(0.2, cancel.cancel).start()
+        start = time.monotonic()
+        try:
+            outcome = runner.run({'id': '1', 'python_code': 'import time\ntime.sleep(3)'}, 'sleep', {}, cancel)
+            # The only worker was freed by the cancel, not by the tool's timeout or a pool restart
+            after = runner.run({'id': '2', 'python_code': 'result = "free"'}, 'next', {})
+        finally:
+            runner.shutdown()
+        self.assertTrue(outcome['cancelled'])
+        self.assertEqual(after['result'], 'free')
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual((runner.stats['cancelled'], runner.stats['restarts']), (1, 0))
+
+    def test_tool_runner_closing_run_many_interrupts_calls(self):
+        import time
+        from modules.ollama.cancellation import CancelToken
+        from modules.ollama.tool_runner import ToolRunner
+        runner = ToolRunner(max_workers=2, timeout=5, memory_limit_mb=0)
+        cancel = CancelToken('req-4')
+        calls = [
+            ({'id': '1', 'python_code': 'result = "fast"'}, 'fast', {}),
+            ({'id': '2', 'python_code': 'import time\ntime.sleep(3)'}, 'slow', {}),
+        ]
+        try:
+            results = runner.run_many(calls, cancel)
+            self.assertEqual(next(results)[1]['result'], 'fast')
+            # What a disconnected client does to the response generator
+            start = time.monotonic()
+            results.close()
+            self.assertLess(time.monotonic() - start, 1)
+            self.assertTrue(cancel.is_set())
+        finally:
+            runner.shutdown()
+
+    @patch('ollama.Client')
+    def test_chat_send_stops_during_prompt_evaluation(self, mock_ollama):
+        import threading
+        import time
+        from modules.ollama.cancellation import chat_cancels
+
+        def stream():
+            # The daemon sends nothing until the prompt is evaluated
+            time.sleep(3)
+            yield {'message': {'content': 'late'}, 'done': True, 'prompt_eval_count': 5, 'eval_count': 1}
+
+        def chat(**kwargs):
+            threading.Timer(0.3, chat_cancels.cancel, (self.user.pk, 'req-3')).start()
+            return stream()
+
+        mock_ollama.return_value.chat.side_effect = chat
+        start = time.monotonic()
+        response = self.client.post('/ollama/chat/send/', {'model': 'llama3', 'message': 'Hi', 'request_id': 'req-3'})
+        content = b"".join(response.streaming_content).decode()
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertNotIn('late', content)
+        self.assertIn('(stopped)', content)
+
+    async def test_chat_send_async_streams_without_a_thread_each(self):
+        import asyncio
+        import threading
+        import time
+        from unittest.mock import AsyncMock
+        from asgiref.sync import sync_to_async
+        from django.test import override_settings
+        streams = 10
+        thread_counts = []
+
+        async def stream():
+            for word in ['Hello', ' there']:
+                thread_counts.append(threading.active_count())
+                await asyncio.sleep(0.2)
+                yield {'message': {'content': word}, 'done': False}
+            yield {'message': {'content': ''}, 'done': True, 'prompt_eval_count': 3, 'eval_count': 2}
+
+        async def send():
+            response = await self.async_client.post('/ollama/chat/send/async/', {'model': 'llama3', 'message': 'Hi'})
+            return b"".join([chunk async for chunk in response.streaming_content]).decode()
+
+        await sync_to_async(self.async_client.force_login)(self.user)
+        baseline = threading.active_count()
+        with patch('ollama.AsyncClient') as mock_async_ollama, \
+                override_settings(OLLAMA_CHAT_MAX_CONCURRENT=streams, OLLAMA_CHAT_MAX_CONCURRENT_PER_MODEL=streams):
+            mock_async_ollama.return_value.chat = AsyncMock(side_effect=lambda **kwargs: stream())
+            start = time.monotonic()
+            contents = await asyncio.gather(*(send() for _ in range(streams)))
+            elapsed = time.monotonic() - start
+
+        for content in contents:
+            self.assertIn('ollamaStreamAppend("Hello', content)
+            self.assertIn('session-id-input', content)
+        # All streams overlapped, and none of them needed a thread of its own while waiting on Ollama
+        self.assertLess(elapsed, streams * 0.4 / 2)
+        self.assertLess(max(thread_counts) - baseline, streams)
+
+    @patch('ollama.Client')
+    def test_chat_send_reports_timing_and_metrics(self, mock_ollama):
+        from django.test import override_settings
+        from modules.ollama.metrics import chat_metrics
+        chat_metrics.clear()
+        mock_ollama.return_value.chat.return_value = [
+            {'message': {'content': 'Hello'}, 'done': False},
+            {'message': {'content': ''}, 'done': True, 'prompt_eval_count': 10, 'eval_count': 20,
+             'total_duration': 2_000_000_000, 'load_duration': 1_000_000_000,
+             'prompt_eval_duration': 250_000_000, 'eval_duration': 500_000_000}
+        ]
+        response = self.client.post('/ollama/chat/send/', {'model': 'llama3', 'message': 'Hi'})
+        content = b"".join(response.streaming_content).decode()
+        self.assertIn('40.0 tok/s', content)
+
+        response = self.client.get('/ollama/metrics/')
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = response.content.decode()
+        self.assertIn('ollama_chat_requests_total{model="llama3"} 1', text)
+        self.assertIn('ollama_chat_generation_tokens_per_second{model="llama3"} 40.0', text)
+        self.assertIn('ollama_chat_prompt_tokens_per_second{model="llama3"} 40.0', text)
+        self.assertIn('ollama_model_cold_loads_total{model="llama3"} 1', text)
+        self.assertIn('# TYPE ollama_admission_queue_depth gauge', text)
+        self.assertIn('ollama_stream_bytes_total{transport="http"}', text)
+
+        # Without a token the endpoint needs an admin session
+        response = Client().get('/ollama/metrics/')
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn(b'ollama_chat_requests_total', response.content)
+
+        # Scrapers authenticate with the configured token instead of a session
+        with override_settings(OLLAMA_METRICS_TOKEN='secret'):
+            self.assertEqual(Client().get('/ollama/metrics/').status_code, 401)
+            response = Client().get('/ollama/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
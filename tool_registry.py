@@ -0,0 +1,88 @@
+import logging
+import threading
+import uuid
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# Changed by every save or delete of a tool; workers reload their index when it differs
+VERSION_KEY = 'ollama_tools_version'
+
+
+def api_schema(tool_def):
+    return {
+        'type': 'function',
+        'function': {
+            'name': tool_def['name'],
+            'description': tool_def['description'],
+            'parameters': tool_def['parameters']
+        }
+    }
+
+
+class ToolIndex:
+    """The configured tools of one version, indexed by id and name with API schemas prebuilt."""
+
+    def __init__(self, tools, version=None):
+        self.tools = tools
+        self.version = version
+        self.by_id = {}
+        self.by_name = {}
+        for t in tools:
+            self.by_id.setdefault(t['id'], t)
+            # Like the former linear scan, the first tool with a name wins
+            self.by_name.setdefault(t['name'], t)
+        self.schemas = {t['id']: api_schema(t) for t in tools}
+
+    def select(self, tool_ids):
+        # Schemas for the selected tools, in configuration order
+        tool_ids = set(tool_ids)
+        return [self.schemas[t['id']] for t in self.tools if t['id'] in tool_ids]
+
+    def find(self, name):
+        return self.by_name.get(name)
+
+
+class ToolRegistry:
+    """Per-process cache of the tool index, validated against a shared version key."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self.stats = {'hits': 0, 'reloads': 0}
+
+    def _current_version(self):
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            # First use or a cleared cache: agree on a version so every worker loads once
+            cache.add(VERSION_KEY, uuid.uuid4().hex, None)
+            version = cache.get(VERSION_KEY)
+        return version
+
+    def get(self):
+        version = self._current_version()
+        index = self._index
+        if index is not None and version is not None and index.version == version:
+            self.stats['hits'] += 1
+            return index
+        with self._lock:
+            if self._index is not None and version is not None and self._index.version == version:
+                self.stats['hits'] += 1
+                return self._index
+            from core.models import Tool
+            tool = Tool.objects.filter(name='ollama').first()
+            tools = tool.config_data.get('ollama_tools', []) if tool else []
+            self._index = ToolIndex(tools, version)
+            self.stats['reloads'] += 1
+            logger.debug(f"Loaded {len(tools)} Ollama tools (version {version})")
+            return self._index
+
+    def invalidate(self):
+        cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+
+    def clear(self):
+        with self._lock:
+            self._index = None
+
+
+tool_registry = ToolRegistry()
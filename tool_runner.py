@@ -0,0 +1,341 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = 4
+# Tool calls from one model turn that may run at the same time
+TOOL_CONCURRENCY = 4
+TOOL_TIMEOUT = 30
+# Address space each tool may add on top of its worker's fresh interpreter; 0 disables the limit
+MEMORY_LIMIT_MB = 1024
+# Extra time the parent waits before it assumes the worker is stuck outside Python code
+TIMEOUT_GRACE = 2
+COMPILE_CACHE_SIZE = 256
+# How often a waiting call checks whether its chat was cancelled
+CANCEL_POLL_INTERVAL = 0.1
+# Recently cancelled call ids shared with the workers
+CANCEL_SLOTS = 64
+NO_RESULT = 'Success (no result returned)'
+
+
+class ToolTimeout(Exception):
+    pass
+
+
+class ToolCancelled(Exception):
+    pass
+
+
+# Compiled tool code per worker process, keyed by tool id and version
+_compiled = OrderedDict()
+# Id of the call this worker is running, and the shared ids of cancelled calls
+_current_call = 0
+_cancelled_calls = None
+
+
+def _on_cancel(signum, frame):
+    # Checked again here: the call may have finished since the watcher sent the signal
+    if _current_call and _current_call in _cancelled_calls[:]:
+        raise ToolCancelled()
+
+
+def _watch_cancels():
+    main_thread = threading.main_thread().ident
+    while True:
+        time.sleep(CANCEL_POLL_INTERVAL)
+        if _current_call and _current_call in _cancelled_calls[:]:
+            signal.pthread_kill(main_thread, signal.SIGUSR1)
+
+
+def _address_space():
+    # Current virtual size of this process, where /proc is available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _init_worker(memory_limit_mb, cancelled_calls=None):
+    global _cancelled_calls
+    if cancelled_calls is not None and hasattr(signal, 'pthread_kill'):
+        # Running calls are interrupted like a timeout when their chat is stopped
+        _cancelled_calls = cancelled_calls
+        signal.signal(signal.SIGUSR1, _on_cancel)
+        threading.Thread(target=_watch_cancels, daemon=True).start()
+    if not memory_limit_mb:
+        return
+    try:
+        import resource
+        limit = _address_space() + memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError) as e:
+        logger.warning(f"Could not limit Ollama tool worker memory: {e}")
+
+
+def _on_alarm(signum, frame):
+    raise ToolTimeout()
+
+
+def _get_code(tool_id, version, source):
+    key = (tool_id, version)
+    code = _compiled.get(key)
+    if code is not None:
+        _compiled.move_to_end(key)
+        return code, True
+    code = compile(source, f'<ollama tool {tool_id}>', 'exec')
+    _compiled[key] = code
+    while len(_compiled) > COMPILE_CACHE_SIZE:
+        _compiled.popitem(last=False)
+    return code, False
+
+
+def _execute(call_id, tool_id, version, source, args, timeout):
+    # Runs in a worker process; everything returned must be picklable
+    global _current_call
+    start = time.monotonic()
+    cached = False
+    timed_out = cancelled = False
+    # Tools stuck in Python code are interrupted here, so the worker survives the timeout
+    use_alarm = hasattr(signal, 'setitimer')
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    _current_call = call_id
+    try:
+        code, cached = _get_code(tool_id, version, source)
+        exec_globals = {'args': args, 'result': None}
+        exec(code, exec_globals)
+        result = str(exec_globals.get('result', NO_RESULT))
+        error = False
+    except ToolTimeout:
+        result = f"Error executing tool: timed out after {timeout}s"
+        error = timed_out = True
+    except ToolCancelled:
+        result = "Tool call cancelled"
+        error = cancelled = True
+    except BaseException as e:
+        result = f"Error executing tool: {str(e) or type(e).__name__}"
+        error = True
+    finally:
+        _current_call = 0
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    return {
+        'result': result,
+        'error': error,
+        'timed_out': timed_out,
+        'cancelled': cancelled,
+        'cached': cached,
+        'exec_ms': int((time.monotonic() - start) * 1000)
+    }
+
+
+def _mp_context():
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(method)
+
+
+def tool_version(tool_def):
+    # Tools saved before updated_at existed are versioned by their source
+    if tool_def.get('updated_at'):
+        return str(tool_def['updated_at'])
+    return hashlib.sha1(tool_def.get('python_code', '').encode()).hexdigest()
+
+
+class ToolRunner:
+    """Executes user-defined Python tools in worker processes with per-call timeouts."""
+
+    def __init__(self, max_workers=None, timeout=None, memory_limit_mb=None):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self._executor = None
+        self._cancelled_calls = None
+        self._cancel_slot = 0
+        self._call_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.stats = {
+            'calls': 0, 'errors': 0, 'timeouts': 0, 'cancelled': 0, 'restarts': 0,
+            'compile_hits': 0, 'compile_misses': 0, 'duration_ms_total': 0
+        }
+
+    def _get_timeout(self):
+        return self.timeout or getattr(settings, 'OLLAMA_TOOL_TIMEOUT', TOOL_TIMEOUT)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                max_workers = self.max_workers or getattr(settings, 'OLLAMA_TOOL_WORKERS', MAX_WORKERS)
+                memory_limit_mb = self.memory_limit_mb
+                if memory_limit_mb is None:
+                    memory_limit_mb = getattr(settings, 'OLLAMA_TOOL_MEMORY_LIMIT_MB', MEMORY_LIMIT_MB)
+                # Forking the threaded web process could copy locks held by other threads into the child
+                context = _mp_context()
+                self._cancelled_calls = context.Array('q', CANCEL_SLOTS)
+                self._cancel_slot = 0
+                self._executor = ProcessPoolExecutor(
+                    max_workers=max_workers, mp_context=context,
+                    initializer=_init_worker, initargs=(memory_limit_mb, self._cancelled_calls)
+                )
+            return self._executor
+
+    def _restart(self, executor):
+        # A worker that ignored the alarm cannot be reclaimed individually; the pool is replaced
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+            self.stats['restarts'] += 1
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _interrupt(self, executor, future, call_id):
+        # Stops a call that already runs; the worker raises ToolCancelled inside the tool
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._cancelled_calls[self._cancel_slot % CANCEL_SLOTS] = call_id
+            self._cancel_slot += 1
+        try:
+            future.result(timeout=CANCEL_POLL_INTERVAL + TIMEOUT_GRACE)
+        except FutureTimeoutError:
+            logger.warning(f"Ollama tool call {call_id} did not stop when cancelled, restarting the tool workers")
+            self._restart(executor)
+        except Exception:
+            pass
+
+    def _record(self, outcome):
+        with self._lock:
+            self.stats['calls'] += 1
+            self.stats['duration_ms_total'] += outcome['duration_ms']
+            if outcome['error']:
+                self.stats['errors'] += 1
+            if outcome['timed_out']:
+                self.stats['timeouts'] += 1
+            if outcome.get('cancelled'):
+                self.stats['cancelled'] += 1
+            if outcome.get('cached') is not None:
+                self.stats['compile_hits' if outcome['cached'] else 'compile_misses'] += 1
+        return outcome
+
+    def _wait(self, future, timeout, cancel):
+        if cancel is None:
+            return future.result(timeout=timeout)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return future.result(timeout=max(min(CANCEL_POLL_INTERVAL, deadline - time.monotonic()), 0))
+            except FutureTimeoutError:
+                if cancel.is_set():
+                    raise ToolCancelled()
+                if time.monotonic() >= deadline:
+                    raise
+
+    def run(self, tool_def, func_name, args, cancel=None):
+        # Returns the result text for the model together with timing for the call
+        start = time.monotonic()
+        if tool_def is None:
+            return {'result': "Tool execution failed or not implemented.", 'error': True, 'timed_out': False, 'duration_ms': 0}
+        if not tool_def.get('python_code'):
+            return {'result': f"Mock result for {func_name} with args {json.dumps(args)}", 'error': False, 'timed_out': False, 'duration_ms': 0}
+
+        timeout = self._get_timeout()
+        executor = self._get_executor()
+        future = None
+        try:
+            if cancel is not None and cancel.is_set():
+                raise ToolCancelled()
+            call_id = next(self._call_ids)
+            future = executor.submit(_execute, call_id, tool_def.get('id'), tool_version(tool_def), tool_def['python_code'], args, timeout)
+            outcome = self._wait(future, timeout + TIMEOUT_GRACE, cancel)
+        except ToolCancelled:
+            # Queued calls are simply dropped; running ones are interrupted so they free their worker
+            if future is not None and not future.cancel():
+                self._interrupt(executor, future, call_id)
+            outcome = {'result': "Tool call cancelled", 'error': True, 'timed_out': False, 'cancelled': True}
+        except FutureTimeoutError:
+            logger.warning(f"Ollama tool {func_name} did not stop after {timeout}s, restarting the tool workers")
+            self._restart(executor)
+            outcome = {'result': f"Error executing tool: timed out after {timeout}s", 'error': True, 'timed_out': True}
+        except BrokenProcessPool as e:
+            # Usually the memory limit or a crash in native code
+            logger.warning(f"Ollama tool worker died while running {func_name}: {e}")
+            self._restart(executor)
+            outcome = {'result': "Error executing tool: the tool process exited unexpectedly", 'error': True, 'timed_out': False}
+        except Exception as e:
+            outcome = {'result': f"Error executing tool: {str(e)}", 'error': True, 'timed_out': False}
+        outcome['duration_ms'] = int((time.monotonic() - start) * 1000)
+        return self._record(outcome)
+
+    async def run_async(self, tool_def, func_name, args, cancel=None):
+        return await asyncio.to_thread(self.run, tool_def, func_name, args, cancel)
+
+    def _get_concurrency(self):
+        return max(getattr(settings, 'OLLAMA_TOOL_CONCURRENCY', TOOL_CONCURRENCY), 1)
+
+    def run_many(self, calls, cancel=None):
+        # Yields (index, outcome) as each (tool_def, func_name, args) call finishes
+        concurrency = min(len(calls), self._get_concurrency())
+        if concurrency <= 1:
+            for i, call in enumerate(calls):
+                yield i, self.run(*call, cancel=cancel)
+            return
+        pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='ollama-tools')
+        futures = {pool.submit(self.run, *call, cancel=cancel): i for i, call in enumerate(calls)}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            # Closed early when the client went away: stop the calls instead of waiting them out
+            if cancel is not None and not all(future.done() for future in futures):
+                cancel.cancel()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    async def iter_many_async(self, calls, cancel=None):
+        # Yields (index, outcome) as each call finishes, like run_many
+        semaphore = asyncio.Semaphore(self._get_concurrency())
+
+        async def run_one(i, call):
+            async with semaphore:
+                return i, await self.run_async(*call, cancel=cancel)
+
+        tasks = [asyncio.ensure_future(run_one(i, call)) for i, call in enumerate(calls)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def run_many_async(self, calls, on_result=None, cancel=None):
+        # Returns outcomes in call order; on_result is awaited as each call finishes
+        outcomes = [None] * len(calls)
+        async for i, outcome in self.iter_many_async(calls, cancel):
+            outcomes[i] = outcome
+            if on_result:
+                await on_result(i, outcome)
+        return outcomes
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+tool_runner = ToolRunner()
@@ -1,13 +1,31 @@
+import asyncio
+import hmac
 import json
-import ollama
-import httpx
-import threading
+import logging
 import time
+import uuid
+from django.conf import settings
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, StreamingHttpResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
+from asgiref.sync import sync_to_async
 from core.models import Tool
 from core.utils import devops_admin_required
+from . import context_window, image_store, model_cache, response_cache
+from .chat_sessions import chat_sessions
+from .chat_reply import ChatReply, HtmlReplyFrames
+from .metrics import render_prometheus
+from .clients import get_async_client, get_client
+from .pulls import pull_manager
+from .warm_pool import keep_alive_for, normalize_keep_alive, set_pin, warm_pool
+from .admission import QueueFull, QueueTimeout, admission
+from .cancellation import aiter_cancellable, chat_cancels, iter_cancellable
+from .tool_registry import tool_registry
+from .tool_runner import tool_runner
+from .streaming import FrameCoalescer, QUEUE_CLEAR_SCRIPT, render_append_frame, render_queued_frame
+
+logger = logging.getLogger(__name__)
 
 @login_required
 @devops_admin_required
@@ -16,63 +34,23 @@ def pull_model(request):
         model_name = request.POST.get('model_name')
         if model_name:
             tool = get_object_or_404(Tool, name='ollama')
-            
-            def run_pull():
-                # Use a separate database connection for the background thread to avoid locking issues
-                from django import db
-                db.connections.close_all()
-                
-                try:
-                    client = ollama.Client(host='http://localhost:11434')
-                    # Initialize progress
-                    # Refresh tool object from DB
-                    from core.models import Tool
-                    tool_refresh = Tool.objects.get(pk=tool.pk)
-                    tool_refresh.config_data['pulling_model'] = model_name
-                    tool_refresh.config_data['pull_progress'] = 0
-                    tool_refresh.save()
-                    
-                    for part in client.pull(model_name, stream=True):
-                        # Get a fresh tool object to ensure we don't overwrite other changes
-                        from core.models import Tool
-                        tool_refresh = Tool.objects.get(pk=tool.pk)
-                        
-                        if 'completed' in part and 'total' in part:
-                            progress = int((part['completed'] / part['total']) * 100)
-                            tool_refresh.config_data['pull_progress'] = progress
-                            tool_refresh.config_data['pulling_model'] = model_name
-                            tool_refresh.save()
-                        elif 'status' in part:
-                            # If status is 'success', we can finish early
-                            if part.get('status') == 'success':
-                                break
-                            tool_refresh.config_data['pull_status'] = part['status']
-                            tool_refresh.config_data['pulling_model'] = model_name
-                            tool_refresh.save()
-                            
-                    # Final cleanup after success
-                    # Wait a tiny bit to ensure the last save from loop is finished
-                    time.sleep(0.5)
-                    tool_refresh = Tool.objects.get(pk=tool.pk)
-                    tool_refresh.config_data.pop('pulling_model', None)
-                    tool_refresh.config_data.pop('pull_progress', None)
-                    tool_refresh.config_data.pop('pull_status', None)
-                    tool_refresh.config_data.pop('pull_error', None) # Also clear old errors
-                    tool_refresh.save()
-                except Exception as e:
-                    try:
-                        from core.models import Tool
-                        tool_refresh = Tool.objects.get(pk=tool.pk)
-                        tool_refresh.config_data['pull_error'] = str(e)
-                        tool_refresh.config_data.pop('pulling_model', None)
-                        tool_refresh.save()
-                    except:
-                        pass
-
-            threading.Thread(target=run_pull).start()
+            # Duplicate requests for a model that is already being pulled are ignored
+            job = pull_manager.submit(tool.pk, model_name)
+            if job and tool.config_data.pop('pull_error', None) is not None: # Also clear old errors
+                tool.save()
             
     return redirect('/tool/ollama/?tab=models')
 
+@login_required
+@devops_admin_required
+def cancel_pull(request):
+    if request.method == 'POST':
+        model_name = request.POST.get('model_name')
+        if model_name:
+            pull_manager.cancel(model_name)
+        return redirect('/tool/ollama/?tab=models')
+    return HttpResponse("Method not allowed", status=405)
+
 @login_required
 @devops_admin_required
 def delete_model(request):
@@ -80,12 +58,50 @@ def delete_model(request):
         model_name = request.POST.get('model_name')
         if model_name:
             try:
-                client = ollama.Client(host='http://localhost:11434')
+                client = get_client()
                 client.delete(model_name)
             except Exception as e:
                 return HttpResponse(f"Error deleting model: {str(e)}", status=500)
+            tool = Tool.objects.filter(name='ollama').first()
+            if tool:
+                # Refreshing the list pushes the removed row to open Models tabs
+                model_cache.refresh_in_background(tool.pk, lambda: model_cache.list_models(client))
     return redirect('/tool/ollama/?tab=models')
 
+@login_required
+@devops_admin_required
+def pin_model(request):
+    if request.method == 'POST':
+        model_name = request.POST.get('model_name')
+        keep_alive = request.POST.get('keep_alive', '').strip()
+        if model_name:
+            tool = get_object_or_404(Tool, name='ollama')
+            if keep_alive:
+                try:
+                    normalize_keep_alive(keep_alive)
+                except ValueError as e:
+                    return HttpResponse(str(e), status=400)
+                set_pin(tool, model_name, keep_alive)
+                warm_pool.preload(model_name, normalize_keep_alive(keep_alive), reason='pin', dedupe=False)
+                warm_pool.ensure_scheduler()
+            else:
+                set_pin(tool, model_name, None)
+                # Hands the model back to the daemon's default keep_alive if it is loaded
+                warm_pool.release(model_name)
+        return redirect('/tool/ollama/?tab=models')
+    return HttpResponse("Method not allowed", status=405)
+
+@login_required
+def preload_model(request):
+    if request.method == 'POST':
+        model_name = request.POST.get('model_name')
+        if not model_name:
+            return HttpResponse("Model is required", status=400)
+        # Selecting a model in chat loads it in the background so the first message skips the load time
+        queued = warm_pool.preload(model_name, keep_alive_for(model_name))
+        return JsonResponse({'queued': queued})
+    return HttpResponse("Method not allowed", status=405)
+
 @login_required
 @devops_admin_required
 def save_tool(request):
@@ -129,6 +145,7 @@ def save_tool(request):
             tool.config_data['ollama_tools'].append(new_tool)
             
         tool.save()
+        tool_registry.invalidate()
         return redirect('/tool/ollama/?tab=tools')
     return HttpResponse("Method not allowed", status=405)
 
@@ -142,318 +159,388 @@ def delete_tool(request):
             if 'ollama_tools' in tool.config_data:
                 tool.config_data['ollama_tools'] = [t for t in tool.config_data['ollama_tools'] if t['id'] != tool_id]
                 tool.save()
+                tool_registry.invalidate()
         return redirect('/tool/ollama/?tab=tools')
     return HttpResponse("Method not allowed", status=405)
 
+def close_stream(stream):
+    # Replayed and mocked streams may be plain iterables
+    close = getattr(stream, 'close', None)
+    if close:
+        close()
+
+async def aclose_stream(stream):
+    aclose = getattr(stream, 'aclose', None)
+    if aclose:
+        await aclose()
+
 @login_required
-def chat_send(request):
+def chat_cancel(request):
     if request.method == 'POST':
-        model = request.POST.get('model')
-        message = request.POST.get('message')
-        history = request.POST.get('history', '[]')
-        
-        # Handle file upload
-        images = []
-        attachment_file = request.FILES.get('attachment')
-        if attachment_file:
-            import base64
-            # Check if it's an image
-            if attachment_file.content_type.startswith('image/'):
-                try:
-                    image_data = attachment_file.read()
-                    image_base64 = base64.b64encode(image_data).decode('utf-8')
-                    images.append(image_base64)
-                except Exception as e:
-                    logger.error(f"Failed to process image attachment: {e}")
-            elif attachment_file.content_type.startswith('text/') or attachment_file.name.endswith(('.py', '.js', '.json', '.md', '.txt', '.sh', '.yaml', '.yml')):
-                try:
-                    file_content = attachment_file.read().decode('utf-8')
-                    # Prepend file content to message for context
-                    message = f"File: {attachment_file.name}\n---\n{file_content}\n---\n\n{message}"
-                except Exception as e:
-                    logger.error(f"Failed to process text attachment: {e}")
-            else:
-                # For other types, we just add the name for now as Ollama doesn't support direct video/audio yet
-                message = f"(Attached file: {attachment_file.name})\n\n{message}"
+        request_id = request.POST.get('request_id', '').strip()
+        if not request_id:
+            return HttpResponse("request_id is required", status=400)
+        # The stream may be served by another worker; it picks the cancel up from the cache
+        running_here = chat_cancels.cancel(request.user.pk, request_id)
+        return JsonResponse({'request_id': request_id, 'cancelled': True, 'local': running_here})
+    return HttpResponse("Method not allowed", status=405)
 
-        try:
-            total_tokens = int(request.POST.get('total_tokens', 0))
-        except (ValueError, TypeError):
-            total_tokens = 0
-            
-        try:
-            history_list = json.loads(history)
-        except Exception:
-            history_list = []
+def _metrics_response(request):
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
-        try:
-            temperature = float(request.POST.get('temperature', 0.7))
-            top_p = float(request.POST.get('top_p', 0.9))
-            num_ctx = int(request.POST.get('num_ctx', 4096))
-            system_prompt = request.POST.get('system_prompt', '').strip()
-            user_role = request.POST.get('user_role', 'user').strip()
-            api_token = request.POST.get('api_token', '').strip()
-            thinking_enabled = request.POST.get('thinking', 'false') == 'true'
-            selected_tools_ids = request.POST.getlist('selected_tools')
-        except (ValueError, TypeError) as e:
-            return HttpResponse(f"Invalid parameter value: {str(e)}", status=400)
-            
-        if not model or not message:
-            return HttpResponse(f"Model and message are required", status=400)
+@login_required
+@devops_admin_required
+def _admin_metrics(request):
+    return _metrics_response(request)
 
-        # Get tool definitions
-        tool_obj = get_object_or_404(Tool, name='ollama')
-        all_tools = tool_obj.config_data.get('ollama_tools', [])
-        selected_tools = [t for t in all_tools if t['id'] in selected_tools_ids]
-        
-        # Format for Ollama API
-        api_tools = []
-        for t in selected_tools:
-            api_tools.append({
-                'type': 'function',
-                'function': {
-                    'name': t['name'],
-                    'description': t['description'],
-                    'parameters': t['parameters']
-                }
-            })
-            
-        # Handle thinking instructions
-        thinking_instruction = "Always reason step by step inside <thought> tags before providing your final answer. You MUST start your response with a <thought> block."
-        if thinking_enabled:
-            if system_prompt:
-                system_prompt += f"\n{thinking_instruction}"
-            else:
-                system_prompt = thinking_instruction
+def metrics(request):
+    # Scrapers cannot log in, so a configured bearer token replaces the admin session
+    token = getattr(settings, 'OLLAMA_METRICS_TOKEN', None)
+    if not token:
+        return _admin_metrics(request)
+    auth = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(auth.encode(), f'Bearer {token}'.encode()):
+        return HttpResponse("Unauthorized", status=401)
+    return _metrics_response(request)
+
+def prepare_chat(request):
+    # Parses a chat_send request and builds the messages for Ollama; returns an HttpResponse on invalid input
+    model = request.POST.get('model')
+    message = request.POST.get('message')
+    session_id = request.POST.get('session_id', '').strip()
+    # Lets the client stop this stream through chat_cancel
+    request_id = request.POST.get('request_id', '').strip() or uuid.uuid4().hex
+    # Only older clients still post the full history; it seeds a new session
+    history = request.POST.get('history', '[]')
+    
+    # Handle file upload
+    image_refs = []
+    attachment_file = request.FILES.get('attachment')
+    if attachment_file:
+        # Check if it's an image
+        if attachment_file.content_type.startswith('image/'):
+            try:
+                # Stored once by content hash; messages only carry the reference
+                image_refs.append(image_store.put(attachment_file.read()))
+            except Exception as e:
+                logger.error(f"Failed to process image attachment: {e}")
+        elif attachment_file.content_type.startswith('text/') or attachment_file.name.endswith(('.py', '.js', '.json', '.md', '.txt', '.sh', '.yaml', '.yml')):
+            try:
+                file_content = attachment_file.read().decode('utf-8')
+                # Prepend file content to message for context
+                message = f"File: {attachment_file.name}\n---\n{file_content}\n---\n\n{message}"
+            except Exception as e:
+                logger.error(f"Failed to process text attachment: {e}")
         else:
-            # Try to suppress thinking if disabled
-            suppress_instruction = "Do not use <thought> tags or reasoning process. Answer directly."
-            if system_prompt:
-                system_prompt += f"\n{suppress_instruction}"
-            else:
-                system_prompt = suppress_instruction
-            
-        user_message = {"role": user_role, "content": message}
-        if images:
-            user_message["images"] = images
-            
-        history_list.append(user_message)
+            # For other types, we just add the name for now as Ollama doesn't support direct video/audio yet
+            message = f"(Attached file: {attachment_file.name})\n\n{message}"
+
+    try:
+        total_tokens = int(request.POST.get('total_tokens', 0))
+    except (ValueError, TypeError):
+        total_tokens = 0
         
-        api_messages = []
+    try:
+        history_list = json.loads(history)
+    except Exception:
+        history_list = []
+    session_id, history_list = chat_sessions.resume(request.user.pk, session_id, history_list)
+
+    try:
+        temperature = float(request.POST.get('temperature', 0.7))
+        top_p = float(request.POST.get('top_p', 0.9))
+        num_ctx = int(request.POST.get('num_ctx', 4096))
+        system_prompt = request.POST.get('system_prompt', '').strip()
+        user_role = request.POST.get('user_role', 'user').strip()
+        api_token = request.POST.get('api_token', '').strip()
+        thinking_enabled = request.POST.get('thinking', 'false') == 'true'
+        selected_tools_ids = request.POST.getlist('selected_tools')
+        context_strategy = request.POST.get('context_strategy') or None
+    except (ValueError, TypeError) as e:
+        return HttpResponse(f"Invalid parameter value: {str(e)}", status=400)
+        
+    if not model or not message:
+        return HttpResponse(f"Model and message are required", status=400)
+
+    # Tool definitions and their API schemas come from the in-process registry
+    tools = tool_registry.get()
+    api_tools = tools.select(selected_tools_ids)
+        
+    # Handle thinking instructions
+    thinking_instruction = "Always reason step by step inside <thought> tags before providing your final answer. You MUST start your response with a <thought> block."
+    if thinking_enabled:
+        if system_prompt:
+            system_prompt += f"\n{thinking_instruction}"
+        else:
+            system_prompt = thinking_instruction
+    else:
+        # Try to suppress thinking if disabled
+        suppress_instruction = "Do not use <thought> tags or reasoning process. Answer directly."
         if system_prompt:
-            api_messages.append({"role": "system", "content": system_prompt})
+            system_prompt += f"\n{suppress_instruction}"
+        else:
+            system_prompt = suppress_instruction
         
-        for m in history_list:
-            msg = {"role": m["role"], "content": m["content"]}
-            if "images" in m:
-                msg["images"] = m["images"]
-            api_messages.append(msg)
+    user_message = {"role": user_role, "content": message}
+    if image_refs:
+        user_message["image_refs"] = image_refs
         
-        def stream_generator():
+    history_list.append(user_message)
+    
+    api_messages = []
+    if system_prompt:
+        api_messages.append({"role": "system", "content": system_prompt})
+    
+    for m in history_list:
+        msg = {"role": m["role"], "content": m["content"]}
+        if "images" in m:
+            msg["images"] = m["images"]
+        if "image_refs" in m:
+            msg["image_refs"] = m["image_refs"]
+        api_messages.append(msg)
+    
+    return {
+        'model': model,
+        'session_id': session_id,
+        'request_id': request_id,
+        'total_tokens': total_tokens,
+        'api_token': api_token,
+        # Fitted into num_ctx by ChatReply.fit once the request holds a slot
+        'api_messages': api_messages,
+        'context_strategy': context_strategy,
+        'api_tools': api_tools,
+        'tools': tools,
+        # Pinned models keep their own lease instead of the daemon default
+        'keep_alive': keep_alive_for(model),
+        # Deterministic requests can be replayed from the response cache; the digest ties entries to the model version
+        'digest': response_cache.get_model_digest(model) if response_cache.is_enabled() else None,
+        'options': {
+            "temperature": temperature,
+            "top_p": top_p,
+            "num_ctx": num_ctx
+        }
+    }
+
+@login_required
+def chat_send(request):
+    if request.method == 'POST':
+        chat = prepare_chat(request)
+        if isinstance(chat, HttpResponse):
+            return chat
+        model = chat['model']
+
+        # Content is batched into small append frames instead of one script per token
+        coalescer = FrameCoalescer(render_append_frame)
+        cancel = chat_cancels.register(request.user.pk, chat['request_id'])
+
+        def generate_reply():
+            reply = ChatReply(chat, HtmlReplyFrames(coalescer), cancel)
             try:
-                headers = {}
-                if api_token:
-                    headers["Authorization"] = f"Bearer {api_token}"
-                
-                # Configure client with no timeout for model generation and tool execution
-                client = ollama.Client(
-                    host='http://localhost:11434', 
-                    headers=headers,
-                    timeout=httpx.Timeout(None)
-                )
-                
-                current_messages = api_messages.copy()
-                total_message_tokens = 0
-                accumulated_full_content = ""
-                
-                # We use a loop to handle potential tool calls and model's final response
+                # Pooled client with no timeout for model generation and tool execution
+                client = get_client(chat['api_token'])
+                yield from reply.start()
+                # Summarizing older turns calls the model, so it only happens once admitted
+                reply.fit(context_window.model_summarizer(client, model))
+
+                # One model turn per pass; tool calls lead to another turn with their results
                 while True:
-                    # Use stream=True for Ollama chat
-                    stream = client.chat(
-                        model=model,
-                        messages=current_messages,
-                        tools=api_tools if api_tools else None,
-                        options={
-                            "temperature": temperature,
-                            "top_p": top_p,
-                            "num_ctx": num_ctx
-                        },
-                        stream=True
-                    )
-                    
-                    full_content = ""
-                    current_turn_tokens = 0
-                    is_reasoning_mode = False
-                    tool_calls = []
-                    
-                    # Check if we already yielded the container
-                    if 'container_yielded' not in locals():
-                        yield f'<div class="d-flex mb-4 animate-fade-in" id="streaming-response-container">' \
-                              f'<div class="flex-shrink-0 me-3">' \
-                              f'<div class="rounded-circle bg-primary d-flex align-items-center justify-content-center" style="width: 32px; height: 32px;">' \
-                              f'<i class="bi bi-robot text-white"></i>' \
-                              f'</div>' \
-                              f'</div>' \
-                              f'<div class="flex-grow-1">' \
-                              f'<div class="fw-bold small mb-1">Ollama <span class="text-muted fw-normal">({model})</span></div>' \
-                              f'<div class="p-3 rounded-3 border border-secondary border-opacity-25 text-main small shadow-sm markdown-content" ' \
-                              f'style="max-width: 85%; background-color: var(--card-bg);" id="streaming-text-target">' \
-                              f'<div id="streaming-loader" class="py-1 d-flex gap-1">' \
-                              f'<span class="spinner-grow spinner-grow-sm text-primary" role="status" style="width: 8px; height: 8px;"></span>' \
-                              f'<span class="spinner-grow spinner-grow-sm text-primary" role="status" style="width: 8px; height: 8px; animation-delay: 0.2s"></span>' \
-                              f'<span class="spinner-grow spinner-grow-sm text-primary" role="status" style="width: 8px; height: 8px; animation-delay: 0.4s"></span>' \
-                              f'</div>' \
-                              f'</div>' \
-                              f'<div class="mt-1 ms-1" id="streaming-tokens-target" style="display:none; font-size: 10px; color: var(--muted);">' \
-                              f'<i class="bi bi-lightning-charge-fill me-1"></i><span class="token-count">0</span> tokens' \
-                              f'</div>' \
-                              f'</div></div>'
-                        container_yielded = True
+                    cache_key = reply.cache_key()
+                    cached = response_cache.response_cache.get(cache_key)
+                    if cached is not None:
+                        stream = response_cache.replay(cached)
+                    else:
+                        stream = client.chat(**reply.chat_kwargs(image_store.resolve_images(reply.messages)))
+                        if cache_key:
+                            stream = response_cache.record(cache_key, model, chat['digest'], stream)
+                    # A stop is seen even while the daemon is still evaluating the prompt
+                    stream = iter_cancellable(stream, cancel)
 
+                    yield from reply.begin_turn()
                     try:
                         for chunk in stream:
-                            # Handle thinking/reasoning content if present
-                            reasoning = chunk.get('message', {}).get('reasoning_content', '')
-                            content = chunk.get('message', {}).get('content', '')
-                            
-                            # Collect tool calls if present
-                            chunk_tool_calls = chunk.get('message', {}).get('tool_calls', [])
-                            if chunk_tool_calls:
-                                tool_calls.extend(chunk_tool_calls)
-                            
-                            if reasoning:
-                                if not is_reasoning_mode:
-                                    is_reasoning_mode = True
-                                    full_content += "<thought>\n"
-                                    yield f'<script>document.getElementById("streaming-text-target").textContent += "<thought>\\n";</script>'
-                                full_content += reasoning
-                                safe_reasoning = json.dumps(reasoning, ensure_ascii=False)
-                                yield f'<script>' \
-                                      f'var target = document.getElementById("streaming-text-target");' \
-                                      f'var loader = document.getElementById("streaming-loader");' \
-                                      f'if(loader) loader.remove();' \
-                                      f'target.textContent += {safe_reasoning};' \
-                                      f'document.getElementById("chat-history-container").scrollTop = document.getElementById("chat-history-container").scrollHeight;' \
-                                      f'</script>'
-                            
-                            if content:
-                                if is_reasoning_mode:
-                                    is_reasoning_mode = False
-                                    full_content += "\n</thought>\n\n"
-                                    yield f'<script>document.getElementById("streaming-text-target").textContent += "\\n</thought>\\n\\n";</script>'
-                                
-                                full_content += content
-                                safe_content = json.dumps(content, ensure_ascii=False)
-                                yield f'<script>' \
-                                      f'var target = document.getElementById("streaming-text-target");' \
-                                      f'var loader = document.getElementById("streaming-loader");' \
-                                      f'if(loader) loader.remove();' \
-                                      f'target.textContent += {safe_content};' \
-                                      f'document.getElementById("chat-history-container").scrollTop = document.getElementById("chat-history-container").scrollHeight;' \
-                                      f'</script>'
-                            
-                            if chunk.get('done'):
-                                current_turn_tokens = chunk.get('prompt_eval_count', 0) + chunk.get('eval_count', 0)
-                                total_message_tokens += current_turn_tokens
+                            if cancel.is_set():
+                                reply.stopped = True
+                                break
+                            frame = reply.add(chunk)
+                            if frame:
+                                yield frame
                     except (GeneratorExit, ConnectionResetError):
+                        cancel.cancel()
+                        close_stream(stream)
                         return
+                    # Closing a stopped stream stops the daemon from generating the rest
+                    close_stream(stream)
+                    yield from reply.end_turn()
+                    if not reply.calls:
+                        break
 
-                    if is_reasoning_mode:
-                        full_content += "\n</thought>"
-                        yield f'<script>document.getElementById("streaming-text-target").textContent += "\\n</thought>";</script>'
-                    
-                    accumulated_full_content += full_content
-                    
-                    if tool_calls:
-                        assistant_msg = {'role': 'assistant', 'content': full_content, 'tool_calls': tool_calls}
-                        current_messages.append(assistant_msg)
-                        
-                        for tool_call in tool_calls:
-                            func_name = tool_call.get('function', {}).get('name')
-                            func_args = tool_call.get('function', {}).get('arguments', {})
-                            
-                            yield f'<script>' \
-                                  f'var target = document.getElementById("streaming-text-target");' \
-                                  f'var loader = document.getElementById("streaming-loader");' \
-                                  f'if(loader) loader.remove();' \
-                                  f'target.innerHTML += \'<div class="alert alert-info py-2 px-3 mt-2 mb-0 d-flex align-items-center gap-2 small border-0 shadow-sm" style="background: rgba(var(--bs-info-rgb), 0.1);"><i class="bi bi-cpu"></i> Calling tool: <b>{func_name}</b>({json.dumps(func_args)})</div>\';' \
-                                  f'document.getElementById("chat-history-container").scrollTop = document.getElementById("chat-history-container").scrollHeight;' \
-                                  f'</script>'
-                            
-                            result = "Tool execution failed or not implemented."
-                            tool_def = next((t for t in all_tools if t['name'] == func_name), None)
-                            if tool_def and tool_def.get('python_code'):
-                                try:
-                                    exec_globals = {'args': func_args, 'result': None}
-                                    exec(tool_def['python_code'], exec_globals)
-                                    result = str(exec_globals.get('result', 'Success (no result returned)'))
-                                except Exception as e:
-                                    result = f"Error executing tool: {str(e)}"
-                            elif tool_def:
-                                result = f"Mock result for {func_name} with args {json.dumps(func_args)}"
-                            
-                            current_messages.append({
-                                'role': 'tool',
-                                'content': result,
-                            })
-                            
-                            yield f'<script>' \
-                                  f'var target = document.getElementById("streaming-text-target");' \
-                                  f'target.innerHTML += \'<div class="alert alert-success py-1 px-3 mt-1 mb-2 d-flex align-items-center gap-2 x-small border-0 shadow-sm" style="background: rgba(var(--bs-success-rgb), 0.1); font-family: monospace;"><i class="bi bi-check-circle"></i> Result: {json.dumps(result)}</div>\';' \
-                                  f'document.getElementById("chat-history-container").scrollTop = document.getElementById("chat-history-container").scrollHeight;' \
-                                  f'</script>'
-                        continue
-                    else:
+                    # Calls run concurrently in worker processes with a timeout
+                    for i, outcome in tool_runner.run_many(reply.calls, cancel):
+                        yield reply.tool_result(i, outcome)
+                    if not reply.end_tools():
                         break
-                
-                final_assistant_msg = {"role": "assistant", "content": full_content}
-                if tool_calls:
-                    final_assistant_msg["tool_calls"] = tool_calls
-                
-                new_history = []
-                for m in current_messages:
-                    if m['role'] == 'system':
-                        continue
-                    new_history.append(m)
-                
-                if not tool_calls:
-                    new_history.append(final_assistant_msg)
-                
-                history_list = new_history
-                new_total_tokens = total_tokens + total_message_tokens
-                
-                safe_full_content = json.dumps(accumulated_full_content, ensure_ascii=False)
-                history_json_str = json.dumps(history_list, ensure_ascii=False)
-                safe_history_js_val = json.dumps(history_json_str, ensure_ascii=False)
-
-                yield f'<script>' \
-                      f'var container = document.getElementById("streaming-response-container");' \
-                      f'var target = document.getElementById("streaming-text-target");' \
-                      f'var tokensTarget = document.getElementById("streaming-tokens-target");' \
-                      f'var loader = document.getElementById("streaming-loader");' \
-                      f'if(loader) loader.remove();' \
-                      f'target.setAttribute("data-raw-content", {safe_full_content});' \
-                      f'target.removeAttribute("id");' \
-                      f'if(tokensTarget) {{' \
-                      f'  tokensTarget.querySelector(".token-count").innerText = "{total_message_tokens}";' \
-                      f'  tokensTarget.style.display = "block";' \
-                      f'  tokensTarget.removeAttribute("id");' \
-                      f'}}' \
-                      f'container.removeAttribute("id");' \
-                      f'if(window.renderMarkdown) window.renderMarkdown(target);' \
-                      f'target.setAttribute("data-rendered", "true");' \
-                      f'document.getElementById("history-input").value = {safe_history_js_val};' \
-                      f'document.getElementById("total-tokens-input").value = "{new_total_tokens}";' \
-                      f'document.getElementById("total-tokens-display").innerText = "{new_total_tokens}";' \
-                      f'</script>'
-                      
+
+                chat_sessions.append(request.user.pk, chat['session_id'], reply.session_messages(), reply.tokens)
+                yield reply.done()
+
+            except GeneratorExit:
+                # The client went away; the cancel token interrupts running tools along with the stream
+                cancel.cancel()
+                raise
             except Exception as e:
-                error_msg = str(e)
-                if "unauthorized" in error_msg.lower() or "401" in error_msg:
-                    error_msg = "Ollama is unauthorized to use this model."
-                
-                yield f'<div class="alert alert-danger small mt-2">{error_msg}</div>'
+                yield reply.error(e)
+            finally:
+                reply.log_stats("Ollama chat stream")
 
-        return StreamingHttpResponse(stream_generator(), content_type='text/html')
+        def stream_generator():
+            # Requests beyond the per-model and global limits wait here instead of piling onto the daemon
+            try:
+                ticket = admission.enqueue(model, request.user.pk)
+            except QueueFull as e:
+                chat_cancels.unregister(cancel)
+                yield coalescer.record(f'<div class="alert alert-warning small mt-2">{e}</div>')
+                return
+            try:
+                queued = False
+                try:
+                    for position in admission.wait_positions(ticket, cancel=cancel):
+                        queued = True
+                        yield coalescer.record(render_queued_frame(position))
+                except QueueTimeout as e:
+                    yield coalescer.record(QUEUE_CLEAR_SCRIPT)
+                    yield coalescer.record(f'<div class="alert alert-warning small mt-2">{e}</div>')
+                    return
+                if queued:
+                    yield coalescer.record(QUEUE_CLEAR_SCRIPT)
+                if cancel.is_set():
+                    yield coalescer.record('<div class="alert alert-secondary small mt-2">Stopped</div>')
+                    return
+                yield from generate_reply()
+            finally:
+                # Frees the model slot as soon as the stream stops, whatever the reason
+                admission.release(ticket)
+                chat_cancels.unregister(cancel)
+
+        response = StreamingHttpResponse(stream_generator(), content_type='text/html')
+        # Ids generated here are only known to the client through this header, which chat_cancel needs
+        response['X-Request-Id'] = chat['request_id']
+        # Updated in place while streaming, so byte and flush counts are measurable per response
+        response.stream_stats = coalescer.stats
+        return response
             
     return HttpResponse("Method not allowed", status=405)
+
+async def chat_send_async(request):
+    # Same stream as chat_send, served from the event loop so a long reply does not hold a worker thread.
+    # The user is resolved in a thread because the session lookup hits the database
+    user = await sync_to_async(lambda: request.user if request.user.is_authenticated else None)()
+    if user is None:
+        return redirect_to_login(request.get_full_path())
+    if request.method != 'POST':
+        return HttpResponse("Method not allowed", status=405)
+
+    chat = await sync_to_async(prepare_chat)(request)
+    if isinstance(chat, HttpResponse):
+        return chat
+    model = chat['model']
+
+    coalescer = FrameCoalescer(render_append_frame)
+    cancel = chat_cancels.register(user.pk, chat['request_id'])
+
+    async def generate_reply():
+        reply = ChatReply(chat, HtmlReplyFrames(coalescer), cancel)
+        try:
+            # One keep-alive pool per event loop is shared by every stream on this worker
+            client = get_async_client(chat['api_token'])
+            for frame in reply.start():
+                yield frame
+            # Summarizing older turns calls the model, so it only happens once admitted
+            await asyncio.to_thread(reply.fit, context_window.model_summarizer(get_client(chat['api_token']), model))
+
+            while True:
+                cache_key = reply.cache_key()
+                cached = await sync_to_async(response_cache.response_cache.get)(cache_key) if cache_key else None
+                if cached is not None:
+                    stream = response_cache.areplay(cached)
+                else:
+                    # Only loading attachments touches the disk; plain text messages skip the thread hop
+                    messages = reply.messages
+                    if image_store.message_refs(messages):
+                        messages = await asyncio.to_thread(image_store.resolve_images, messages)
+                    stream = await client.chat(**reply.chat_kwargs(messages))
+                    if cache_key:
+                        stream = response_cache.arecord(cache_key, model, chat['digest'], stream)
+                stream = aiter_cancellable(stream, cancel)
+
+                for frame in reply.begin_turn():
+                    yield frame
+                try:
+                    async for chunk in stream:
+                        if cancel.is_set():
+                            reply.stopped = True
+                            break
+                        frame = reply.add(chunk)
+                        if frame:
+                            yield frame
+                except (GeneratorExit, ConnectionResetError):
+                    cancel.cancel()
+                    await aclose_stream(stream)
+                    return
+                except asyncio.CancelledError:
+                    cancel.cancel()
+                    await aclose_stream(stream)
+                    raise
+                await aclose_stream(stream)
+                for frame in reply.end_turn():
+                    yield frame
+                if not reply.calls:
+                    break
+
+                async for i, outcome in tool_runner.iter_many_async(reply.calls, cancel):
+                    yield reply.tool_result(i, outcome)
+                if not reply.end_tools():
+                    break
+
+            await sync_to_async(chat_sessions.append)(user.pk, chat['session_id'], reply.session_messages(), reply.tokens)
+            yield reply.done()
+
+        except (GeneratorExit, asyncio.CancelledError):
+            cancel.cancel()
+            raise
+        except Exception as e:
+            yield reply.error(e)
+        finally:
+            reply.log_stats("Ollama async chat stream")
+
+    async def stream_generator():
+        try:
+            ticket = admission.enqueue(model, user.pk)
+        except QueueFull as e:
+            chat_cancels.unregister(cancel)
+            yield coalescer.record(f'<div class="alert alert-warning small mt-2">{e}</div>')
+            return
+        try:
+            queued = False
+            try:
+                async for position in admission.wait_positions_async(ticket, cancel=cancel):
+                    queued = True
+                    yield coalescer.record(render_queued_frame(position))
+            except QueueTimeout as e:
+                yield coalescer.record(QUEUE_CLEAR_SCRIPT)
+                yield coalescer.record(f'<div class="alert alert-warning small mt-2">{e}</div>')
+                return
+            if queued:
+                yield coalescer.record(QUEUE_CLEAR_SCRIPT)
+            if cancel.is_set():
+                yield coalescer.record('<div class="alert alert-secondary small mt-2">Stopped</div>')
+                return
+            async for frame in generate_reply():
+                yield frame
+        finally:
+            admission.release(ticket)
+            chat_cancels.unregister(cancel)
+
+    response = StreamingHttpResponse(stream_generator(), content_type='text/html')
+    response['X-Request-Id'] = chat['request_id']
+    response.stream_stats = coalescer.stats
+    return response
@@ -0,0 +1,189 @@
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
+from .capabilities import get_model_field
+from .clients import get_client
+
+logger = logging.getLogger(__name__)
+
+# Pinned models and their keep_alive; the source of truth is Tool.config_data['warm_pool']
+PINS_KEY = 'ollama_warm_pool_pins'
+STATUS_KEY = 'ollama_warm_pool_status'
+RUNNING_KEY = 'ollama_warm_pool_running'
+RECONCILE_LOCK_KEY = 'ollama_warm_pool_reconcile_lock'
+DEFAULT_KEEP_ALIVE = '1h'
+KEEP_ALIVE_CHOICES = ['30m', '1h', '4h', '24h', '-1']
+RECONCILE_INTERVAL = 60
+# Repeated selects of the same model within this window trigger a single preload
+PRELOAD_DEDUPE_SECONDS = 30
+MAX_CONCURRENT_PRELOADS = 2
+
+KEEP_ALIVE_RE = re.compile(r'^-?\d+(\.\d+)?(ms|s|m|h)?$')
+
+
+def normalize_keep_alive(value):
+    value = str(value).strip()
+    if not KEEP_ALIVE_RE.match(value):
+        raise ValueError(f"Invalid keep_alive: {value}")
+    # Bare numbers are seconds (negative keeps the model loaded forever) and must be sent as JSON numbers
+    if value[-1].isdigit():
+        number = float(value)
+        return int(number) if number.is_integer() else number
+    return value
+
+
+def _preload_key(model_name):
+    return f'ollama_preload_{model_name}'
+
+
+def get_pins():
+    pins = cache.get(PINS_KEY)
+    if pins is None:
+        from core.models import Tool
+        tool = Tool.objects.filter(name='ollama').first()
+        pins = tool.config_data.get('warm_pool', {}) if tool else {}
+        cache.set(PINS_KEY, pins, None)
+    return pins
+
+
+def set_pin(tool, model_name, keep_alive):
+    pins = dict(tool.config_data.get('warm_pool', {}))
+    if keep_alive is None:
+        pins.pop(model_name, None)
+    else:
+        pins[model_name] = keep_alive
+    tool.config_data['warm_pool'] = pins
+    tool.save()
+    cache.set(PINS_KEY, pins, None)
+    return pins
+
+
+def keep_alive_for(model_name):
+    # None leaves the daemon's default; chat requests for pinned models must not shorten their lease
+    keep_alive = get_pins().get(model_name)
+    return normalize_keep_alive(keep_alive) if keep_alive is not None else None
+
+
+def get_status():
+    return cache.get(STATUS_KEY) or {}
+
+
+def get_running():
+    return cache.get(RUNNING_KEY) or []
+
+
+class WarmPool:
+    """Preloads models in the background and keeps pinned models resident."""
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._in_flight = set()
+        self._scheduler = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            max_workers = self.max_workers or getattr(settings, 'OLLAMA_MAX_CONCURRENT_PRELOADS', MAX_CONCURRENT_PRELOADS)
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ollama-preload')
+        return self._executor
+
+    def _record(self, model_name, **fields):
+        with self._lock:
+            status = get_status()
+            status[model_name] = dict(status.get(model_name, {}), **fields)
+            cache.set(STATUS_KEY, status, None)
+
+    def preload(self, model_name, keep_alive=None, reason='select', dedupe=True):
+        if dedupe and not cache.add(_preload_key(model_name), True, PRELOAD_DEDUPE_SECONDS):
+            return False
+        with self._lock:
+            if model_name in self._in_flight:
+                return False
+            self._in_flight.add(model_name)
+        self._get_executor().submit(self._load, model_name, keep_alive, reason)
+        return True
+
+    def _load(self, model_name, keep_alive, reason):
+        start = time.monotonic()
+        try:
+            # An empty prompt loads the model without generating anything
+            response = get_client().generate(model=model_name, prompt='', keep_alive=keep_alive)
+            load_ms = int((time.monotonic() - start) * 1000)
+            self._record(
+                model_name, loaded_at=time.time(), load_ms=load_ms,
+                daemon_load_ms=int((get_model_field(response, 'load_duration', 0) or 0) / 1e6),
+                reason=reason, error=None
+            )
+            logger.info(f"Loaded Ollama model {model_name} in {load_ms} ms ({reason})")
+        except Exception as e:
+            self._record(model_name, error=str(e), reason=reason)
+            logger.warning(f"Failed to preload Ollama model {model_name}: {e}")
+        finally:
+            with self._lock:
+                self._in_flight.discard(model_name)
+
+    def refresh_running(self):
+        response = get_client().ps()
+        running_models = get_model_field(response, 'models', []) or []
+        running = sorted(get_model_field(m, 'model') or get_model_field(m, 'name') for m in running_models)
+        cache.set(RUNNING_KEY, running, getattr(settings, 'OLLAMA_WARM_POOL_INTERVAL', RECONCILE_INTERVAL) * 2)
+        return running
+
+    def release(self, model_name):
+        # Hands an unpinned model back to the daemon's default keep_alive, off the request path
+        self._get_executor().submit(self._release, model_name)
+
+    def _release(self, model_name):
+        try:
+            running = self.refresh_running()
+        except Exception as e:
+            logger.warning(f"Failed to check whether Ollama model {model_name} is loaded: {e}")
+            return False
+        # Resetting the lease of a model that is not loaded would load it
+        if model_name not in running:
+            return False
+        return self.preload(model_name, None, reason='unpin', dedupe=False)
+
+    def reconcile(self):
+        pins = get_pins()
+        running = self.refresh_running()
+
+        reloaded = []
+        for model_name, keep_alive in pins.items():
+            if model_name in running:
+                continue
+            # Evicted by the daemon (memory pressure or an expired lease): load it again
+            if self.preload(model_name, normalize_keep_alive(keep_alive), reason='reconcile'):
+                reloaded.append(model_name)
+        if reloaded:
+            logger.info(f"Reloading evicted pinned Ollama models: {', '.join(reloaded)}")
+        return reloaded
+
+    def ensure_scheduler(self):
+        with self._lock:
+            if self._scheduler is not None and self._scheduler.is_alive():
+                return
+            self._scheduler = threading.Thread(target=self._run_scheduler, daemon=True)
+            self._scheduler.start()
+
+    def _run_scheduler(self):
+        from django import db
+        interval = getattr(settings, 'OLLAMA_WARM_POOL_INTERVAL', RECONCILE_INTERVAL)
+        while True:
+            # Every worker runs a scheduler, but only one reconciles per interval
+            if cache.add(RECONCILE_LOCK_KEY, True, max(interval - 1, 1)):
+                try:
+                    self.reconcile()
+                except Exception as e:
+                    logger.debug(f"Ollama warm pool reconcile failed: {e}")
+                finally:
+                    db.connection.close()
+            time.sleep(interval)
+
+
+warm_pool = WarmPool()